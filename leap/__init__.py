@@ -1,7 +1,45 @@
-from . import image_augmentation
-from . import layers
-from . import models
-from . import predict_box
-from . import training
-from . import utils
-from . import viz
\ No newline at end of file
+import importlib
+import sys
+import types
+
+# Submodules are imported on first access (e.g., leap.training) so that importing the package does not load Keras,
+# TensorFlow, OpenCV or matplotlib until they are needed.
+__all__ = [
+    "benchmark",
+    "cache",
+    "checkpoints",
+    "cli",
+    "cluster_sample",
+    "distributed",
+    "evaluation",
+    "gait_analysis",
+    "generate_training_set",
+    "image_augmentation",
+    "layers",
+    "models",
+    "predict_box",
+    "prediction_store",
+    "predict_video",
+    "rechunk",
+    "render_predictions",
+    "sweep",
+    "synthetic",
+    "training",
+    "utils",
+    "viz",
+]
+
+
+class _LazyModule(types.ModuleType):
+    # Module-level __getattr__ (PEP 562) requires Python 3.7, so the package's class is replaced instead
+
+    def __getattr__(self, name):
+        if name in __all__:
+            return importlib.import_module("." + name, __name__)
+        raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+    def __dir__(self):
+        return sorted(set(self.__dict__.keys()) | set(__all__))
+
+
+sys.modules[__name__].__class__ = _LazyModule
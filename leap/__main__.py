@@ -0,0 +1,3 @@
+from leap.cli import main
+
+main()
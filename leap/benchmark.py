@@ -0,0 +1,79 @@
+import numpy as np
+from time import time
+import clize
+
+import keras
+from keras.layers import Conv2D, Conv2DTranspose, SeparableConv2D
+
+from leap.training import create_model
+
+
+def count_flops(model):
+    """ Counts the floating point operations (2x multiply-adds) of the convolutional layers of a model for one sample. """
+    flops = 0
+    for layer in model.layers:
+        if isinstance(layer, SeparableConv2D):
+            _, h, w, c_out = layer.output_shape
+            c_in = layer.input_shape[-1] * layer.depth_multiplier
+            kh, kw = layer.kernel_size
+            flops += 2 * h * w * (kh * kw * c_in + c_in * c_out)
+        elif isinstance(layer, Conv2DTranspose):
+            _, h, w, c_in = layer.input_shape
+            c_out = layer.output_shape[-1]
+            kh, kw = layer.kernel_size
+            flops += 2 * h * w * kh * kw * c_in * c_out
+        elif isinstance(layer, Conv2D):
+            _, h, w, c_out = layer.output_shape
+            c_in = layer.input_shape[-1]
+            kh, kw = layer.kernel_size
+            flops += 2 * h * w * kh * kw * c_in * c_out
+    return flops
+
+
+def measure_fps(model, num_samples=512, batch_size=32):
+    """ Measures the prediction throughput of a model in frames per second on random inputs. """
+    X = np.random.rand(num_samples, *model.input_shape[1:]).astype("float32")
+
+    # Warm up (graph finalization, memory allocation)
+    model.predict(X[:batch_size], batch_size=batch_size)
+
+    t0 = time()
+    model.predict(X, batch_size=batch_size)
+    return num_samples / (time() - t0)
+
+
+def benchmark_models(*net_names, img_size=192, channels=1, output_channels=32, filters=64, width_multiplier=1.0, output_stride=1, num_samples=512, batch_size=32):
+    """
+    Prints the size, FLOPs and measured prediction speed of networks on this machine.
+
+    :param net_names: names of the networks to benchmark (see training.create_model). Defaults to all.
+    :param img_size: height and width of the input images
+    :param channels: number of input image channels
+    :param output_channels: number of output channels (joints being predicted)
+    :param filters: number of baseline filters to use
+    :param width_multiplier: scales the number of filters in every layer (only for leap_mobile)
+    :param output_stride: downsampling factor of the output confidence maps relative to the input (1, 2 or 4)
+    :param num_samples: number of random samples to time prediction on
+    :param batch_size: number of samples to evaluate at once per batch
+    """
+    if len(net_names) == 0:
+        net_names = ("leap_cnn", "hourglass", "stacked_hourglass", "leap_mobile")
+
+    print("%-20s %12s %10s %10s" % ("Model", "Params", "GFLOPs", "FPS"))
+    for net_name in net_names:
+        model_kwargs = dict(filters=filters, output_stride=output_stride)
+        if net_name == "leap_mobile":
+            model_kwargs["width_multiplier"] = width_multiplier
+        model = create_model(net_name, (img_size, img_size, channels), output_channels, **model_kwargs)
+        if model == None:
+            print("Could not find model:", net_name)
+            continue
+
+        fps = measure_fps(model, num_samples=num_samples, batch_size=batch_size)
+        print("%-20s %12d %10.2f %10.1f" % (net_name, model.count_params(), count_flops(model) / 1e9, fps))
+
+        keras.backend.clear_session()
+
+
+if __name__ == "__main__":
+    clize.run(benchmark_models)
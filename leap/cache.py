@@ -0,0 +1,224 @@
+import numpy as np
+import h5py
+import hashlib
+import json
+import os
+import re
+import shutil
+from time import time
+
+from leap.utils import check_chunk_layout, split_indices, preprocess, downsample_confmaps
+
+
+def _hash_str(*parts):
+    """ Returns a SHA-1 hex digest of a JSON serialization of the arguments. """
+    return hashlib.sha1(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def file_fingerprint(path):
+    """ Returns a cheap identity of a file's contents from its absolute path, size and modification time. """
+    stat = os.stat(path)
+    return dict(path=os.path.abspath(path), size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+
+
+_file_hashes = {}
+def file_hash(path, block_size=2 ** 20):
+    """ Returns the SHA-1 digest of a file's contents. Memoized by file fingerprint. """
+    fingerprint = _hash_str(file_fingerprint(path))
+    if fingerprint not in _file_hashes:
+        h = hashlib.sha1()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(block_size), b""):
+                h.update(block)
+        _file_hashes[fingerprint] = h.hexdigest()
+    return _file_hashes[fingerprint]
+
+
+def dir_size(path):
+    """ Returns the total size in bytes of the files under a folder. """
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+
+def evict(cache_dir, max_bytes, keep=()):
+    """
+    Deletes least recently used entries (subfolders) of a cache folder until its total size is below max_bytes.
+
+    :param cache_dir: path to the cache folder
+    :param max_bytes: maximum size of the cache in bytes
+    :param keep: names of entries that should not be deleted (e.g., the ones in use)
+    :return: list of deleted entry names
+    """
+    entries = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if os.path.isdir(path) and not name.endswith(".tmp"):
+            entries.append((os.path.getmtime(path), dir_size(path), name))
+
+    total = sum(size for _, size, _ in entries)
+    deleted = []
+    for _, size, name in sorted(entries):
+        if total <= max_bytes:
+            break
+        if name in keep:
+            continue
+        shutil.rmtree(os.path.join(cache_dir, name), ignore_errors=True)
+        total -= size
+        deleted.append(name)
+
+    return deleted
+
+
+class PredictionCache:
+    """
+    Content-addressed store of predicted peaks.
+
+    Entries are keyed by the contents of the weights file, the identity of the box dataset and the peak finding
+    settings. Each entry is a folder of segments saved as START-END.npy with the peaks (samples, [x, y, val], channels)
+    of frames START to END (exclusive), so any frame range can be served from the union of previously predicted ones.
+    """
+
+    segment_pattern = re.compile(r"^(\d+)-(\d+)\.npy$")
+
+    def __init__(self, cache_dir, max_size_gb=10.0):
+        self.cache_dir = cache_dir
+        self.max_bytes = int(max_size_gb * 1024 ** 3)
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, weights_path, box_path, box_dset, **settings):
+        """ Returns the key of the predictions of a model (weights file) on a box dataset with the given settings. """
+        return _hash_str(file_hash(weights_path), file_fingerprint(box_path), box_dset, settings)
+
+    def _entry(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def segments(self, key):
+        """ Returns the (start, end) frame ranges stored under a key. """
+        if not os.path.isdir(self._entry(key)):
+            return []
+        matches = [self.segment_pattern.match(name) for name in os.listdir(self._entry(key))]
+        return sorted((int(m.group(1)), int(m.group(2))) for m in matches if m is not None)
+
+    def get(self, key, start, end):
+        """
+        Looks up the predictions of a frame range.
+
+        :return: hits, misses. hits is a list of (start, peaks) for cached parts of the range and misses is a list
+        of (start, end) for the parts that need to be predicted.
+        """
+        hits, misses = [], []
+        pos = start
+        for seg_start, seg_end in self.segments(key):
+            if seg_end <= pos or seg_start >= end:
+                continue
+            if seg_start > pos:
+                misses.append((pos, seg_start))
+                pos = seg_start
+            Ypk = np.load(os.path.join(self._entry(key), "%d-%d.npy" % (seg_start, seg_end)), mmap_mode="r")
+            hits.append((pos, np.array(Ypk[pos - seg_start:min(seg_end, end) - seg_start])))
+            pos = min(seg_end, end)
+        if pos < end:
+            misses.append((pos, end))
+
+        if len(hits) > 0:
+            os.utime(self._entry(key)) # mark as recently used
+        return hits, misses
+
+    def metadata(self, key):
+        """ Returns the metadata stored with a key (or None). """
+        meta_path = os.path.join(self._entry(key), "meta.json")
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path, "r") as f:
+            return json.load(f)
+
+    def put(self, key, start, Ypk, **metadata):
+        """ Stores the predictions of frames start to start + len(Ypk) and evicts old entries if over the size limit. """
+        entry = self._entry(key)
+        os.makedirs(entry, exist_ok=True)
+
+        # Write to a temporary file first so concurrent readers never see partial segments
+        seg_path = os.path.join(entry, "%d-%d.npy" % (start, start + len(Ypk)))
+        tmp_path = seg_path + ".%d.tmp" % os.getpid()
+        with open(tmp_path, "wb") as f:
+            np.save(f, Ypk)
+        os.replace(tmp_path, seg_path)
+
+        if len(metadata) > 0:
+            with open(os.path.join(entry, "meta.json"), "w") as f:
+                json.dump(dict(metadata, updated=time()), f)
+        os.utime(entry)
+
+        evict(self.cache_dir, self.max_bytes, keep=(key,))
+
+
+def load_cached_split(cache_dir, data_path, *, X_dset="box", Y_dset="confmaps", permute=(0,3,2,1), val_size=0.15,
+                      shuffle=True, seed=None, output_stride=1, block_size=256, max_size_gb=50.0):
+    """
+    Loads preprocessed training and validation sets from an on-disk cache, creating the cache entry if needed.
+
+    Entries are keyed by the data file (path, size and modification time), dataset names, permutation, split settings
+    and output stride. Arrays are stored as .npy files and opened as read-only memory maps, so concurrent runs on the
+    same data share pages through the OS page cache. Entries are written to a temporary folder and renamed when done.
+
+    :param cache_dir: path to the cache folder
+    :param data_path: path to an HDF5 file with box and confmaps datasets
+    :param X_dset: name of the box dataset
+    :param Y_dset: name of the confidence maps dataset
+    :param permute: dimension order applied by preprocess
+    :param val_size: fraction or number of samples to use as validation (see split_indices)
+    :param shuffle: if True, shuffle prior to splitting
+    :param seed: random seed for the split
+    :param output_stride: downsampling factor of the confidence maps (see downsample_confmaps)
+    :param block_size: number of frames to preprocess at a time when creating the entry
+    :param max_size_gb: maximum size of the cache folder, after which least recently used entries are deleted
+    :return: X, Y, val_X, val_Y, train_idx, val_idx
+    """
+    key = _hash_str(file_fingerprint(data_path), X_dset, Y_dset, list(permute), val_size, shuffle, seed, output_stride)
+    entry = os.path.join(cache_dir, key)
+    names = ["X", "Y", "val_X", "val_Y", "train_idx", "val_idx"]
+
+    if os.path.isdir(entry):
+        os.utime(entry) # mark as recently used
+    else:
+        t0 = time()
+        tmp_entry = entry + ".%d.tmp" % os.getpid()
+        os.makedirs(tmp_entry, exist_ok=True)
+        with h5py.File(data_path, "r") as f:
+            check_chunk_layout(f[X_dset])
+            check_chunk_layout(f[Y_dset])
+            train_idx, val_idx = split_indices(len(f[X_dset]), val_size=val_size, shuffle=shuffle, seed=seed)
+            np.save(os.path.join(tmp_entry, "train_idx.npy"), train_idx)
+            np.save(os.path.join(tmp_entry, "val_idx.npy"), val_idx)
+
+            def load_block(idx):
+                # HDF5 fancy indexing requires increasing indices
+                order = np.argsort(idx)
+                X = preprocess(f[X_dset][idx[order]], permute)
+                Y = downsample_confmaps(preprocess(f[Y_dset][idx[order]], permute), output_stride)
+                return X[np.argsort(order)], Y[np.argsort(order)]
+
+            X0, Y0 = load_block(np.arange(1))
+            for prefix, idx in [("", train_idx), ("val_", val_idx)]:
+                X_out = np.lib.format.open_memmap(os.path.join(tmp_entry, prefix + "X.npy"), mode="w+",
+                                                  dtype=X0.dtype, shape=(len(idx),) + X0.shape[1:])
+                Y_out = np.lib.format.open_memmap(os.path.join(tmp_entry, prefix + "Y.npy"), mode="w+",
+                                                  dtype=Y0.dtype, shape=(len(idx),) + Y0.shape[1:])
+                for start in range(0, len(idx), block_size):
+                    X_out[start:start + block_size], Y_out[start:start + block_size] = load_block(idx[start:start + block_size])
+                X_out.flush()
+                Y_out.flush()
+                del X_out, Y_out
+
+        try:
+            os.rename(tmp_entry, entry)
+        except OSError:
+            # Another process created the same entry first
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+        print("Cached preprocessed dataset: %s [%.1fs]" % (entry, time() - t0))
+
+        evict(cache_dir, int(max_size_gb * 1024 ** 3), keep=(key,))
+
+    arrays = [np.load(os.path.join(entry, name + ".npy"), mmap_mode="r") for name in names]
+    print("Loaded %d + %d samples from cache: %s" % (len(arrays[0]), len(arrays[2]), entry))
+
+    return tuple(arrays)
@@ -0,0 +1,216 @@
+import numpy as np
+import h5py
+import os
+import json
+import shutil
+from time import time
+from concurrent.futures import ThreadPoolExecutor
+import keras
+import keras.backend as K
+
+
+INDEX_NAME = "checkpoints.json"
+
+
+def _json_default(obj):
+    """ Serializes numpy values, Keras objects and functions like keras.engine.topology.get_json_type. """
+    if hasattr(obj, "get_config"):
+        return {"class_name": obj.__class__.__name__, "config": obj.get_config()}
+    if type(obj).__module__ == np.__name__:
+        return obj.item() if np.isscalar(obj) or obj.ndim == 0 else obj.tolist()
+    if callable(obj):
+        return obj.__name__
+    raise TypeError("Not JSON serializable: %s" % (obj,))
+
+
+def _bytes(s):
+    """ Encodes a string as a fixed-length byte string attribute like Keras does with h5py 2. """
+    return np.bytes_(s.encode("utf8"))
+
+
+def _encode(names):
+    """ Encodes names as a fixed-length byte string array like Keras does with h5py 2. """
+    return np.array([name.encode("utf8") for name in names], dtype="S")
+
+
+def snapshot_model(model, include_optimizer=True):
+    """
+    Copies everything needed to save a compiled model into host memory so it can be written outside of the main thread.
+
+    :return: dict with the model and training configurations, layer/weight names and weight values
+    """
+    snapshot = dict(
+        model_config=json.dumps({"class_name": model.__class__.__name__, "config": model.get_config()}, default=_json_default),
+        layers=[(layer.name, [w.name for w in layer.weights]) for layer in model.layers],
+        weights=model.get_weights(),
+        optimizer_names=[], optimizer_weights=[], training_config=None)
+
+    if include_optimizer and getattr(model, "optimizer", None) is not None:
+        snapshot["training_config"] = json.dumps({
+            "optimizer_config": {"class_name": model.optimizer.__class__.__name__, "config": model.optimizer.get_config()},
+            "loss": model.loss, "metrics": model.metrics, "sample_weight_mode": model.sample_weight_mode,
+            "loss_weights": model.loss_weights}, default=_json_default)
+        snapshot["optimizer_names"] = [w.name for w in model.optimizer.weights]
+        snapshot["optimizer_weights"] = K.batch_get_value(model.optimizer.weights)
+
+    return snapshot
+
+
+def write_snapshot(snapshot, path):
+    """ Writes a model snapshot to an HDF5 file in the format of keras.models.save_model (loadable with load_model). """
+    tmp_path = path + ".tmp"
+    with h5py.File(tmp_path, "w") as f:
+        f.attrs["keras_version"] = _bytes(str(keras.__version__))
+        f.attrs["backend"] = _bytes(K.backend())
+        f.attrs["model_config"] = _bytes(snapshot["model_config"])
+
+        model_weights = f.create_group("model_weights")
+        model_weights.attrs["layer_names"] = _encode([name for name, _ in snapshot["layers"]])
+        model_weights.attrs["backend"] = _bytes(K.backend())
+        model_weights.attrs["keras_version"] = _bytes(str(keras.__version__))
+        values = iter(snapshot["weights"])
+        for layer_name, weight_names in snapshot["layers"]:
+            g = model_weights.create_group(layer_name)
+            g.attrs["weight_names"] = _encode(weight_names)
+            for weight_name in weight_names:
+                g.create_dataset(weight_name, data=next(values))
+
+        if snapshot["training_config"] is not None:
+            f.attrs["training_config"] = _bytes(snapshot["training_config"])
+            if len(snapshot["optimizer_names"]) > 0:
+                optimizer_weights = f.create_group("optimizer_weights")
+                optimizer_weights.attrs["weight_names"] = _encode(snapshot["optimizer_names"])
+                for name, val in zip(snapshot["optimizer_names"], snapshot["optimizer_weights"]):
+                    optimizer_weights.create_dataset(name, data=val)
+
+    os.replace(tmp_path, path)
+
+
+def load_index(run_path):
+    """ Returns the checkpoint index of a run folder or None if it does not have one. """
+    index_path = os.path.join(run_path, "weights", INDEX_NAME)
+    if not os.path.exists(index_path):
+        return None
+    with open(index_path, "r") as f:
+        return json.load(f)
+
+
+class AsyncCheckpointer(keras.callbacks.Callback):
+    """
+    Saves models at the end of epochs in a background thread.
+
+    The weights and optimizer state are copied to host memory in the training thread and written while the next epoch
+    trains. best_model.h5 is updated whenever the monitored value improves. If save_every_epoch, checkpoints are also
+    saved to weights/weights.{epoch:03d}-{val_loss:.9f}.h5, keeping only the keep_best ones with the lowest monitored
+    value and the latest one. Saved checkpoints, the best and latest models and the training state saved with the
+    latest model are listed in weights/checkpoints.json (see load_index).
+    """
+
+    def __init__(self, run_path, monitor="val_loss", save_every_epoch=False, keep_best=3, save_latest=False, state_fn=None,
+                 include_optimizer=True, verbose=1):
+        """
+        :param run_path: path to the run folder
+        :param monitor: quantity to select the best checkpoints by (lower is better)
+        :param save_every_epoch: if True, saves checkpoints in the weights subfolder at every epoch
+        :param keep_best: number of checkpoints with the lowest monitored value to keep (0 = keep all)
+        :param save_latest: if True, saves latest_model.h5 at every epoch (if not saving every epoch) to resume from
+        :param state_fn: function returning a JSON serializable dict of training state (e.g., of other callbacks) to
+        store in the index with the latest model
+        :param include_optimizer: if True, saves the optimizer state for resuming training
+        :param verbose: if 1, prints when models are saved
+        """
+        super().__init__()
+        self.run_path = run_path
+        self.monitor = monitor
+        self.save_every_epoch = save_every_epoch
+        self.keep_best = keep_best
+        self.save_latest = save_latest
+        self.state_fn = state_fn
+        self.include_optimizer = include_optimizer
+        self.verbose = verbose
+
+        self.index_path = os.path.join(run_path, "weights", INDEX_NAME)
+        self.index = load_index(run_path) or dict(monitor=monitor, checkpoints=[], best=None, latest=None)
+        self.best = np.inf if self.index.get("best_value") is None else self.index["best_value"]
+        self.executor = None
+        self.pending = None
+
+    def on_train_begin(self, logs={}):
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def on_epoch_end(self, epoch, logs={}):
+        value = logs.get(self.monitor)
+        if value is None:
+            print("Warning: AsyncCheckpointer requires %s to be available." % self.monitor)
+            return
+        is_best = value < self.best
+        if is_best:
+            self.best = value
+        if not is_best and not self.save_every_epoch and not self.save_latest:
+            return
+
+        # Only one write in flight so that at most two snapshots are in memory
+        self.wait()
+        snapshot = snapshot_model(self.model, include_optimizer=self.include_optimizer)
+        state = self.state_fn() if self.state_fn is not None else {}
+        self.pending = self.executor.submit(self._write, snapshot, epoch + 1, float(value), is_best, state)
+
+    def _write(self, snapshot, epoch, value, is_best, state):
+        t0 = time()
+
+        # Paths in the index are relative to the run folder
+        latest = None
+        if self.save_every_epoch:
+            latest = os.path.join("weights", "weights.%03d-%.9f.h5" % (epoch, value))
+        elif self.save_latest:
+            latest = "latest_model.h5"
+
+        best_path = os.path.join(self.run_path, "best_model.h5")
+        if latest is not None:
+            write_snapshot(snapshot, os.path.join(self.run_path, latest))
+            if is_best:
+                shutil.copyfile(os.path.join(self.run_path, latest), best_path + ".tmp")
+                os.replace(best_path + ".tmp", best_path)
+        else:
+            write_snapshot(snapshot, best_path)
+
+        if self.save_every_epoch:
+            self.index["checkpoints"].append({"epoch": epoch, self.monitor: value, "path": os.path.basename(latest)})
+            self._apply_retention()
+        if latest is not None:
+            self.index.update(latest=latest, latest_epoch=epoch, state=state)
+        if is_best:
+            self.index.update(best="best_model.h5", best_value=value, best_epoch=epoch)
+        self._write_index()
+
+        if self.verbose > 0:
+            print("\nEpoch %05d: saved %s%s [%.1fs]" % (epoch, latest or "best_model.h5",
+                                                       " (best %s: %.9f)" % (self.monitor, value) if is_best else "", time() - t0))
+
+    def _apply_retention(self):
+        """ Deletes checkpoints that are neither among the keep_best ones nor the latest. """
+        if self.keep_best <= 0:
+            return
+        checkpoints = self.index["checkpoints"]
+        keep = sorted(checkpoints, key=lambda x: x[self.monitor])[:self.keep_best] + [checkpoints[-1]]
+        for x in checkpoints:
+            if x not in keep:
+                path = os.path.join(self.run_path, "weights", x["path"])
+                if os.path.exists(path):
+                    os.remove(path)
+        self.index["checkpoints"] = [x for x in checkpoints if x in keep]
+
+    def _write_index(self):
+        with open(self.index_path + ".tmp", "w") as f:
+            json.dump(self.index, f, indent=2)
+        os.replace(self.index_path + ".tmp", self.index_path)
+
+    def wait(self):
+        """ Blocks until the pending write is done (raising its errors). """
+        if self.pending is not None:
+            self.pending.result()
+            self.pending = None
+
+    def on_train_end(self, logs={}):
+        self.wait()
+        self.executor.shutdown()
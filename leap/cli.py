@@ -0,0 +1,128 @@
+import os
+import sys
+import importlib
+from time import time
+
+# Commands map to "module:function" and are only imported when run, so short commands do not load Keras/TensorFlow.
+COMMANDS = {
+    "train": ("leap.training:train", "Train a network on a training set"),
+    "resume": ("leap.training:resume", "Continue training a run from its latest checkpoint"),
+    "finetune": ("leap.training:finetune", "Fine-tune a trained model on newly labeled frames"),
+    "sweep": ("leap.sweep:sweep", "Train a grid of parameters in concurrent trials"),
+    "train-distributed": ("leap.distributed:train_distributed", "Train with data-parallel workers"),
+    "predict": ("leap.predict_box:predict_box", "Predict on a box dataset"),
+    "predict-video": ("leap.predict_video:predict_video", "Predict on a video"),
+    "render": ("leap.render_predictions:render_predictions", "Render a video of predictions overlaid on a box"),
+    "ingest": ("leap.prediction_store:ingest_predictions", "Add prediction files to a consolidated store"),
+    "query": ("leap.prediction_store:query_predictions", "Find frames in a prediction store by joint confidence"),
+    "gait": ("leap.gait_analysis:gait_analysis", "Compute gait statistics over many prediction files"),
+    "evaluate": ("leap.evaluation:evaluate_predictions", "Evaluate predictions against labels"),
+    "evaluate-run": ("leap.evaluation:evaluate_run", "Evaluate a run on its validation set"),
+    "cluster-sample": ("leap.cluster_sample:cluster_sample", "Sample diverse frames to label by clustering boxes"),
+    "generate-training-set": ("leap.generate_training_set:generate_training_set", "Generate a training set from labels"),
+    "rechunk": ("leap.rechunk:rechunk", "Rewrite an HDF5 file with frame-aligned chunks"),
+    "benchmark-layouts": ("leap.rechunk:benchmark_layouts", "Compare read throughput of chunk layouts"),
+    "synthetic": ("leap.synthetic:synthetic_data", "Generate a synthetic box or training file for benchmarks"),
+    "benchmark": ("leap.benchmark:benchmark_models", "Benchmark model architectures"),
+    "weights": ("leap.cli:weights", "List the saved weights of a run"),
+    "info": ("leap.cli:info", "Print the datasets and attributes of an HDF5 file"),
+}
+
+
+def weights(run_path):
+    """
+    Lists the saved weights of a run folder with their epoch and validation loss.
+
+    :param run_path: path to a run folder with a weights subfolder
+    """
+    from leap.utils import find_weights
+
+    if not os.path.isdir(os.path.join(run_path, "weights")):
+        print("Error: No weights folder found in run path.")
+        return
+
+    weights_paths, epochs, val_losses = find_weights(run_path)
+    best = min(range(len(val_losses)), key=lambda i: val_losses[i]) if len(val_losses) > 0 else -1
+    print("%6s %14s  %s" % ("Epoch", "val_loss", "Path"))
+    for i, (path, epoch, val_loss) in enumerate(zip(weights_paths, epochs, val_losses)):
+        print("%6d %14.9f  %s%s" % (epoch, val_loss, path, " (best)" if i == best else ""))
+    for name in ["best_model.h5", "latest_model.h5", "final_model.h5"]:
+        if os.path.exists(os.path.join(run_path, name)):
+            print("%21s  %s" % ("", os.path.join(run_path, name)))
+
+
+def info(path, *, attrs=True):
+    """
+    Prints the datasets (shape, dtype, chunks and compression) and attributes of an HDF5 file (including MAT v7.3).
+
+    :param path: path to the HDF5 file
+    :param attrs: if True, also prints attributes
+    """
+    import h5py
+
+    def print_attrs(obj, indent):
+        if not attrs:
+            return
+        for k, v in obj.attrs.items():
+            v = str(v)
+            print("%s@%s = %s" % (indent, k, v if len(v) <= 80 else v[:77] + "..."))
+
+    def visit(name, obj):
+        indent = "    " * name.count("/")
+        if isinstance(obj, h5py.Dataset):
+            print("%s%s: %s %s (chunks: %s, compression: %s)" % (indent, os.path.basename(name), obj.shape, obj.dtype,
+                                                                obj.chunks, obj.compression))
+        else:
+            print("%s%s/" % (indent, os.path.basename(name)))
+        print_attrs(obj, indent + "    ")
+
+    with h5py.File(path, "r") as f:
+        print("%s (%.1f MiB)" % (path, os.path.getsize(path) / 1024 ** 2))
+        print_attrs(f, "    ")
+        f.visititems(visit)
+
+
+def usage():
+    print("Usage: leap [--time] COMMAND [ARGS...]\n")
+    print("Commands:")
+    for name, (_, description) in COMMANDS.items():
+        print("    %-24s %s" % (name, description))
+    print("\nRun \"leap COMMAND --help\" for the parameters of a command.")
+
+
+def main(argv=None):
+    """
+    Entry point of the leap command.
+
+    With --time, prints the time taken to import the command and to run it to stderr.
+    """
+    t0 = time()
+    argv = sys.argv[1:] if argv is None else list(argv)
+    show_time = len(argv) > 0 and argv[0] == "--time"
+    if show_time:
+        argv = argv[1:]
+
+    if len(argv) == 0 or argv[0] in ("-h", "--help"):
+        usage()
+        return
+    if argv[0] not in COMMANDS:
+        print("Error: Unknown command: %s\n" % argv[0])
+        usage()
+        sys.exit(2)
+
+    module_name, fn_name = COMMANDS[argv[0]][0].split(":")
+    import clize
+    fn = getattr(importlib.import_module(module_name), fn_name)
+    t1 = time()
+    if show_time:
+        print("Startup: %.3fs (import %s)" % (t1 - t0, module_name), file=sys.stderr)
+
+    try:
+        clize.run(fn, args=["leap " + argv[0]] + argv[1:], exit=False)
+    finally:
+        if show_time:
+            print("Run: %.3fs" % (time() - t1), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,254 @@
+import numpy as np
+import h5py
+import os
+from time import time
+import clize
+
+
+def iter_chunks(box_paths, box_dset="/box", chunk_frames=1000):
+    """ Yields (expt_idx, start, frames) for consecutive chunks of frames (frames, channels, width, height) of each box. """
+    for expt_idx, box_path in enumerate(box_paths):
+        with h5py.File(box_path, "r") as f:
+            box = f[box_dset]
+            for start in range(0, box.shape[0], chunk_frames):
+                yield expt_idx, start, box[start:start + chunk_frames]
+
+
+def to_features(X, downsample=1):
+    """ Flattens frames (frames, channels, width, height) to float32 vectors after block averaging by downsample. """
+    if X.dtype == "uint8":
+        X = X.astype("float32") / 255
+    else:
+        X = X.astype("float32")
+    if downsample > 1:
+        n, c, w, h = X.shape
+        w, h = w // downsample, h // downsample
+        X = X[:, :, :w * downsample, :h * downsample].reshape(n, c, w, downsample, h, downsample).mean(axis=(3, 5))
+    return X.reshape(len(X), -1)
+
+
+class IncrementalPCA:
+    """
+    PCA fit over batches with a running mean and a truncated SVD of the previous components stacked with each new batch
+    (Ross et al., 2008). Memory depends only on the batch size, number of features and number of components.
+    """
+
+    def __init__(self, n_components):
+        self.n_components = n_components
+        self.n_samples_seen = 0
+        self.mean = None
+        self.var = None
+        self.components = None
+        self.singular_values = None
+
+    def partial_fit(self, X):
+        X = X.astype("float64")
+        n = len(X)
+        batch_mean = X.mean(axis=0)
+        if self.n_samples_seen == 0:
+            total_mean = batch_mean
+            total_var = X.var(axis=0)
+            X = X - batch_mean
+        else:
+            n_total = self.n_samples_seen + n
+            total_mean = (self.n_samples_seen * self.mean + n * batch_mean) / n_total
+            total_var = (self.n_samples_seen * (self.var + (self.mean - total_mean) ** 2) +
+                         n * (X.var(axis=0) + (batch_mean - total_mean) ** 2)) / n_total
+            correction = np.sqrt(self.n_samples_seen * n / n_total) * (self.mean - batch_mean)
+            X = np.vstack([self.singular_values[:, None] * self.components, X - batch_mean, correction])
+
+        _, S, Vt = np.linalg.svd(X, full_matrices=False)
+        self.n_samples_seen += n
+        self.mean, self.var = total_mean, total_var
+        self.components = Vt[:self.n_components]
+        self.singular_values = S[:self.n_components]
+        return self
+
+    @property
+    def explained_variance_ratio(self):
+        return self.singular_values ** 2 / max(self.var.sum() * self.n_samples_seen, 1e-12)
+
+    def transform(self, X):
+        return ((X - self.mean) @ self.components.T).astype("float32")
+
+    def inverse_transform(self, Z):
+        return (Z @ self.components + self.mean).astype("float32")
+
+
+def kmeans_plusplus(X, k, rng):
+    """ Picks k initial centers from the rows of X with k-means++ seeding. """
+    centers = [X[rng.randint(len(X))]]
+    d2 = ((X - centers[0]) ** 2).sum(axis=1)
+    for _ in range(1, k):
+        p = d2 / d2.sum() if d2.sum() > 0 else None
+        centers.append(X[rng.choice(len(X), p=p)])
+        d2 = np.minimum(d2, ((X - centers[-1]) ** 2).sum(axis=1))
+    return np.stack(centers).astype("float32")
+
+
+def assign_clusters(X, centers):
+    """ Returns the index of the nearest center to each row of X. """
+    d2 = (X ** 2).sum(axis=1)[:, None] - 2 * X @ centers.T + (centers ** 2).sum(axis=1)[None, :]
+    return np.argmin(d2, axis=1)
+
+
+class MiniBatchKMeans:
+    """ K-means updated one batch at a time with a per-center learning rate of 1 / (samples assigned so far). """
+
+    def __init__(self, k, seed=None):
+        self.k = k
+        self.rng = np.random.RandomState(seed)
+        self.centers = None
+        self.counts = np.zeros(k, dtype="int64")
+
+    def partial_fit(self, X):
+        if self.centers is None:
+            self.centers = kmeans_plusplus(X, self.k, self.rng)
+        labels = assign_clusters(X, self.centers)
+        for j in np.unique(labels):
+            members = X[labels == j]
+            self.counts[j] += len(members)
+            self.centers[j] += (members.sum(axis=0) - len(members) * self.centers[j]) / self.counts[j]
+        return self
+
+
+def cluster_sample(out_path, *box_paths, box_dset="/box", num_clusters=10, samples_per_cluster=50, pcs=50,
+                   downsample=2, chunk_frames=1000, kmeans_epochs=1, seed: int = None, shuffle=False, overwrite=False):
+    """
+    Samples frames to label from clusters of their appearance, streaming box files in chunks so that memory does not
+    grow with the number of frames.
+
+    This is the scalable version of the cluster_sample GUI: PCA and k-means are fit incrementally over chunks of
+    (optionally downsampled) frames, and frames are sampled uniformly within each cluster by reservoir sampling. The
+    output is written in the same format as the GUI so it can be opened directly in label_joints.
+
+    :param out_path: path to the HDF5 file to save the sampled dataset to
+    :param box_paths: paths to HDF5 files with box datasets
+    :param box_dset: name of HDF5 dataset containing box images
+    :param num_clusters: number of clusters (k)
+    :param samples_per_cluster: number of frames to sample from each cluster
+    :param pcs: number of principal components to project frames onto before clustering (0 = cluster pixels)
+    :param downsample: integer factor to average down frames by before PCA and clustering
+    :param chunk_frames: number of frames to read at a time (must be at least pcs)
+    :param kmeans_epochs: number of passes over the data to fit k-means
+    :param seed: seed for k-means initialization and sampling
+    :param shuffle: if True, sampled frames are shuffled, otherwise they cycle through the clusters
+    :param overwrite: if True and out_path exists, file will be overwritten
+    """
+    t0 = time()
+    if len(box_paths) == 0:
+        print("Error: No box paths specified.")
+        return
+    if os.path.exists(out_path):
+        if overwrite:
+            os.remove(out_path)
+            print("Deleted existing output.")
+        else:
+            print("Error: Output path already exists.")
+            return
+    if pcs > 0 and chunk_frames < pcs:
+        print("Error: chunk_frames must be at least the number of PCs.")
+        return
+
+    box_paths = [os.path.abspath(p) for p in box_paths]
+    with h5py.File(box_paths[0], "r") as f:
+        box_shape, box_dtype = f[box_dset].shape[1:], f[box_dset].dtype
+    feature_shape = (box_shape[0], box_shape[1] // downsample, box_shape[2] // downsample)
+
+    def features(X):
+        return to_features(X, downsample=downsample)
+
+    # Pass 1: PCA
+    pca = None
+    if pcs > 0:
+        pca = IncrementalPCA(pcs)
+        for _, _, X in iter_chunks(box_paths, box_dset, chunk_frames):
+            if len(X) >= pcs or pca.n_samples_seen > 0:
+                pca.partial_fit(features(X))
+        if pca.n_samples_seen == 0:
+            print("Error: Not enough frames to fit %d PCs." % pcs)
+            return
+        print("Fit PCA on %d frames: %.1f%% of variance explained by %d PCs [%.1fs]" % (
+            pca.n_samples_seen, 100 * pca.explained_variance_ratio.sum(), pcs, time() - t0))
+
+        def features(X):
+            return pca.transform(to_features(X, downsample=downsample))
+
+    # Pass 2: k-means
+    kmeans = MiniBatchKMeans(num_clusters, seed=seed)
+    for epoch in range(kmeans_epochs):
+        for _, _, X in iter_chunks(box_paths, box_dset, chunk_frames):
+            kmeans.partial_fit(features(X))
+    print("Fit k-means with %d clusters [%.1fs]" % (num_clusters, time() - t0))
+
+    # Pass 3: assign clusters and keep a uniform sample of each (reservoir sampling)
+    rng = np.random.RandomState(seed)
+    counts = np.zeros(num_clusters, dtype="int64")
+    reservoirs = [[] for _ in range(num_clusters)]
+    for expt_idx, start, X in iter_chunks(box_paths, box_dset, chunk_frames):
+        labels = assign_clusters(features(X), kmeans.centers)
+        for i, j in enumerate(labels):
+            counts[j] += 1
+            if len(reservoirs[j]) < samples_per_cluster:
+                reservoirs[j].append((expt_idx, start + i))
+            else:
+                r = rng.randint(counts[j])
+                if r < samples_per_cluster:
+                    reservoirs[j][r] = (expt_idx, start + i)
+    print("Cluster sizes:", counts.tolist())
+    if counts.min() < samples_per_cluster:
+        print("Warning: Smallest cluster has %d frames, fewer than samples_per_cluster." % counts.min())
+
+    # Cycle through clusters: sample 1 of each cluster, then sample 2, ...
+    for j in range(num_clusters):
+        reservoirs[j].sort()
+    order = [(j, r) for r in range(samples_per_cluster) for j in range(num_clusters) if r < len(reservoirs[j])]
+    if shuffle:
+        order = [order[i] for i in rng.permutation(len(order))]
+    G = np.array([j for j, _ in order], dtype="int32")
+    exptID = np.array([reservoirs[j][r][0] for j, r in order], dtype="int32")
+    dataIdx = np.array([reservoirs[j][r][1] for j, r in order], dtype="int64")
+
+    # Pass 4: save sampled frames
+    with h5py.File(out_path, "w") as f:
+        ds_box = f.create_dataset("box", shape=(len(order),) + tuple(box_shape), dtype=box_dtype,
+                                  chunks=(1,) + tuple(box_shape), compression="gzip", compression_opts=1)
+        scores = np.zeros((len(order), pcs), dtype="float32")
+        for expt_idx, box_path in enumerate(box_paths):
+            out_idx = np.flatnonzero(exptID == expt_idx)
+            out_idx = out_idx[np.argsort(dataIdx[out_idx])]
+            if len(out_idx) == 0:
+                continue
+            with h5py.File(box_path, "r") as f_box:
+                X = f_box[box_dset][dataIdx[out_idx]]
+            for i, x in zip(out_idx, X):
+                ds_box[i] = x
+            if pca is not None:
+                scores[out_idx] = pca.transform(to_features(X, downsample=downsample))
+
+        # Indices are saved 1-based for MATLAB
+        f.create_dataset("exptID", data=exptID + 1)
+        f.create_dataset("dataIdx", data=dataIdx + 1)
+        f.attrs["boxPaths"] = "\n".join(box_paths)
+
+        if pca is not None:
+            f.create_dataset("pca/score", data=scores)
+            f.create_dataset("pca/coeff", data=pca.components.astype("float32"))
+            f.create_dataset("pca/coeff_box", data=pca.components.reshape((pcs,) + feature_shape).astype("float32"))
+            f.create_dataset("pca/mu", data=pca.mean.astype("float32"))
+            f.create_dataset("pca/explained", data=100 * pca.explained_variance_ratio.astype("float32"))
+            centroids = pca.inverse_transform(kmeans.centers)
+        else:
+            centroids = kmeans.centers
+        f.create_dataset("clusters/k", data=num_clusters)
+        f.create_dataset("clusters/G", data=G + 1)
+        f.create_dataset("clusters/cluster_centroids", data=centroids.reshape((num_clusters,) + feature_shape))
+        f.create_dataset("clusters/counts", data=counts)
+        f.attrs["downsample"] = downsample
+
+    print("Saved %d frames: %s" % (len(order), out_path))
+    print("Total runtime: %.1f secs" % (time() - t0))
+
+
+if __name__ == "__main__":
+    clize.run(cluster_sample)
@@ -0,0 +1,249 @@
+import numpy as np
+import os
+import multiprocessing
+from multiprocessing.connection import Listener, Client
+from time import time, sleep
+import clize
+import keras
+import keras.backend as K
+
+from leap.utils import configure_threads
+
+
+class Communicator:
+    """
+    Connects worker processes in a star around rank 0 over TCP (multiprocessing.connection) for collective operations.
+
+    Rank 0 listens on the rendezvous address and every other rank connects to it, so workers can run on one host or
+    across hosts that can reach the address of rank 0.
+    """
+
+    def __init__(self, rank, world_size, address=("127.0.0.1", 29500), authkey=b"leap", timeout=120):
+        self.rank = rank
+        self.world_size = world_size
+        self.conns = []
+        self.stats = dict(steps=0, samples=0, compute_secs=0.0, comm_secs=0.0, apply_secs=0.0) # see make_distributed
+
+        if world_size == 1:
+            return
+        if rank == 0:
+            listener = Listener(address, authkey=authkey)
+            conns = {}
+            for _ in range(world_size - 1):
+                conn = listener.accept()
+                conns[conn.recv()] = conn
+            listener.close()
+            self.conns = [conns[r] for r in sorted(conns.keys())]
+        else:
+            t0 = time()
+            while True:
+                try:
+                    conn = Client(address, authkey=authkey)
+                    break
+                except ConnectionRefusedError:
+                    if time() - t0 > timeout:
+                        raise
+                    sleep(0.5)
+            conn.send(rank)
+            self.conns = [conn]
+
+    def allreduce(self, x, weight=1.0):
+        """ Returns the mean of an array across all workers, weighted by the weight given by each worker. """
+        if self.world_size == 1:
+            return x
+        msg = np.append(np.ravel(x).astype("float64") * weight, weight)
+        if self.rank == 0:
+            total = msg
+            for conn in self.conns:
+                total += np.frombuffer(conn.recv_bytes(), dtype="float64")
+            mean = (total[:-1] / total[-1]).astype(x.dtype).reshape(x.shape)
+            for conn in self.conns:
+                conn.send_bytes(mean.tobytes())
+            return mean
+        else:
+            self.conns[0].send_bytes(msg.tobytes())
+            return np.frombuffer(self.conns[0].recv_bytes(), dtype=x.dtype).reshape(x.shape).copy()
+
+    def broadcast(self, obj):
+        """ Returns the object of rank 0 on all workers. """
+        if self.world_size == 1:
+            return obj
+        if self.rank == 0:
+            for conn in self.conns:
+                conn.send(obj)
+            return obj
+        return self.conns[0].recv()
+
+    def close(self):
+        for conn in self.conns:
+            conn.close()
+
+
+def make_distributed(model, comm):
+    """
+    Replaces the training function of a compiled Keras model with one that averages gradients across workers.
+
+    Gradients are computed on the local shard of each batch, averaged with an all-reduce weighted by the size of each
+    shard and applied by the model's optimizer, fed through placeholders in place of the gradients of the loss (see Optimizer.get_gradients). Initial
+    weights and optimizer state are broadcast from rank 0 so that all workers stay in sync.
+
+    :param model: compiled Keras model
+    :param comm: Communicator
+    :return: dict with timing statistics that is updated at each step (comm.stats)
+    """
+    params = model._collected_trainable_weights
+    inputs = model._feed_inputs + model._feed_targets + model._feed_sample_weights
+    if model.uses_learning_phase and not isinstance(K.learning_phase(), int):
+        inputs += [K.learning_phase()]
+    outputs = [model.total_loss] + model.metrics_tensors
+    grad_fn = K.function(inputs, outputs + model.optimizer.get_gradients(model.total_loss, params), updates=model.updates)
+
+    # Optimizer updates with the averaged gradients fed in through placeholders
+    placeholders = [K.placeholder(shape=K.int_shape(p), dtype=K.dtype(p)) for p in params]
+    get_gradients = model.optimizer.get_gradients
+    model.optimizer.get_gradients = lambda loss, params: placeholders
+    with K.name_scope("training"):
+        apply_fn = K.function(placeholders, [], updates=model.optimizer.get_updates(loss=model.total_loss, params=params))
+    model.optimizer.get_gradients = get_gradients
+
+    # Start from the same weights and optimizer state everywhere
+    model.set_weights(comm.broadcast(model.get_weights()))
+    K.batch_set_value(list(zip(model.optimizer.weights, comm.broadcast(K.batch_get_value(model.optimizer.weights)))))
+
+    shapes = [K.int_shape(p) for p in params]
+    sizes = [int(np.prod(s)) for s in shapes]
+    state_weights = model.non_trainable_weights # e.g., batch norm statistics
+    stats = comm.stats
+
+    def train_function(ins):
+        t0 = time()
+        outs = grad_fn(ins)
+        state = K.batch_get_value(state_weights)
+        t1 = time()
+
+        # Average losses, gradients and state in a single message, weighted by the shard size since shards of batches
+        # that do not divide evenly between workers differ in size
+        flat = np.concatenate([np.ravel(x) for x in outs + state]).astype("float32")
+        flat = comm.allreduce(flat, weight=len(ins[0]))
+        t2 = time()
+
+        num_outs = len(outputs)
+        grads = np.split(flat[num_outs:num_outs + sum(sizes)], np.cumsum(sizes)[:-1])
+        apply_fn([g.reshape(s) for g, s in zip(grads, shapes)])
+        if len(state_weights) > 0:
+            state_flat = np.split(flat[num_outs + sum(sizes):], np.cumsum([x.size for x in state])[:-1])
+            K.batch_set_value([(w, v.reshape(x.shape)) for w, v, x in zip(state_weights, state_flat, state)])
+        t3 = time()
+
+        stats["steps"] += 1
+        stats["samples"] += len(ins[0])
+        stats["compute_secs"] += t1 - t0
+        stats["comm_secs"] += t2 - t1
+        stats["apply_secs"] += t3 - t2
+        return list(flat[:num_outs])
+
+    model.train_function = train_function
+    return stats
+
+
+class SyncStopTraining(keras.callbacks.Callback):
+    """ Stops training on all workers if any of them stops (e.g., early stopping or time budget). """
+
+    def __init__(self, comm):
+        super().__init__()
+        self.comm = comm
+
+    def on_epoch_end(self, epoch, logs={}):
+        stop = self.comm.allreduce(np.array([float(self.model.stop_training)]))
+        self.model.stop_training = bool(stop[0] > 0)
+
+
+def print_scaling(stats, world_size, baseline_throughput=0):
+    """
+    Prints throughput, communication overhead and scaling efficiency from the timing statistics of make_distributed.
+
+    :param stats: timing statistics returned by make_distributed
+    :param world_size: number of workers
+    :param baseline_throughput: samples/s of the same training with a single worker. The scaling efficiency is only
+        reported if this is given.
+    """
+    step_secs = stats["compute_secs"] + stats["comm_secs"] + stats["apply_secs"]
+    if stats["steps"] == 0 or step_secs == 0:
+        return
+    throughput = stats["samples"] * world_size / step_secs
+
+    print("Workers: %d" % world_size)
+    print("Throughput: %.1f samples/s (%.1f per worker)" % (throughput, throughput / world_size))
+    print("Step time: %.1f ms compute, %.1f ms all-reduce, %.1f ms apply" % tuple(1000 * stats[k] / stats["steps"] for k in ["compute_secs", "comm_secs", "apply_secs"]))
+    print("Communication overhead: %.1f%% of step time" % (100 * stats["comm_secs"] / step_secs))
+    if baseline_throughput > 0:
+        print("Scaling efficiency: %.1f%% (vs. %.1f samples/s with 1 worker)" % (
+            100 * throughput / (world_size * baseline_throughput), baseline_throughput))
+
+
+def _worker(rank, num_workers, address, threads, cores, data_path, train_kwargs, baseline_throughput=0):
+    """ Runs train as one of the workers. """
+    from leap.training import train
+
+    configure_threads(threads, cores=cores)
+    comm = Communicator(rank, num_workers, address=address)
+    try:
+        train(data_path, distributed=comm, **train_kwargs)
+    finally:
+        comm.close()
+    print_scaling(comm.stats, num_workers, baseline_throughput=baseline_throughput)
+
+
+def train_distributed(data_path, *train_params, workers=2, rank=-1, master_addr="127.0.0.1", master_port=29500, threads=0,
+                      baseline_throughput=0.0):
+    """
+    Trains a network with data-parallel workers that average gradients at every step.
+
+    Parameters of training.train are given as "name=value" (e.g., net_name=leap_cnn epochs=30 batch_size=64). Every
+    worker trains on its shard of each batch (batch_size is the total across workers), and all workers average their
+    gradients with an all-reduce before each update, so they keep identical weights. Only rank 0 saves the run folder.
+
+    To run on a single host, launch once (rank = -1). To run across hosts, launch once per worker with its rank,
+    the total number of workers and the address of the host running rank 0.
+
+    :param data_path: path to an HDF5 file with box and confmaps datasets
+    :param train_params: parameters of training.train as "name=value"
+    :param workers: total number of worker processes
+    :param rank: rank of this worker (-1 = spawn all workers on this host)
+    :param master_addr: address of the host running rank 0
+    :param master_port: port that rank 0 listens on for the other workers
+    :param threads: number of threads per worker (0 = split the CPU cores evenly between local workers)
+    :param baseline_throughput: samples/s of the same training with workers=1, used to report the scaling efficiency
+    """
+    from leap.sweep import parse_grid
+
+    train_kwargs = {name: values[0] for name, values in parse_grid(train_params).items()}
+    train_kwargs.setdefault("seed", 0) # all workers need the same training/validation split
+    if train_kwargs.get("batch_size", 32) < workers:
+        print("Error: batch_size must be at least the number of workers.")
+        return
+
+    num_cpus = os.cpu_count() or 1
+    local_workers = workers if rank < 0 else 1
+    if threads <= 0:
+        threads = max(1, num_cpus // local_workers)
+    address = (master_addr, master_port)
+
+    if rank >= 0:
+        _worker(rank, workers, address, threads, None, data_path, train_kwargs, baseline_throughput)
+        return
+
+    ctx = multiprocessing.get_context("spawn")
+    processes = []
+    for r in range(workers):
+        cores = list(range(r * threads, (r + 1) * threads)) if (r + 1) * threads <= num_cpus else None
+        p = ctx.Process(target=_worker, args=(r, workers, address, threads, cores, data_path, train_kwargs,
+                                                  baseline_throughput))
+        p.start()
+        processes.append(p)
+    for p in processes:
+        p.join()
+
+
+if __name__ == "__main__":
+    clize.run(train_distributed)
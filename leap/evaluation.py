@@ -0,0 +1,240 @@
+import numpy as np
+import h5py
+import os
+from time import time
+from scipy.io import loadmat, savemat
+import clize
+
+from leap.utils import load_labels, find_model_weights, preprocess
+
+
+def compute_errors(pos_pred, pos_gt):
+    """
+    Computes error metrics given predicted and ground truth positions (see compute_errors.m).
+
+    :param pos_pred: predicted positions (samples, [x, y], joints)
+    :param pos_gt: ground truth positions (samples, [x, y], joints)
+    :return: dict with delta (samples, [x, y], joints), euclidean (samples, joints) and overall and per joint MAE,
+    MSE and RMSE
+    """
+    delta = np.asarray(pos_pred, dtype="float64") - np.asarray(pos_gt, dtype="float64")
+    euclidean = np.sqrt(np.sum(delta ** 2, axis=1))
+
+    mae_all = np.mean(np.abs(delta))
+    mse_all = np.mean(delta ** 2)
+    mae = np.mean(np.abs(delta), axis=(0, 1))
+    mse = np.mean(delta ** 2, axis=(0, 1))
+
+    return dict(delta=delta, euclidean=euclidean, mae_all=mae_all, mse_all=mse_all, rmse_all=np.sqrt(mse_all),
+                mae=mae, mse=mse, rmse=np.sqrt(mse))
+
+
+def match_instances(pos_pred, pos_gt):
+    """
+    Picks the predicted instance that best matches the ground truth in each sample.
+
+    :param pos_pred: grouped predicted positions (samples, instances, [x, y], joints) with -1 for missing joints
+    :param pos_gt: ground truth positions (samples, [x, y], joints)
+    :return: positions of the instance with the lowest mean error over joints found in both (samples, [x, y], joints),
+    with NaN for missing joints
+    """
+    pos_pred = np.where(pos_pred < 0, np.nan, np.asarray(pos_pred, dtype="float64"))
+    euclidean = np.sqrt(np.sum((pos_pred - np.asarray(pos_gt, dtype="float64")[:, None]) ** 2, axis=2))
+    valid = ~np.isnan(euclidean)
+    mean_error = np.where(valid.any(axis=2), np.nansum(euclidean, axis=2) / np.maximum(valid.sum(axis=2), 1), np.inf)
+    best = np.argmin(mean_error, axis=1)
+    return pos_pred[np.arange(len(pos_pred)), best]
+
+
+class ErrorAccumulator:
+    """
+    Accumulates summary statistics of Euclidean errors per joint in constant memory.
+
+    Errors are binned into a fixed-width histogram, so percentiles are accurate to bin_width and PCK curves can be
+    computed at any threshold that is a multiple of bin_width.
+    """
+
+    def __init__(self, num_joints, bin_width=0.1, max_error=100):
+        self.bin_width = bin_width
+        self.num_bins = int(np.ceil(max_error / bin_width)) + 1 # last bin collects errors >= max_error
+        self.hist = np.zeros((num_joints, self.num_bins), dtype="int64")
+        self.sum = np.zeros(num_joints)
+        self.sum_sq = np.zeros(num_joints)
+
+    @property
+    def count(self):
+        return self.hist.sum(axis=1)
+
+    def update(self, euclidean):
+        """ Adds errors (samples, joints). NaNs (unlabeled or missing joints) are ignored. """
+        valid = ~np.isnan(euclidean)
+        bins = np.minimum(np.floor(np.where(valid, euclidean, 0) / self.bin_width), self.num_bins - 1).astype("int64")
+        joints = np.broadcast_to(np.arange(euclidean.shape[1]), euclidean.shape)
+        np.add.at(self.hist, (joints[valid], bins[valid]), 1)
+        self.sum += np.nansum(euclidean, axis=0)
+        self.sum_sq += np.nansum(euclidean ** 2, axis=0)
+
+    def merge(self, other):
+        """ Adds the statistics accumulated by another instance with the same binning. """
+        self.hist += other.hist
+        self.sum += other.sum
+        self.sum_sq += other.sum_sq
+
+    def percentiles(self, q=(50, 75, 90, 95, 99)):
+        """ Returns error percentiles (joints, percentiles) as the upper edge of the bin reaching each percentile. """
+        cdf = np.cumsum(self.hist, axis=1) / np.maximum(self.count, 1)[:, None]
+        q = np.asarray(q) / 100
+        idx = np.array([np.argmax(cdf >= p, axis=1) for p in q]).T
+        return (idx + 1) * self.bin_width
+
+    def pck(self, thresholds):
+        """ Returns the fraction of errors below each threshold (joints, thresholds), i.e., PCK curves. """
+        cdf = np.concatenate((np.zeros((len(self.hist), 1)), np.cumsum(self.hist, axis=1)), axis=1)
+        idx = np.minimum(np.round(np.asarray(thresholds) / self.bin_width).astype("int64"), self.num_bins)
+        return cdf[:, idx] / np.maximum(self.count, 1)[:, None]
+
+    def summary(self, percentiles=(50, 75, 90, 95, 99), thresholds=None):
+        """ Returns a dict of metrics per joint and across all joints. """
+        if thresholds is None:
+            thresholds = np.arange(0, 20.5, 0.5)
+
+        total = ErrorAccumulator(1, bin_width=self.bin_width)
+        total.hist = self.hist.sum(axis=0, keepdims=True)
+        total.sum = self.sum.sum(keepdims=True)
+        total.sum_sq = self.sum_sq.sum(keepdims=True)
+
+        count = np.maximum(self.count, 1)
+        return dict(count=self.count, mean=self.sum / count, rmse=np.sqrt(self.sum_sq / count),
+                    percentiles=np.asarray(percentiles), percentile_errors=self.percentiles(percentiles),
+                    pck_thresholds=np.asarray(thresholds), pck=self.pck(thresholds),
+                    count_all=total.count[0], mean_all=total.sum[0] / max(total.count[0], 1),
+                    rmse_all=np.sqrt(total.sum_sq[0] / max(total.count[0], 1)),
+                    percentile_errors_all=total.percentiles(percentiles)[0], pck_all=total.pck(thresholds)[0])
+
+
+def print_summary(metrics):
+    """ Prints a table of per joint metrics. """
+    print("%-8s %8s %8s %8s" % ("Joint", "N", "Mean", "RMSE") + "".join(" %7s" % ("p%g" % p) for p in metrics["percentiles"]))
+    for j in range(len(metrics["count"])):
+        print("%-8d %8d %8.2f %8.2f" % (j, metrics["count"][j], metrics["mean"][j], metrics["rmse"][j]) +
+              "".join(" %7.2f" % x for x in metrics["percentile_errors"][j]))
+    print("%-8s %8d %8.2f %8.2f" % ("All", metrics["count_all"], metrics["mean_all"], metrics["rmse_all"]) +
+          "".join(" %7.2f" % x for x in metrics["percentile_errors_all"]))
+
+
+def evaluate_predictions(*pred_paths, labels_path=None, chunk_size=10000, bin_width=0.1, save_path=None, verbose=True):
+    """
+    Evaluates predict_box outputs against labeled frames, streaming the predictions in chunks.
+
+    For multi-instance predictions (sample, instance, [x, y], joint), the instance that best matches the labels is
+    evaluated in each frame and joints it is missing are ignored.
+
+    :param pred_paths: paths to HDF5 files saved by predict_box
+    :param labels_path: path to labels file. Defaults to the .labels.mat file named after the box of each prediction file.
+    :param chunk_size: number of frames to read at a time from each prediction file
+    :param bin_width: resolution of the error histogram in pixels
+    :param save_path: path to MAT file to save the metrics to
+    :param verbose: if True, prints the metrics
+    """
+    t0 = time()
+    acc = None
+    for pred_path in pred_paths:
+        with h5py.File(pred_path, "r") as f:
+            if labels_path is None:
+                box_path = f.attrs["box_path"]
+                if isinstance(box_path, bytes):
+                    box_path = box_path.decode()
+                gt_path = os.path.splitext(box_path)[0] + ".labels.mat"
+            else:
+                gt_path = labels_path
+
+            # Ground truth is (frames, joints, [x, y]); transpose to match the predictions
+            positions_gt = np.transpose(load_labels(gt_path)["positions"], (0, 2, 1))
+            labeled = np.where(np.any(~np.isnan(positions_gt), axis=(1, 2)))[0]
+
+            ds_pos = f["positions_pred"]
+            if acc is None:
+                acc = ErrorAccumulator(ds_pos.shape[-1], bin_width=bin_width)
+
+            # Predictions start at the start_frame of the box
+            start_frame = int(f.attrs.get("start_frame", 0))
+            labeled = labeled - start_frame
+            for start in range(0, len(ds_pos), chunk_size):
+                idx = labeled[(labeled >= start) & (labeled < start + chunk_size)]
+                if len(idx) == 0:
+                    continue
+                pos_pred = ds_pos[start:start + chunk_size][idx - start]
+                if pos_pred.ndim == 4:
+                    pos_pred = match_instances(pos_pred, positions_gt[idx + start_frame])
+                acc.update(compute_errors(pos_pred, positions_gt[idx + start_frame])["euclidean"])
+
+    metrics = acc.summary()
+    if verbose:
+        print_summary(metrics)
+        print("Evaluated %d files [%.1fs]" % (len(pred_paths), time() - t0))
+    if save_path is not None:
+        savemat(save_path, metrics)
+
+    return metrics
+
+
+def evaluate_run(run_path, *, model=None, epoch=None, batch_size=32, chunk_size=1024, save=True, verbose=True):
+    """
+    Evaluates a trained model on the validation set held out during training.
+
+    :param run_path: path to the run folder with training_info.mat
+    :param model: Keras model to evaluate. If None, loads the weights from the run folder (see find_model_weights).
+    :param epoch: epoch of the weights to load if model is not provided
+    :param batch_size: number of samples to evaluate at once per batch
+    :param chunk_size: number of validation frames to read from the data file at a time
+    :param save: if True, saves the metrics to evaluation.mat in the run folder
+    :param verbose: if True, prints the metrics
+    """
+    import keras.models
+    from leap.predict_box import convert_to_peak_outputs, rescale_peaks
+    from leap.utils import get_output_stride
+
+    t0 = time()
+    info = loadmat(os.path.join(run_path, "training_info.mat"), squeeze_me=True)
+    data_path = str(info["data_path"])
+    val_idx = np.sort(np.atleast_1d(info["val_idx"]).astype("int64"))
+    box_dset = str(info["box_dset"])
+    confmap_dset = str(info["confmap_dset"])
+
+    if model is None:
+        model = keras.models.load_model(find_model_weights(run_path, epoch=epoch))
+    model_peaks = convert_to_peak_outputs(model)
+    output_stride = get_output_stride(model)
+
+    acc = None
+    with h5py.File(data_path, "r") as f:
+        for start in range(0, len(val_idx), chunk_size):
+            idx = val_idx[start:start + chunk_size]
+            X = preprocess(f[box_dset][idx])
+
+            # Ground truth from labels if available, otherwise from the peaks of the training confidence maps
+            if "joints" in f:
+                pos_gt = f["joints"][idx] - 1
+            else:
+                Y = preprocess(f[confmap_dset][idx])
+                flat_idx = Y.reshape(len(Y), -1, Y.shape[-1]).argmax(axis=1)
+                rows, cols = np.unravel_index(flat_idx, Y.shape[1:3])
+                pos_gt = np.stack((cols, rows), axis=1)
+
+            pos_pred = rescale_peaks(model_peaks.predict(X, batch_size=batch_size), output_stride)[:, :2, :]
+            if acc is None:
+                acc = ErrorAccumulator(pos_pred.shape[-1])
+            acc.update(compute_errors(pos_pred, pos_gt)["euclidean"])
+
+    metrics = acc.summary()
+    if verbose:
+        print_summary(metrics)
+        print("Evaluated %d validation samples [%.1fs]" % (len(val_idx), time() - t0))
+    if save:
+        savemat(os.path.join(run_path, "evaluation.mat"), metrics)
+
+    return metrics
+
+
+if __name__ == "__main__":
+    clize.run(evaluate_predictions, evaluate_run)
@@ -0,0 +1,292 @@
+import numpy as np
+import h5py
+import os
+from glob import glob
+from time import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from scipy.ndimage import convolve1d, uniform_filter1d
+import clize
+
+
+# Joints of the fly skeleton (0-based): thorax and leg tips in the order of gait_analysis_computation.m
+FLY_CENTER_JOINT = 4
+FLY_LEG_TIPS = [21, 25, 29, 9, 13, 17]
+
+# Gait modes (as in gait_analysis_computation.m)
+TRIPOD, TETRAPOD, NON_CANONICAL = 3, 4, 5
+GAIT_MODES = [TRIPOD, TETRAPOD, NON_CANONICAL]
+
+
+def diffpad(x, axis=0):
+    """ Differences along an axis, padded with 0 at the start to keep the length. """
+    x = np.asarray(x, dtype="float64")
+    d = np.diff(x, axis=axis)
+    pad = [(0, 0)] * x.ndim
+    pad[axis] = (1, 0)
+    return np.pad(d, pad, mode="constant")
+
+
+def gaussian_smooth(x, window, axis=0):
+    """ Gaussian-weighted moving average over a window of samples (like smoothdata(..., 'gaussian', window)). """
+    if window <= 1:
+        return x
+    t = np.arange(window) - (window - 1) / 2
+    kernel = np.exp(-t ** 2 / (2 * (window / 5) ** 2))
+    return convolve1d(x, kernel / kernel.sum(), axis=axis, mode="nearest")
+
+
+def bouts(mask):
+    """
+    Finds runs of True values along the last axis.
+
+    :param mask: boolean array (rows, frames)
+    :return: row, start and duration of each run
+    """
+    padded = np.pad(mask.astype("int8"), ((0, 0), (1, 1)), mode="constant")
+    d = np.diff(padded, axis=1)
+    rows, starts = np.nonzero(d == 1)
+    _, ends = np.nonzero(d == -1)
+    return rows, starts, ends - starts
+
+
+def classify_gait(stance, window=5):
+    """
+    Classifies the gait mode of each frame from the number of legs in stance.
+
+    Frames with 3 legs in stance are tripod, 4 are tetrapod and the others are non-canonical. Modes are smoothed with
+    a majority vote over a window of frames. (gait_analysis_computation.m fits an HMM on the number of legs in stance
+    and maps its hidden states to these modes by hand.)
+
+    :param stance: boolean array (legs, frames)
+    :param window: number of frames of the majority vote
+    :return: gait modes (frames,) as uint8 (TRIPOD, TETRAPOD or NON_CANONICAL)
+    """
+    num_stance = stance.sum(axis=0)
+    modes = np.where(num_stance == 3, TRIPOD, np.where(num_stance == 4, TETRAPOD, NON_CANONICAL))
+    if window > 1:
+        votes = np.stack([uniform_filter1d((modes == m).astype("float32"), window, mode="nearest") for m in GAIT_MODES])
+        modes = np.array(GAIT_MODES)[np.argmax(votes, axis=0)]
+    return modes.astype("uint8")
+
+
+def forward_velocity(centroids, orientations, smoothing_window=5):
+    """
+    Computes the speed of the body along its orientation (as in gait_analysis_computation.m).
+
+    :param centroids: (frames, [x, y]) body positions
+    :param orientations: (frames,) body orientations in degrees
+    :param smoothing_window: number of frames of the moving averages
+    :return: forward velocity and speed (frames,) in units of centroids per frame
+    """
+    ctr = uniform_filter1d(np.asarray(centroids, dtype="float64"), smoothing_window, axis=0, mode="nearest")
+    vel = diffpad(ctr, axis=0)
+    direction = uniform_filter1d(np.mod(np.unwrap(np.arctan2(vel[:, 1], vel[:, 0])), 2 * np.pi), smoothing_window, mode="nearest")
+    orientation = np.mod(np.unwrap(np.deg2rad(orientations)), 2 * np.pi)
+    speed = np.sqrt(np.sum(vel ** 2, axis=1))
+    return np.cos(np.abs(direction - orientation)) * speed, speed
+
+
+def load_body_motion(box_path, num_frames, start_frame=0, ell_dset="ell", frames_dset="framesIdx"):
+    """
+    Loads centroids and orientations of the boxes from the ellipse fits stored with a box file.
+
+    :return: centroids (frames, [x, y]) and orientations (frames,) in degrees, or None if not available
+    """
+    if not os.path.exists(box_path):
+        return None
+    with h5py.File(box_path, "r") as f:
+        if ell_dset not in f:
+            return None
+        ell = f[ell_dset][()]
+        if ell.shape[0] < ell.shape[1]:
+            ell = ell.T # MATLAB dimension order
+        if frames_dset in f:
+            frames = f[frames_dset][()].flatten().astype("int64") - 1 # 1-based video frame of each box
+            ell = ell[frames]
+    ell = ell[start_frame:start_frame + num_frames]
+    return ell[:, 0:2], ell[:, 4]
+
+
+def analyze_file(pred_path, legs=FLY_LEG_TIPS, center_joint=FLY_CENTER_JOINT, axis=0, fps=100.0, px_per_mm=1.0,
+                 smoothing_window=5, gait_window=5, min_forward_speed=2.0):
+    """
+    Computes leg velocities, swing/stance and gait modes from the predictions of a box file.
+
+    :param pred_path: path to HDF5 file with predictions (see predict_box)
+    :param legs: joint indices of the leg tips
+    :param center_joint: joint index that positions are made relative to
+    :param axis: coordinate of the leg velocities (0 = x, along the body axis in egocentric boxes)
+    :param fps: frame rate of the recording
+    :param px_per_mm: pixels per mm of the body centroids (1 = pixels)
+    :param smoothing_window: number of frames of the velocity smoothing
+    :param gait_window: number of frames of the gait mode majority vote
+    :param min_forward_speed: minimum forward speed (mm/s) for a frame to count as walking
+    :return: dict with per-frame results, or None if the file has multi-instance predictions
+    """
+    with h5py.File(pred_path, "r") as f:
+        positions = f["positions_pred"][()].astype("float64")
+        if positions.ndim != 3:
+            print("Skipping %s: multi-instance predictions are not supported." % pred_path)
+            return None
+        box_path = f.attrs.get("box_path", "")
+        start_frame = int(f.attrs.get("start_frame", 0))
+    if isinstance(box_path, bytes):
+        box_path = box_path.decode()
+
+    # Egocentric leg tip trajectories: (legs, frames)
+    traj = (positions[:, axis, legs] - positions[:, axis, center_joint][:, None]).T
+
+    # Stance is when legs move backwards relative to the body
+    leg_velocity = gaussian_smooth(diffpad(traj, axis=1), smoothing_window, axis=1)
+    stance = leg_velocity < 0
+    gait_mode = classify_gait(stance, window=gait_window)
+
+    # Body motion, if the ellipse fits are available
+    num_frames = len(positions)
+    motion = load_body_motion(str(box_path), num_frames, start_frame=start_frame)
+    if motion is not None and len(motion[0]) == num_frames:
+        fv, speed = forward_velocity(motion[0] / px_per_mm, motion[1], smoothing_window=smoothing_window)
+        fv, speed = fv * fps, speed * fps
+    else:
+        fv, speed = np.full(num_frames, np.nan), np.full(num_frames, np.nan)
+    walking = fv > min_forward_speed
+
+    return dict(pred_path=pred_path, leg_velocity=leg_velocity.astype("float32"), stance=stance, gait_mode=gait_mode,
+                forward_velocity=fv.astype("float32"), speed=speed.astype("float32"), walking=walking)
+
+
+class GaitSummary:
+    """ Accumulates gait statistics over files with constant memory. """
+
+    def __init__(self, num_legs, speed_bins=np.linspace(2, 35, 167), max_duration=100):
+        self.speed_bins = speed_bins
+        self.duration_bins = np.arange(max_duration + 2) - 0.5
+        self.speed_counts = np.zeros((len(GAIT_MODES), len(speed_bins) - 1), dtype="int64")
+        self.mode_frames = np.zeros(len(GAIT_MODES), dtype="int64")
+        self.swing_durations = np.zeros((num_legs, len(self.duration_bins) - 1), dtype="int64")
+        self.stance_durations = np.zeros((num_legs, len(self.duration_bins) - 1), dtype="int64")
+        self.num_frames = 0
+        self.num_walking = 0
+
+    def add(self, result):
+        walking = result["walking"] if np.any(np.isfinite(result["forward_velocity"])) else np.ones(len(result["gait_mode"]), dtype="bool")
+        self.num_frames += len(walking)
+        self.num_walking += walking.sum()
+
+        for i, mode in enumerate(GAIT_MODES):
+            in_mode = walking & (result["gait_mode"] == mode)
+            self.mode_frames[i] += in_mode.sum()
+            self.speed_counts[i] += np.histogram(result["forward_velocity"][in_mode & np.isfinite(result["forward_velocity"])], bins=self.speed_bins)[0]
+
+        for counts, mask in [(self.stance_durations, result["stance"]), (self.swing_durations, ~result["stance"])]:
+            rows, starts, durations = bouts(mask & walking[None, :])
+            np.add.at(counts, (rows, np.clip(durations, 0, counts.shape[1] - 1)), 1)
+
+    def densities(self):
+        """ Returns the distribution (pdf) of forward speeds of each gait mode: (modes, speed bins). """
+        widths = np.diff(self.speed_bins)
+        totals = np.maximum(self.speed_counts.sum(axis=1, keepdims=True), 1)
+        return self.speed_counts / totals / widths[None, :]
+
+
+def gait_analysis(out_path, *pred_paths, legs="21,25,29,9,13,17", center_joint=FLY_CENTER_JOINT, fps=100.0,
+                  px_per_mm=1.0, smoothing_window=5, gait_window=5, min_forward_speed=2.0, workers=4,
+                  save_frames=True, overwrite=False):
+    """
+    Computes gait statistics over many prediction files (Python version of gait_analysis_computation.m).
+
+    Files are analyzed in a process pool. Results are streamed to the output file as files finish, so memory does not
+    grow with the number of files. The output contains per-file gait mode fractions and, if save_frames, the per-frame
+    leg velocities, stance and gait modes under /sessions/<file name>. Speed distributions of the gait modes (during
+    forward walking) and histograms of stance and swing durations are saved at the end.
+
+    Forward walking requires ellipse fits (ell and framesIdx datasets) in the box files the predictions were made on.
+    Otherwise all frames are used.
+
+    :param out_path: path to output HDF5 file
+    :param pred_paths: paths or glob patterns of prediction files
+    :param legs: comma-separated joint indices of the leg tips (0-based, default: fly skeleton)
+    :param center_joint: joint index that positions are made relative to
+    :param fps: frame rate of the recordings
+    :param px_per_mm: pixels per mm of the body centroids (1 = pixels)
+    :param smoothing_window: number of frames of the velocity smoothing
+    :param gait_window: number of frames of the gait mode majority vote
+    :param min_forward_speed: minimum forward speed (mm/s) for a frame to count as walking
+    :param workers: number of processes
+    :param save_frames: if True, saves the per-frame results of each file
+    :param overwrite: if True and out_path exists, file will be overwritten
+    """
+    t0 = time()
+    if os.path.exists(out_path):
+        if overwrite:
+            os.remove(out_path)
+            print("Deleted existing output.")
+        else:
+            print("Error: Output path already exists.")
+            return
+
+    paths = []
+    for pattern in pred_paths:
+        paths.extend(sorted(glob(pattern)) if any(c in pattern for c in "*?[") else [pattern])
+    legs = [int(x) for x in str(legs).split(",")] if isinstance(legs, str) else list(legs)
+    print("Files: %d" % len(paths))
+
+    kwargs = dict(legs=legs, center_joint=center_joint, fps=fps, px_per_mm=px_per_mm, smoothing_window=smoothing_window,
+                  gait_window=gait_window, min_forward_speed=min_forward_speed)
+    summary = GaitSummary(len(legs))
+    names, fractions, mean_speeds, frame_counts = [], [], [], []
+
+    with h5py.File(out_path, "w") as f, ProcessPoolExecutor(max_workers=workers) as executor:
+        def write_result(result):
+            if result is None:
+                return
+            name = os.path.splitext(os.path.basename(result["pred_path"]))[0]
+            summary.add(result)
+            names.append(name)
+            fractions.append([np.mean(result["gait_mode"] == m) for m in GAIT_MODES])
+            mean_speeds.append(np.nanmean(result["forward_velocity"]) if np.any(np.isfinite(result["forward_velocity"])) else np.nan)
+            frame_counts.append(len(result["gait_mode"]))
+            if save_frames:
+                g = f.create_group("sessions/" + name)
+                g.attrs["pred_path"] = result["pred_path"]
+                for key in ["leg_velocity", "gait_mode", "forward_velocity"]:
+                    g.create_dataset(key, data=result[key], compression="gzip", compression_opts=1)
+                g.create_dataset("stance", data=result["stance"].astype("uint8"), compression="gzip", compression_opts=1)
+
+        # Keep a bounded number of files in flight
+        pending = deque()
+        for path in paths:
+            pending.append(executor.submit(analyze_file, path, **kwargs))
+            if len(pending) >= 2 * workers:
+                write_result(pending.popleft().result())
+                print("[%.1fs] %d/%d files" % (time() - t0, len(names), len(paths)))
+        while len(pending) > 0:
+            write_result(pending.popleft().result())
+        print("[%.1fs] %d/%d files" % (time() - t0, len(names), len(paths)))
+
+        f.attrs["legs"] = legs
+        f.attrs["center_joint"] = center_joint
+        f.attrs["fps"] = fps
+        f.attrs["gait_modes"] = GAIT_MODES
+        f.attrs["gait_mode_names"] = "tripod\ntetrapod\nnon-canonical"
+        f.create_dataset("names", data=np.array([n.encode("utf8") for n in names], dtype="S"))
+        f.create_dataset("gait_mode_fractions", data=np.array(fractions, dtype="float32").reshape(-1, len(GAIT_MODES)))
+        f.create_dataset("mean_forward_velocity", data=np.array(mean_speeds, dtype="float32"))
+        f.create_dataset("num_frames", data=np.array(frame_counts, dtype="int64"))
+        f.create_dataset("speed_bins", data=summary.speed_bins)
+        f.create_dataset("speed_counts", data=summary.speed_counts)
+        f.create_dataset("speed_densities", data=summary.densities())
+        f.create_dataset("duration_bins", data=summary.duration_bins)
+        f.create_dataset("stance_durations", data=summary.stance_durations)
+        f.create_dataset("swing_durations", data=summary.swing_durations)
+
+    print("Frames: %d (%d walking)" % (summary.num_frames, summary.num_walking))
+    for name, count in zip(["Tripod", "Tetrapod", "Non-canonical"], summary.mode_frames):
+        print("%s: %.1f%%" % (name, 100 * count / max(summary.num_walking, 1)))
+    print("Saved:", out_path)
+    print("Total runtime: %.1f mins" % ((time() - t0) / 60))
+
+
+if __name__ == "__main__":
+    clize.run(gait_analysis)
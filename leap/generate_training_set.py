@@ -0,0 +1,261 @@
+import numpy as np
+import h5py
+import os
+from time import time
+from datetime import datetime
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import clize
+
+from leap.utils import load_labels
+
+
+def render_confmaps(points, img_size, sigma=5, normalize=True, window=3):
+    """
+    Renders Gaussian confidence maps centered at points for a set of frames.
+
+    The 2D Gaussian is separable, so maps are built as outer products of 1D profiles along rows and columns, which
+    vectorizes across frames and joints. Values further than window * sigma from the point (along either axis) are 0.
+
+    :param points: (frames, joints, [x, y]) in 0-based image coordinates. NaN points yield empty maps.
+    :param img_size: (height, width) of the maps
+    :param sigma: standard deviation of the Gaussian in pixels
+    :param normalize: if True, maps peak at 1.0, otherwise they are scaled as a PDF (see pts2confmaps.m)
+    :param window: half-width of the rendered window in units of sigma
+    :return: confmaps (frames, height, width, joints) as float32
+    """
+    points = np.asarray(points, dtype="float32")
+    xv = np.arange(img_size[1], dtype="float32")
+    yv = np.arange(img_size[0], dtype="float32")
+
+    # 1D distances: (frames, joints, width) and (frames, joints, height)
+    dx = xv[None, None, :] - points[..., 0:1]
+    dy = yv[None, None, :] - points[..., 1:2]
+
+    gx = np.exp(-dx ** 2 / (2 * sigma ** 2))
+    gy = np.exp(-dy ** 2 / (2 * sigma ** 2))
+    gx[~(np.abs(dx) <= window * sigma)] = 0 # also zeroes NaN points
+    gy[~(np.abs(dy) <= window * sigma)] = 0
+
+    confmaps = np.einsum("njh,njw->nhwj", gy, gx)
+
+    if not normalize:
+        confmaps /= sigma * np.sqrt(2 * np.pi)
+
+    return confmaps
+
+
+def render_pafs(points, edges, img_size, sigma=5):
+    """
+    Renders part affinity fields for a set of frames (Python version of graph2paf.m).
+
+    Each edge gets 2 channels with the x and y components of the unit vector from its source to its destination joint
+    (graph2paf.m points from the destination to the source) at pixels within sigma of the segment between them, and 0
+    elsewhere. The band of an edge intersects each row in an interval of columns, so intervals are computed for all
+    frames, edges and rows at once and the fields are filled without computing distances at every pixel.
+
+    Points with an instance axis are rendered per instance, and fields are averaged where instances overlap.
+
+    :param points: (frames, joints, [x, y]) or (frames, instances, joints, [x, y]) in 0-based image coordinates. Edges
+    with NaN points are not rendered.
+    :param edges: (edges, [src, dst]) as 0-based joint indices
+    :param img_size: (height, width) of the fields
+    :param sigma: maximum distance from the edge segment in pixels
+    :return: pafs (frames, height, width, 2 * edges) as float32 with channels ordered as [x0, y0, x1, y1, ...]
+    """
+    points = np.asarray(points, dtype="float32")
+    edges = np.asarray(edges, dtype="int64").reshape(-1, 2)
+    if points.ndim == 4:
+        num_frames, num_instances = points.shape[:2]
+        pafs = render_pafs(points.reshape((-1,) + points.shape[2:]), edges, img_size, sigma=sigma)
+        pafs = pafs.reshape((num_frames, num_instances) + pafs.shape[1:])
+        counts = np.maximum(np.sum(np.any(pafs.reshape(pafs.shape[:-1] + (-1, 2)) != 0, axis=-1), axis=1), 1)
+        return pafs.sum(axis=1) / np.repeat(counts, 2, axis=-1)
+
+    # Unit vectors along edges: (frames, edges)
+    src, dst = points[:, edges[:, 0]], points[:, edges[:, 1]]
+    length = np.linalg.norm(dst - src, axis=-1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        vx, vy = (dst[..., 0] - src[..., 0]) / length, (dst[..., 1] - src[..., 1]) / length
+    valid = np.isfinite(vx) & np.isfinite(vy) & (length > 0)
+    vx, vy, length = np.where(valid, vx, 0), np.where(valid, vy, 0), np.where(valid, length, -1)
+    sx, sy = np.nan_to_num(src[..., 0]), np.nan_to_num(src[..., 1])
+
+    def interval(a, b, lo, hi):
+        """ Returns the range of x satisfying lo <= a * x + b <= hi (empty if x0 > x1). """
+        with np.errstate(invalid="ignore", divide="ignore"):
+            x0, x1 = (lo - b) / a, (hi - b) / a
+        x0, x1 = np.minimum(x0, x1), np.maximum(x0, x1)
+        inside = (lo <= b) & (b <= hi) # a == 0: all or no columns
+        flat = np.abs(a) < 1e-6
+        x0 = np.where(flat, np.where(inside, -np.inf, np.inf), x0)
+        x1 = np.where(flat, np.where(inside, np.inf, -np.inf), x1)
+        return x0, x1
+
+    # Per row: distance along the edge (0 to length) and distance across it (-sigma to sigma) are linear in x
+    dy = np.arange(img_size[0], dtype="float32")[None, None, :] - sy[..., None] # (frames, edges, height)
+    along0, along1 = interval(vx[..., None], vy[..., None] * dy - vx[..., None] * sx[..., None], 0, length[..., None])
+    across0, across1 = interval(-vy[..., None], vx[..., None] * dy + vy[..., None] * sx[..., None], -sigma, sigma)
+    x0, x1 = np.maximum(along0, across0), np.minimum(along1, across1)
+
+    # Band masks: (frames, height, width, edges)
+    xv = np.arange(img_size[1], dtype="float32")
+    mask = (xv[None, None, :, None] >= np.transpose(x0, (0, 2, 1))[:, :, None, :] - 1e-4) & \
+           (xv[None, None, :, None] <= np.transpose(x1, (0, 2, 1))[:, :, None, :] + 1e-4)
+
+    pafs = np.zeros(mask.shape[:3] + (2 * len(edges),), dtype="float32")
+    pafs[..., 0::2] = mask * vx[:, None, None, :]
+    pafs[..., 1::2] = mask * vy[:, None, None, :]
+    return pafs
+
+
+def _read_frames(dset, idx):
+    """ Reads frames at arbitrary (unsorted) indices from an HDF5 dataset. """
+    order = np.argsort(idx)
+    X = dset[idx[order]]
+    return X[np.argsort(order)]
+
+
+def _write_mat_attrs(ds, dtype):
+    """ Tags a dataset with the MATLAB class name like h5save.m does. """
+    ds.attrs["dtype"] = dtype
+
+
+def generate_training_set(box_path, *, labels_path=None, save_path=None, box_dset="/box", sigma=5.0, normalize=True,
+                          post_shuffle=True, horizontal_orientation=True, compress=True, chunk_size=64, workers=4,
+                          pafs=False, paf_sigma=5.0, overwrite=False):
+    """
+    Creates a dataset for training from a box file and its labels (Python version of generate_training_set.m).
+
+    Output datasets and attributes follow the MATLAB version (without offline mirroring), so the file can be used with
+    training.train and the MATLAB tools interchangeably.
+
+    :param box_path: path to HDF5 file with box dataset
+    :param labels_path: path to labels file. Defaults to the .labels.mat file named after the box file.
+    :param save_path: path to output HDF5 file. Defaults to training/<box name>.h5 next to the box file.
+    :param box_dset: name of HDF5 dataset containing box images
+    :param sigma: kernel size of the confidence maps in pixels
+    :param normalize: scale confidence maps to [0, 1] range
+    :param post_shuffle: shuffle the frames before saving
+    :param horizontal_orientation: animals are facing right/left (stored for mirroring during training)
+    :param compress: use GZIP compression for the image and confidence map datasets
+    :param chunk_size: number of frames to render and write at a time
+    :param workers: number of threads used to render confidence maps
+    :param pafs: if True, also renders part affinity fields along the skeleton edges (see render_pafs)
+    :param paf_sigma: maximum distance from the edges in pixels for the part affinity fields
+    :param overwrite: if True and save_path exists, file will be overwritten
+    """
+    t0_all = time()
+
+    # Paths
+    if labels_path is None:
+        labels_path = os.path.splitext(box_path)[0] + ".labels.mat"
+    if save_path is None:
+        save_path = os.path.join(os.path.dirname(box_path), "training", os.path.basename(box_path))
+    if os.path.exists(save_path):
+        if overwrite:
+            os.remove(save_path)
+            print("Deleted existing output.")
+        else:
+            print("Error: Output path already exists.")
+            return
+    if os.path.dirname(save_path) != "":
+        os.makedirs(os.path.dirname(save_path), exist_ok=True)
+
+    # Labels
+    labels = load_labels(labels_path)
+    positions = labels["positions"]
+    labeled_idx = np.where(np.all(~np.isnan(positions), axis=(1, 2)))[0]
+    num_frames = len(labeled_idx)
+    num_joints = positions.shape[1]
+    print("Found %d/%d labeled frames." % (num_frames, len(positions)))
+
+    shuffle_idx = np.arange(num_frames)
+    if post_shuffle:
+        np.random.shuffle(shuffle_idx)
+    labeled_idx = labeled_idx[shuffle_idx]
+    joints = positions[labeled_idx]
+
+    compression = dict(compression="gzip", compression_opts=1) if compress else {}
+
+    with h5py.File(box_path, "r") as f_box, h5py.File(save_path, "w") as f:
+        box = f_box[box_dset]
+        num_channels, width, height = box.shape[1:]
+        img_size = (height, width)
+
+        # Datasets are stored in MATLAB dimension order: (frames, channels, width, height)
+        ds_box = f.create_dataset("box", shape=(num_frames, num_channels, width, height), dtype=box.dtype,
+                                  chunks=(1, num_channels, width, height), **compression)
+        _write_mat_attrs(ds_box, "uint8" if box.dtype == "uint8" else "single")
+        ds_confmaps = f.create_dataset("confmaps", shape=(num_frames, num_joints, width, height), dtype="float32",
+                                       chunks=(1, num_joints, width, height), **compression)
+        _write_mat_attrs(ds_confmaps, "single")
+        ds_confmaps.attrs["sigma"] = sigma
+        ds_confmaps.attrs["normalize"] = np.uint8(normalize)
+        if pafs:
+            edges = labels["edges"]
+            ds_pafs = f.create_dataset("pafs", shape=(num_frames, 2 * len(edges), width, height), dtype="float32",
+                                       chunks=(1, 2 * len(edges), width, height), **compression)
+            _write_mat_attrs(ds_pafs, "single")
+            ds_pafs.attrs["sigma"] = paf_sigma
+
+        # Render and write in chunks, with rendering for upcoming chunks running in the background
+        t0 = time()
+        chunks = [np.arange(i, min(i + chunk_size, num_frames)) for i in range(0, num_frames, chunk_size)]
+
+        def render(points):
+            confmaps = render_confmaps(points, img_size, sigma=sigma, normalize=normalize)
+            return confmaps, render_pafs(points, edges, img_size, sigma=paf_sigma) if pafs else None
+
+        def write_chunk(idx, future):
+            confmaps, chunk_pafs = future.result()
+            ds_box[idx[0]:idx[-1]+1] = _read_frames(box, labeled_idx[idx])
+            ds_confmaps[idx[0]:idx[-1]+1] = np.transpose(confmaps, (0, 3, 2, 1))
+            if pafs:
+                ds_pafs[idx[0]:idx[-1]+1] = np.transpose(chunk_pafs, (0, 3, 2, 1))
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = deque()
+            for chunk in chunks:
+                pending.append((chunk, executor.submit(render, joints[chunk])))
+                if len(pending) >= 2 * workers:
+                    write_chunk(*pending.popleft())
+            while len(pending) > 0:
+                write_chunk(*pending.popleft())
+        print("Generated confidence maps%s [%.1fs]" % (" and part affinity fields" if pafs else "", time() - t0))
+
+        # Labels and indices (1-based, as in MATLAB)
+        _write_mat_attrs(f.create_dataset("joints", data=np.transpose(joints + 1, (0, 2, 1))), "single")
+        _write_mat_attrs(f.create_dataset("labeledIdx", data=(labeled_idx + 1).astype("float64")), "double")
+        _write_mat_attrs(f.create_dataset("shuffleIdx", data=(shuffle_idx + 1).astype("float64")), "double")
+
+        # Per-frame metadata from the box file
+        for name in ["exptID", "framesIdx", "idxs", "L"]:
+            if name in f_box:
+                data = f_box[name][()].flatten()
+                if len(data) == len(f_box[box_dset]):
+                    f.create_dataset(name, data=data[labeled_idx])
+
+        # Metadata
+        for k, v in f_box.attrs.items():
+            f.attrs[k] = v
+        f.attrs["createdOn"] = datetime.now().strftime("%d-%b-%Y %H:%M:%S")
+        f.attrs["boxPath"] = box_path
+        f.attrs["labelsPath"] = labels_path
+        f.attrs["scale"] = 1.0
+        f.attrs["postShuffle"] = np.uint8(post_shuffle)
+        f.attrs["horizontalOrientation"] = np.uint8(horizontal_orientation)
+
+        skeleton = f.create_group("skeleton")
+        skeleton.create_dataset("edges", data=(labels["edges"] + 1).T.astype("float64"))
+        skeleton.create_dataset("pos", data=labels["pos"].T.astype("float64"))
+        skeleton.attrs["jointNames"] = "\n".join(labels["joint_names"])
+
+    print("Saved:", save_path)
+    print("Finished generating training set [%.1fs]" % (time() - t0_all))
+
+    return save_path
+
+
+if __name__ == "__main__":
+    clize.run(generate_training_set)
@@ -1,34 +1,34 @@
 import cv2
 import numpy as np
+from collections import deque
 import keras
 from keras.utils import Sequence
 
+from leap.utils import split_targets
+
 def transform_imgs(X, theta=(-180,180), scale=1.0):
     """ Transforms sets of images with the same random transformation across each channel. """
     
     # Sample random rotation and scale if range specified
-    if not np.isscalar(theta):
-        theta = np.ptp(theta) * np.random.rand() + np.min(theta)
-    if not np.isscalar(scale):
-        scale = np.ptp(scale) * np.random.rand() + np.min(scale)
+    theta, scale = sample_transform(theta, scale)
     
     # Standardize X input to a list
     single_img = type(X) == np.ndarray
     if single_img:
         X = [X,]
     
-    # Find image parameters
-    img_size = X[0].shape[:2]
-    ctr = (img_size[0] / 2, img_size[0] / 2)
-    
-    # Compute affine transformation matrix
-    T = cv2.getRotationMatrix2D(ctr, theta, scale)
-    
     # Make sure we don't overwrite the inputs
     X = [x.copy() for x in X]
     
     # Apply to each image
     for i in range(len(X)):
+        # Find image parameters (images may differ in resolution, e.g., downsampled confidence maps)
+        img_size = X[i].shape[:2]
+        ctr = (img_size[0] / 2, img_size[0] / 2)
+        
+        # Compute affine transformation matrix
+        T = cv2.getRotationMatrix2D(ctr, theta, scale)
+        
         if X[i].ndim == 2:
             # Single channel image
             X[i] = cv2.warpAffine(X[i], T, img_size[::-1])
@@ -44,13 +44,99 @@ def transform_imgs(X, theta=(-180,180), scale=1.0):
     return X
 
 
+def sample_transform(theta=(-180,180), scale=1.0):
+    """ Samples a rotation angle and scale uniformly from their ranges (scalars are returned as is). """
+    if not np.isscalar(theta):
+        theta = np.ptp(theta) * np.random.rand() + np.min(theta)
+    if not np.isscalar(scale):
+        scale = np.ptp(scale) * np.random.rand() + np.min(scale)
+    return theta, scale
+
+
+def rotate_pafs(pafs, theta):
+    """
+    Rotates the vectors of part affinity fields by the rotation that transform_imgs applies to their grid.
+
+    :param pafs: fields (..., 2 * edges) with channels ordered as [x0, y0, x1, y1, ...]
+    :param theta: rotation in degrees (counter-clockwise, as in cv2.getRotationMatrix2D)
+    """
+    # Points move by T = [[cos, sin], [-sin, cos]] in image coordinates (y pointing down), and so do the vectors
+    c, s = np.cos(np.deg2rad(theta)), np.sin(np.deg2rad(theta))
+    dx, dy = pafs[..., 0::2], pafs[..., 1::2]
+    rotated = np.empty_like(pafs)
+    rotated[..., 0::2] = c * dx + s * dy
+    rotated[..., 1::2] = -s * dx + c * dy
+    return rotated
+
+
+def crop_egocentric(img, ctr, theta, box_size):
+    """
+    Crops a box centered on a point of an image, rotated about that point.
+
+    :param img: image (height, width) or (height, width, channels)
+    :param ctr: (x, y) center of the box in image coordinates
+    :param theta: rotation in degrees (counter-clockwise, as in cv2.getRotationMatrix2D)
+    :param box_size: (height, width) of the output box
+    """
+    # Rotate about the center, then translate the center to the middle of the box
+    T = cv2.getRotationMatrix2D((float(ctr[0]), float(ctr[1])), theta, 1.0)
+    T[0, 2] += box_size[1] / 2 - ctr[0]
+    T[1, 2] += box_size[0] / 2 - ctr[1]
+    
+    return cv2.warpAffine(img, T, (box_size[1], box_size[0]))
+
+
 class PairedImageAugmenter(Sequence):
-    def __init__(self, X, Y, batch_size=32, shuffle=False, theta=(-180,180), scale=1.0):
+    def __init__(self, X, Y, batch_size=32, shuffle=False, theta=(-180,180), scale=1.0, mirror=False, swap_pairs=None, horizontal_orientation=True,
+                 sampling=False, sampling_smoothing=0.9, sampling_uniform=0.2, paf_edges=None):
+        """
+        Augments pairs of images and confidence maps with random rotations, scaling and mirroring.
+
+        :param mirror: if True, randomly flips half of the samples
+        :param swap_pairs: pairs of confmap channel indices (e.g., left/right joints) to swap in flipped samples
+        :param horizontal_orientation: if True, animals face left/right so samples are flipped vertically (flipud),
+        otherwise they are flipped horizontally (fliplr)
+        :param sampling: if True, batches are drawn with probability proportional to the recent loss of each sample and
+        returned with importance weights (X, Y, sample_weights). Losses are reported by SampleLossTracker.
+        :param sampling_smoothing: weight of the previous loss of a sample in its exponential moving average
+        :param sampling_uniform: fraction of the sampling distribution that is uniform over all samples
+        :param paf_edges: skeleton edges (edges, [src, dst]) as 0-based joint indices if the last 2 * edges channels of Y
+        are part affinity fields (see generate_training_set.render_pafs). Their vectors are rotated and mirrored with the
+        images.
+        """
         self.X = X
         self.Y = Y
         self.batch_size = batch_size
         self.theta = theta
         self.scale = scale
+        self.mirror = mirror
+        self.flip_axis = 1 if horizontal_orientation else 2
+        
+        # Channel permutation for flipped confidence maps
+        self.paf_channels = 0 if paf_edges is None else 2 * len(paf_edges)
+        num_joints = Y.shape[-1] - self.paf_channels
+        self.swap_idx = np.arange(Y.shape[-1])
+        if swap_pairs is not None:
+            for a, b in swap_pairs:
+                self.swap_idx[a], self.swap_idx[b] = b, a
+
+        # Flipped fields of an edge belong to the edge between the swapped joints, and their component along the flip
+        # axis changes sign (as does the whole vector if that edge points the other way)
+        self.flip_sign = np.ones(Y.shape[-1], dtype=Y.dtype)
+        if self.paf_channels > 0:
+            self.flip_sign[num_joints + (1 if self.flip_axis == 1 else 0)::2] = -1
+            if mirror:
+                edges = [tuple(e) for e in np.asarray(paf_edges).tolist()]
+                for i, (a, b) in enumerate(edges):
+                    a, b = self.swap_idx[a], self.swap_idx[b]
+                    if (a, b) in edges:
+                        j, sign = edges.index((a, b)), 1
+                    elif (b, a) in edges:
+                        j, sign = edges.index((b, a)), -1
+                    else:
+                        raise ValueError("Edge %d-%d has no mirrored edge %d-%d in the skeleton." % (edges[i] + (a, b)))
+                    self.swap_idx[num_joints + 2 * j:num_joints + 2 * j + 2] = num_joints + 2 * i + np.arange(2)
+                    self.flip_sign[num_joints + 2 * j:num_joints + 2 * j + 2] *= sign
         
         self.num_samples = len(X)
         all_idx = np.arange(self.num_samples)
@@ -58,17 +144,58 @@ class PairedImageAugmenter(Sequence):
             np.random.shuffle(all_idx)
         
         self.batches = np.array_split(all_idx, np.ceil(self.num_samples / self.batch_size))
+
+        # Loss-aware sampling state (NaN = not seen yet)
+        self.sampling = sampling
+        self.sampling_smoothing = sampling_smoothing
+        self.sampling_uniform = sampling_uniform
+        self.sample_loss = np.full(self.num_samples, np.nan)
+        self.pending = deque(maxlen=1024) # generated batches waiting for their losses
         
     def __len__(self):
         return len(self.batches)
     
+    def sampling_probabilities(self):
+        """ Returns the probability of drawing each sample, mixing loss-proportional and uniform sampling. """
+        seen = ~np.isnan(self.sample_loss)
+        if not np.any(seen):
+            return np.full(self.num_samples, 1 / self.num_samples)
+
+        # Unseen samples are as likely as the hardest ones so that they get visited
+        loss = np.where(seen, self.sample_loss, np.nanmax(self.sample_loss))
+        p = loss / np.sum(loss) if np.sum(loss) > 0 else np.full(self.num_samples, 1 / self.num_samples)
+        return (1 - self.sampling_uniform) * p + self.sampling_uniform / self.num_samples
+
+    def update_losses(self, idx, losses):
+        """ Updates the moving average of the loss of samples. """
+        prev = self.sample_loss[idx]
+        self.sample_loss[idx] = np.where(np.isnan(prev), losses, self.sampling_smoothing * prev + (1 - self.sampling_smoothing) * losses)
+
     def __getitem__(self, batch_idx):
-        idx = self.batches[batch_idx]
+        if self.sampling:
+            p = self.sampling_probabilities()
+            idx = np.random.choice(self.num_samples, size=min(self.batch_size, self.num_samples), p=p)
+        else:
+            idx = self.batches[batch_idx]
         X = self.X[idx]
         Y = self.Y[idx]
         
         for i in range(len(X)):
-            X[i], Y[i] = transform_imgs((X[i],Y[i]), theta=self.theta, scale=self.scale)
+            theta, scale = sample_transform(self.theta, self.scale)
+            X[i], Y[i] = transform_imgs((X[i],Y[i]), theta=theta, scale=scale)
+            if self.paf_channels > 0:
+                Y[i][..., -self.paf_channels:] = rotate_pafs(Y[i][..., -self.paf_channels:], theta)
+        
+        if self.mirror:
+            flip = np.random.rand(len(X)) < 0.5
+            X[flip] = np.flip(X[flip], axis=self.flip_axis)
+            Y[flip] = np.flip(Y[flip], axis=self.flip_axis)[..., self.swap_idx] * self.flip_sign
+
+        if self.sampling:
+            # Importance weights correct the bias of the sampling distribution (normalized to a mean of 1)
+            self.pending.append((idx, X, Y))
+            weights = 1 / (self.num_samples * p[idx])
+            return X, Y, weights / np.mean(weights)
         return X, Y
 
     
@@ -83,6 +210,39 @@ class MultiInputOutputPairedImageAugmenter(PairedImageAugmenter):
         super().__init__(*args, **kwargs)
         
     def __getitem__(self, batch_idx):
-        X,Y = super().__getitem__(batch_idx)
-        return ({k: X for k in self.input_names}, {k: Y for k in self.output_names})
+        batch = super().__getitem__(batch_idx)
+        X, Y = batch[:2]
+        Y = split_targets(Y, self.output_names, self.paf_channels)
+        if len(batch) == 3:
+            return ({k: X for k in self.input_names}, Y, {k: batch[2] for k in self.output_names})
+        return ({k: X for k in self.input_names}, Y)
+
+
+class SampleLossTracker(keras.callbacks.Callback):
+    """
+    Reports the loss of each sample in the batches generated by an augmenter with sampling enabled.
+
+    After each training step, the oldest generated batch is evaluated with the current model and the per-sample mean
+    squared errors update the sampling distribution of the augmenter. This costs one extra forward pass per step. Keep
+    the generator queue short so that the sampling distribution is based on recent losses.
+    """
+    def __init__(self, augmenter):
+        super().__init__()
+        self.augmenter = augmenter
+
+    def on_batch_end(self, batch, logs={}):
+        if len(self.augmenter.pending) == 0:
+            return
+        idx, X, Y = self.augmenter.pending.popleft()
+        Y_pred = self.model.predict_on_batch(X)
+        if type(Y_pred) != list:
+            Y_pred = [Y_pred]
+
+        # Loss of the final confidence maps, plus the part affinity fields if the model has them
+        names = self.model.output_names
+        targets = split_targets(Y, names, self.augmenter.paf_channels)
+        final = [i for i, name in enumerate(names) if name != "pafs"][-1]
+        losses = sum(np.mean((Y_pred[i] - targets[name]) ** 2, axis=tuple(range(1, Y.ndim)))
+                     for i, name in enumerate(names) if i == final or name == "pafs")
+        self.augmenter.update_losses(idx, losses)
     
\ No newline at end of file
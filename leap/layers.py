@@ -33,7 +33,7 @@ from keras.backend import int_shape, permute_dimensions
 
 from keras.backend import tf
 
-from keras.layers import Conv2D, Add
+from keras.layers import Conv2D, SeparableConv2D, Add
 
 from packaging.version import parse as parse_version
 
@@ -277,4 +277,28 @@ def residual_bottleneck_module(x_in, output_filters=32, bottleneck_factor=2, pre
     # Residual connection
     x = Add(name=prefix + "_AddRes")([x_in, x])
     
-    return x
\ No newline at end of file
+    return x
+
+
+def separable_residual_module(x_in, output_filters=32, bottleneck_factor=2, prefix="sepres", activation="relu", initializer="glorot_normal"):
+    """ Residual bottleneck module with a depthwise separable convolution in place of the full 3x3 convolution. """
+    # Get input shape and channels
+    in_shape = K.int_shape(x_in)
+    input_filters = in_shape[3]
+    
+    # Bottleneck filters are proportional to the output filters
+    bottleneck_filters = output_filters // bottleneck_factor
+    
+    # Bottleneck block
+    x = Conv2D(filters=bottleneck_filters, kernel_size=1, padding="same", activation=activation, kernel_initializer=initializer, name=prefix + "_Conv1")(x_in)
+    x = SeparableConv2D(filters=bottleneck_filters, kernel_size=3, padding="same", activation=activation, depthwise_initializer=initializer, pointwise_initializer=initializer, name=prefix + "_SepConv2")(x)
+    x = Conv2D(filters=output_filters, kernel_size=1, padding="same", activation=activation, kernel_initializer=initializer, name=prefix + "_Conv3")(x)
+    
+    # 1x1 conv if input channels are different from output channels
+    if output_filters != input_filters:
+        x_in = Conv2D(filters=output_filters, kernel_size=1, padding="same", activation=activation, kernel_initializer=initializer, name=prefix + "_ConvSkip")(x_in)
+    
+    # Residual connection
+    x = Add(name=prefix + "_AddRes")([x_in, x])
+    
+    return x
@@ -4,19 +4,42 @@ from keras.models import Model
 from keras.layers import Input, Conv2D, Conv2DTranspose, Add, MaxPooling2D
 from keras.optimizers import Adam
 
-from leap.layers import residual_bottleneck_module, UpSampling2D
+from leap.layers import residual_bottleneck_module, separable_residual_module, UpSampling2D
 
-def leap_cnn(img_size, output_channels, filters=64, upsampling_layers=False, amsgrad=False, summary=False):
+def check_output_stride(output_stride):
+    """ Raises a ValueError if the output stride is not supported by the networks. """
+    if output_stride not in (1, 2, 4):
+        raise ValueError("Output stride must be 1, 2 or 4 (got %s)." % output_stride)
+
+
+def paf_head(x, paf_channels, upsample=False, name="pafs"):
+    """
+    Adds an output predicting part affinity fields (x and y components for each skeleton edge) from decoder features.
+
+    :param x: decoder features at the output stride (or at twice the output stride if upsample)
+    :param paf_channels: number of output channels (2 x number of edges)
+    :param upsample: if True, upsamples the features by 2 with a transposed convolution
+    :param name: name of the output layer (predict_box finds the PAF output by this name)
+    """
+    if upsample:
+        return Conv2DTranspose(paf_channels, kernel_size=3, strides=2, padding="same", activation="linear", kernel_initializer="glorot_normal", name=name)(x)
+    return Conv2D(paf_channels, kernel_size=3, padding="same", activation="linear", name=name)(x)
+
+
+def leap_cnn(img_size, output_channels, filters=64, upsampling_layers=False, output_stride=1, paf_channels=0, amsgrad=False, summary=False):
     """
     Creates and compiles network model.
 
     :param img_size: shape of a single image, optionally including channels
     :param output_channels: number of output channels (joints being predicted)
     :param filters: number of baseline filters to use (more filters will be used in intermediate layers)
+    :param output_stride: downsampling factor of the output confidence maps relative to the input (1, 2 or 4)
+    :param paf_channels: if > 0, adds a second output with this many part affinity field channels (see paf_head)
     :param summary: prints network summary after compiling
     """
     if len(img_size) == 2:
         img_size = img_size + (1,)
+    check_output_stride(output_stride)
 
     x_in = Input(img_size)
 
@@ -34,18 +57,26 @@ def leap_cnn(img_size, output_channels, filters=64, upsampling_layers=False, ams
     x3 = Conv2D(filters*4, kernel_size=3, padding="same", activation="relu")(x3)
     x3 = Conv2D(filters*4, kernel_size=3, padding="same", activation="relu")(x3)
 
-    if upsampling_layers:
-        x4 = UpSampling2D(interpolation="bilinear")(x3)
+    if output_stride == 4:
+        x_out = Conv2D(output_channels, kernel_size=3, padding="same", activation="linear")(x3)
     else:
-        x4 = Conv2DTranspose(filters*2, kernel_size=3, strides=2, padding="same", activation="relu", kernel_initializer="glorot_normal")(x3)
-    x4 = Conv2D(filters*2, kernel_size=3, padding="same", activation="relu")(x4)
-    x4 = Conv2D(filters*2, kernel_size=3, padding="same", activation="relu")(x4)
-
-    if upsampling_layers:
-        x_out = UpSampling2D(interpolation="bilinear")(x4)
-        x_out = Conv2D(output_channels, kernel_size=3, padding="same", activation="linear")(x_out)
-    else:
-        x_out = Conv2DTranspose(output_channels, kernel_size=3, strides=2, padding="same", activation="linear", kernel_initializer="glorot_normal")(x4)
+        if upsampling_layers:
+            x4 = UpSampling2D(interpolation="bilinear")(x3)
+        else:
+            x4 = Conv2DTranspose(filters*2, kernel_size=3, strides=2, padding="same", activation="relu", kernel_initializer="glorot_normal")(x3)
+        x4 = Conv2D(filters*2, kernel_size=3, padding="same", activation="relu")(x4)
+        x4 = Conv2D(filters*2, kernel_size=3, padding="same", activation="relu")(x4)
+
+        if output_stride == 2:
+            x_out = Conv2D(output_channels, kernel_size=3, padding="same", activation="linear")(x4)
+        elif upsampling_layers:
+            x_out = UpSampling2D(interpolation="bilinear")(x4)
+            x_out = Conv2D(output_channels, kernel_size=3, padding="same", activation="linear")(x_out)
+        else:
+            x_out = Conv2DTranspose(output_channels, kernel_size=3, strides=2, padding="same", activation="linear", kernel_initializer="glorot_normal")(x4)
+
+    if paf_channels > 0:
+        x_out = [x_out, paf_head(x3 if output_stride == 4 else x4, paf_channels, upsample=output_stride == 1)]
 
     # Compile
     net = Model(inputs=x_in, outputs=x_out, name="LeapCNN")
@@ -56,18 +87,21 @@ def leap_cnn(img_size, output_channels, filters=64, upsampling_layers=False, ams
 
     return net
 
-def hourglass(img_size, output_channels, filters=64, upsampling_layers=False, amsgrad=False, summary=False):
+def hourglass(img_size, output_channels, filters=64, upsampling_layers=False, output_stride=1, paf_channels=0, amsgrad=False, summary=False):
     """
     Creates and compiles network model.
 
     :param img_size: shape of a single image, optionally including channels
     :param output_channels: number of output channels (joints being predicted)
     :param filters: number of baseline filters to use (more filters will be used in intermediate layers)
+    :param output_stride: downsampling factor of the output confidence maps relative to the input (1, 2 or 4)
+    :param paf_channels: if > 0, adds a second output with this many part affinity field channels (see paf_head)
     :param summary: prints network summary after compiling
     """
 
     if len(img_size) == 2:
         img_size = img_size + (1,)
+    check_output_stride(output_stride)
 
     x_in = Input(img_size, name="x_in")
 
@@ -101,21 +135,29 @@ def hourglass(img_size, output_channels, filters=64, upsampling_layers=False, am
     x7_add = Add(name="x7_Add")([x3_pre, x7_pre])
     x7 = residual_bottleneck_module(x7_add, prefix="x7", output_filters=filters)
 
-    if upsampling_layers:
-        x8_pre = UpSampling2D(interpolation="bilinear", name="x8_Upsample")(x7)
-    else:
-        x8_pre = Conv2DTranspose(filters=filters, kernel_size=3, strides=2, padding="same", activation="relu", kernel_initializer="glorot_normal", name="x8_ConvT")(x7)
-    x8_add = Add(name="x8_Add")([x2_pre, x8_pre])
-    x8 = residual_bottleneck_module(x8_add, prefix="x8", output_filters=filters)
-
-    if upsampling_layers:
-        x9_pre = UpSampling2D(interpolation="bilinear", name="x9_Upsample")(x8)
-    else:
-        x9_pre = Conv2DTranspose(filters=filters, kernel_size=3, strides=2, padding="same", activation="relu", kernel_initializer="glorot_normal", name="x9_ConvT")(x8)
-    x9_add = Add(name="x9_Add")([x1_pre, x9_pre])
-    x9 = residual_bottleneck_module(x9_add, prefix="x9", output_filters=filters)
-
-    x_out = Conv2D(filters=output_channels, kernel_size=3, strides=1, padding="same", activation="linear", name="x_out")(x9)
+    x_dec = x7
+    if output_stride <= 2:
+        if upsampling_layers:
+            x8_pre = UpSampling2D(interpolation="bilinear", name="x8_Upsample")(x7)
+        else:
+            x8_pre = Conv2DTranspose(filters=filters, kernel_size=3, strides=2, padding="same", activation="relu", kernel_initializer="glorot_normal", name="x8_ConvT")(x7)
+        x8_add = Add(name="x8_Add")([x2_pre, x8_pre])
+        x8 = residual_bottleneck_module(x8_add, prefix="x8", output_filters=filters)
+        x_dec = x8
+
+    if output_stride == 1:
+        if upsampling_layers:
+            x9_pre = UpSampling2D(interpolation="bilinear", name="x9_Upsample")(x8)
+        else:
+            x9_pre = Conv2DTranspose(filters=filters, kernel_size=3, strides=2, padding="same", activation="relu", kernel_initializer="glorot_normal", name="x9_ConvT")(x8)
+        x9_add = Add(name="x9_Add")([x1_pre, x9_pre])
+        x9 = residual_bottleneck_module(x9_add, prefix="x9", output_filters=filters)
+        x_dec = x9
+
+    x_out = Conv2D(filters=output_channels, kernel_size=3, strides=1, padding="same", activation="linear", name="x_out")(x_dec)
+
+    if paf_channels > 0:
+        x_out = [x_out, paf_head(x_dec, paf_channels)]
 
     # Compile
     model = Model(inputs=x_in, outputs=x_out, name="hourglass")
@@ -128,18 +170,21 @@ def hourglass(img_size, output_channels, filters=64, upsampling_layers=False, am
 
 
 
-def stacked_hourglass(img_size, output_channels, filters=64, upsampling_layers=False, amsgrad=False, summary=False):
+def stacked_hourglass(img_size, output_channels, filters=64, upsampling_layers=False, output_stride=1, paf_channels=0, amsgrad=False, summary=False):
     """
     Creates and compiles network model.
 
     :param img_size: shape of a single image, optionally including channels
     :param output_channels: number of output channels (joints being predicted)
     :param filters: number of baseline filters to use (more filters will be used in intermediate layers)
+    :param output_stride: downsampling factor of the output confidence maps relative to the input (1, 2 or 4)
+    :param paf_channels: if > 0, adds a second output with this many part affinity field channels (see paf_head)
     :param summary: prints network summary after compiling
     """
 
     if len(img_size) == 2:
         img_size = img_size + (1,)
+    check_output_stride(output_stride)
 
     x_in = Input(img_size, name="x_in")
 
@@ -173,23 +218,28 @@ def stacked_hourglass(img_size, output_channels, filters=64, upsampling_layers=F
     x1_7_add = Add(name="x1_7_Add")([x1_3_pre, x1_7_pre])
     x1_7 = residual_bottleneck_module(x1_7_add, prefix="x1_7", output_filters=filters)
 
-    if upsampling_layers:
-        x1_8_pre = UpSampling2D(interpolation="bilinear", name="x1_8_Upsample")(x1_7)
-    else:
-        x1_8_pre = Conv2DTranspose(filters=filters, kernel_size=3, strides=2, padding="same", activation="relu", kernel_initializer="glorot_normal", name="x1_8_ConvT")(x1_7)
-    x1_8_add = Add(name="x1_8_Add")([x1_2_pre, x1_8_pre])
-    x1_8 = residual_bottleneck_module(x1_8_add, prefix="x1_8", output_filters=filters)
-
-    if upsampling_layers:
-        x1_9_pre = UpSampling2D(interpolation="bilinear", name="x1_9_Upsample")(x1_8)
-    else:
-        x1_9_pre = Conv2DTranspose(filters=filters, kernel_size=3, strides=2, padding="same", activation="relu", kernel_initializer="glorot_normal", name="x1_9_ConvT")(x1_8)
-    x1_9_add = Add(name="x1_9_Add")([x1_1_pre, x1_9_pre])
-    x1_9 = residual_bottleneck_module(x1_9_add, prefix="x1_9", output_filters=filters)
+    x1_dec = x1_7
+    if output_stride <= 2:
+        if upsampling_layers:
+            x1_8_pre = UpSampling2D(interpolation="bilinear", name="x1_8_Upsample")(x1_7)
+        else:
+            x1_8_pre = Conv2DTranspose(filters=filters, kernel_size=3, strides=2, padding="same", activation="relu", kernel_initializer="glorot_normal", name="x1_8_ConvT")(x1_7)
+        x1_8_add = Add(name="x1_8_Add")([x1_2_pre, x1_8_pre])
+        x1_8 = residual_bottleneck_module(x1_8_add, prefix="x1_8", output_filters=filters)
+        x1_dec = x1_8
+
+    if output_stride == 1:
+        if upsampling_layers:
+            x1_9_pre = UpSampling2D(interpolation="bilinear", name="x1_9_Upsample")(x1_8)
+        else:
+            x1_9_pre = Conv2DTranspose(filters=filters, kernel_size=3, strides=2, padding="same", activation="relu", kernel_initializer="glorot_normal", name="x1_9_ConvT")(x1_8)
+        x1_9_add = Add(name="x1_9_Add")([x1_1_pre, x1_9_pre])
+        x1_9 = residual_bottleneck_module(x1_9_add, prefix="x1_9", output_filters=filters)
+        x1_dec = x1_9
 
     #############
 
-    x2_1_pre = residual_bottleneck_module(x1_9, prefix="x2_1", output_filters=filters)
+    x2_1_pre = residual_bottleneck_module(x1_dec, prefix="x2_1", output_filters=filters)
     x2_1 = MaxPooling2D(pool_size=2, strides=2, padding="same", name="x2_1_pool")(x2_1_pre)
 
     x2_2_pre = residual_bottleneck_module(x2_1, prefix="x2_2", output_filters=filters)
@@ -235,11 +285,88 @@ def stacked_hourglass(img_size, output_channels, filters=64, upsampling_layers=F
 
     #############
 
-    x_out1 = residual_bottleneck_module(x1_9, output_filters=output_channels, bottleneck_factor=1, prefix="x_out1", activation="linear")
+    x_out1 = residual_bottleneck_module(x1_dec, output_filters=output_channels, bottleneck_factor=1, prefix="x_out1", activation="linear")
     x_out2 = residual_bottleneck_module(x2_9, output_filters=output_channels, bottleneck_factor=1, prefix="x_out2", activation="linear")
 
+    x_out = [x_out1, x_out2]
+    if paf_channels > 0:
+        x_out.append(paf_head(x2_9, paf_channels))
+
+    # Compile
+    model = Model(inputs=x_in, outputs=x_out, name="StackedHourglass")
+    model.compile(optimizer=Adam(amsgrad=amsgrad), loss="mean_squared_error")
+
+    if summary:
+        model.summary()
+
+    return model
+
+
+def leap_mobile(img_size, output_channels, filters=64, width_multiplier=1.0, upsampling_layers=False, output_stride=1, paf_channels=0, amsgrad=False, summary=False):
+    """
+    Creates and compiles a lightweight network for fast inference on CPUs.
+
+    The input is downsampled by a strided convolution stem before any full-width layers, and the encoder/decoder blocks
+    use depthwise separable residual modules (see separable_residual_module).
+
+    :param img_size: shape of a single image, optionally including channels
+    :param output_channels: number of output channels (joints being predicted)
+    :param filters: number of baseline filters to use (more filters will be used in intermediate layers)
+    :param width_multiplier: scales the number of filters in every layer
+    :param output_stride: downsampling factor of the output confidence maps relative to the input (1, 2 or 4)
+    :param paf_channels: if > 0, adds a second output with this many part affinity field channels (see paf_head)
+    :param summary: prints network summary after compiling
+    """
+    if len(img_size) == 2:
+        img_size = img_size + (1,)
+    check_output_stride(output_stride)
+
+    filters = max(int(filters * width_multiplier), 8)
+
+    x_in = Input(img_size, name="x_in")
+
+    x_stem = Conv2D(filters, kernel_size=3, strides=2, padding="same", activation="relu", kernel_initializer="glorot_normal", name="stem_Conv")(x_in)
+
+    x1_pre = separable_residual_module(x_stem, prefix="x1", output_filters=filters)
+    x1 = MaxPooling2D(pool_size=2, strides=2, padding="same", name="x1_pool")(x1_pre)
+
+    x2_pre = separable_residual_module(x1, prefix="x2", output_filters=filters*2)
+    x2 = MaxPooling2D(pool_size=2, strides=2, padding="same", name="x2_pool")(x2_pre)
+
+    x3 = separable_residual_module(x2, prefix="x3", output_filters=filters*4)
+
+    if upsampling_layers:
+        x4_pre = UpSampling2D(interpolation="bilinear", name="x4_Upsample")(x3)
+        x4_pre = Conv2D(filters*2, kernel_size=1, padding="same", activation="relu", kernel_initializer="glorot_normal", name="x4_Conv")(x4_pre)
+    else:
+        x4_pre = Conv2DTranspose(filters*2, kernel_size=3, strides=2, padding="same", activation="relu", kernel_initializer="glorot_normal", name="x4_ConvT")(x3)
+    x4_add = Add(name="x4_Add")([x2_pre, x4_pre])
+    x4 = separable_residual_module(x4_add, prefix="x4", output_filters=filters*2)
+
+    if output_stride == 4:
+        x_out = Conv2D(output_channels, kernel_size=3, padding="same", activation="linear", name="x_out")(x4)
+    else:
+        if upsampling_layers:
+            x5_pre = UpSampling2D(interpolation="bilinear", name="x5_Upsample")(x4)
+            x5_pre = Conv2D(filters, kernel_size=1, padding="same", activation="relu", kernel_initializer="glorot_normal", name="x5_Conv")(x5_pre)
+        else:
+            x5_pre = Conv2DTranspose(filters, kernel_size=3, strides=2, padding="same", activation="relu", kernel_initializer="glorot_normal", name="x5_ConvT")(x4)
+        x5_add = Add(name="x5_Add")([x1_pre, x5_pre])
+        x5 = separable_residual_module(x5_add, prefix="x5", output_filters=filters)
+
+        if output_stride == 2:
+            x_out = Conv2D(output_channels, kernel_size=3, padding="same", activation="linear", name="x_out")(x5)
+        elif upsampling_layers:
+            x_out = UpSampling2D(interpolation="bilinear", name="x_out_Upsample")(x5)
+            x_out = Conv2D(output_channels, kernel_size=3, padding="same", activation="linear", name="x_out")(x_out)
+        else:
+            x_out = Conv2DTranspose(output_channels, kernel_size=3, strides=2, padding="same", activation="linear", kernel_initializer="glorot_normal", name="x_out")(x5)
+
+    if paf_channels > 0:
+        x_out = [x_out, paf_head(x4 if output_stride == 4 else x5, paf_channels, upsample=output_stride == 1)]
+
     # Compile
-    model = Model(inputs=x_in, outputs=[x_out1, x_out2], name="StackedHourglass")
+    model = Model(inputs=x_in, outputs=x_out, name="LeapMobile")
     model.compile(optimizer=Adam(amsgrad=amsgrad), loss="mean_squared_error")
 
     if summary:
@@ -1,6 +1,7 @@
 import h5py
 import numpy as np
 import os
+import json
 from time import time
 import keras
 import keras.models
@@ -8,9 +9,11 @@ from keras.layers import Lambda
 import tensorflow as tf
 import re
 from clize import run
+from clize.parser import value_converter
 
-from leap.utils import find_weights, find_best_weights, preprocess
+from leap.utils import find_weights, find_best_weights, find_model_weights, preprocess, get_output_stride, check_chunk_layout, find_skeleton_edges
 from leap.layers import Maxima2D
+from leap.cache import PredictionCache
 
 def tf_find_peaks(x):
     """ Finds the maximum value in each channel and returns the location and value.
@@ -45,12 +48,169 @@ def tf_find_peaks(x):
     ], axis=1)
 
 
+def tf_find_local_peaks(x, max_peaks=4, threshold=0.1):
+    """ Finds the largest local maxima above a threshold in each channel and returns their locations and values.
+    Args:
+        x: rank-4 tensor (samples, height, width, channels)
+        max_peaks: number of peaks to return per channel
+        threshold: minimum value of a peak
+
+    Returns:
+        peaks: rank-4 tensor (samples, peaks, [x, y, val], channels) sorted by value, with val = 0 if fewer were found
+    """
+    in_shape = tf.shape(x)
+
+    # Local maxima are the points equal to the maximum of their 3 x 3 neighborhood
+    pooled = tf.nn.max_pool(x, ksize=[1, 3, 3, 1], strides=[1, 1, 1, 1], padding="SAME")
+    is_peak = tf.logical_and(tf.equal(x, pooled), x > threshold)
+    scores = tf.where(is_peak, x, tf.zeros_like(x))
+
+    # Top peaks per channel in linear indices: (samples, channels, peaks)
+    flattened = tf.reshape(tf.transpose(scores, [0, 3, 1, 2]), [in_shape[0], in_shape[3], -1])
+    vals, idx = tf.nn.top_k(flattened, k=max_peaks)
+    rows = tf.floor_div(idx, in_shape[2])
+    cols = tf.floormod(idx, in_shape[2])
+
+    peaks = tf.stack([tf.cast(cols, tf.float32), tf.cast(rows, tf.float32), vals], axis=2)
+    return tf.transpose(peaks, [0, 3, 2, 1])
+
+
+def tf_score_connections(peaks, pafs, edges, num_samples=10):
+    """ Scores connections between the peaks of the joints of each skeleton edge by the line integral of the PAFs.
+    Args:
+        peaks: rank-4 tensor (samples, peaks, [x, y, val], joints) (see tf_find_local_peaks)
+        pafs: rank-4 tensor (samples, height, width, 2 * edges) with channels ordered as [x0, y0, x1, y1, ...]
+        edges: list of (src, dst) joint indices
+        num_samples: number of points sampled along each connection
+
+    Returns:
+        scores: rank-4 tensor (samples, edges, src peaks, dst peaks) with the mean projection of the fields onto the
+        direction of the connection, or 0 if either peak is missing
+    """
+    in_shape = tf.shape(pafs)
+    num_edges = len(edges)
+
+    # Peaks of the joints of each edge: (samples, edges, peaks, [x, y, val])
+    src = tf.transpose(tf.gather(peaks, [int(e[0]) for e in edges], axis=3), [0, 3, 1, 2])
+    dst = tf.transpose(tf.gather(peaks, [int(e[1]) for e in edges], axis=3), [0, 3, 1, 2])
+
+    # Connections between all pairs: (samples, edges, src peaks, dst peaks, [x, y])
+    p0 = src[:, :, :, None, :2]
+    d = dst[:, :, None, :, :2] - p0
+    length = tf.sqrt(tf.reduce_sum(d ** 2, axis=-1, keepdims=True))
+    unit = d / tf.maximum(length, 1e-6)
+
+    # Sample points along connections: (samples, edges, src peaks, dst peaks, points)
+    t = tf.linspace(0.0, 1.0, num_samples)
+    points = tf.round(p0[..., None, :] + t[:, None] * d[..., None, :])
+    cols = tf.clip_by_value(tf.cast(points[..., 0], tf.int32), 0, in_shape[2] - 1)
+    rows = tf.clip_by_value(tf.cast(points[..., 1], tf.int32), 0, in_shape[1] - 1)
+    sample_idx = tf.zeros_like(cols) + tf.reshape(tf.range(in_shape[0]), [-1, 1, 1, 1, 1])
+    edge_idx = tf.zeros_like(cols) + tf.reshape(tf.range(num_edges), [1, -1, 1, 1, 1])
+
+    # Fields at the sample points: (samples, edges, src peaks, dst peaks, points, [x, y])
+    fields = tf.reshape(pafs, [in_shape[0], in_shape[1], in_shape[2], num_edges, 2])
+    vectors = tf.gather_nd(fields, tf.stack([sample_idx, rows, cols, edge_idx], axis=-1))
+
+    scores = tf.reduce_mean(tf.reduce_sum(vectors * unit[..., None, :], axis=-1), axis=-1)
+    valid = tf.logical_and((src[..., 2] > 0)[:, :, :, None], (dst[..., 2] > 0)[:, :, None, :])
+    return tf.where(valid, scores, tf.zeros_like(scores))
+
+
+def group_instances(peaks, scores, edges, max_instances=4, min_score=0.05):
+    """
+    Assembles peaks into instances by greedily matching the best scoring connections of each skeleton edge.
+
+    Matching is vectorized over samples: for each edge, the highest scoring pair of unmatched peaks is connected in all
+    samples at once, as many times as there are peaks. Peaks that are not connected to an existing instance start a new
+    one, and instances are ranked by the sum of their peak values.
+
+    :param peaks: (samples, peaks, [x, y, val], joints) with val = 0 for missing peaks
+    :param scores: (samples, edges, src peaks, dst peaks) connection scores (see tf_score_connections)
+    :param edges: (edges, [src, dst]) as 0-based joint indices
+    :param max_instances: number of instances to return per sample
+    :param min_score: minimum score of a connection
+    :return: instances (samples, max_instances, [x, y, val], joints) with NaN coordinates and val = 0 for missing joints
+    """
+    num_samples, num_peaks, _, num_joints = peaks.shape
+    samples = np.arange(num_samples)
+    valid = peaks[:, :, 2, :] > 0 # (samples, peaks, joints)
+
+    # Instance of each peak (-1 = none) and joints taken in each instance
+    instance = np.full((num_samples, num_peaks, num_joints), -1, dtype="int64")
+    taken = np.zeros((num_samples, num_peaks * num_joints, num_joints), dtype="bool")
+    next_id = np.zeros(num_samples, dtype="int64")
+
+    def start_instances(j):
+        new = valid[:, :, j] & (instance[:, :, j] < 0)
+        ids = next_id[:, None] + np.cumsum(new, axis=1) - 1
+        instance[:, :, j] = np.where(new, ids, instance[:, :, j])
+        n, k = np.nonzero(new)
+        taken[n, ids[n, k], j] = True
+        next_id[:] += new.sum(axis=1)
+
+    for e, (src, dst) in enumerate(edges):
+        start_instances(src)
+        s = np.where(scores[:, e] >= min_score, scores[:, e], -np.inf)
+        for _ in range(num_peaks):
+            best = s.reshape(num_samples, -1).argmax(axis=1)
+            k_src, k_dst = best // num_peaks, best % num_peaks
+            ids = instance[samples, k_src, src]
+            connect = np.isfinite(s[samples, k_src, k_dst]) & (ids >= 0) & (instance[samples, k_dst, dst] < 0) & ~taken[samples, ids, dst]
+            instance[samples[connect], k_dst[connect], dst] = ids[connect]
+            taken[samples[connect], ids[connect], dst] = True
+            s[samples, k_src, :] = -np.inf
+            s[samples, :, k_dst] = -np.inf
+    for j in range(num_joints):
+        start_instances(j)
+
+    # Gather peaks by instance: (samples, instances, [x, y, val], joints)
+    grouped = np.zeros((num_samples, num_peaks * num_joints, 3, num_joints), dtype="float32")
+    grouped[:, :, :2, :] = np.nan
+    n, k, j = np.nonzero(instance >= 0)
+    grouped[n, instance[n, k, j], :, j] = peaks[n, k, :, j]
+
+    order = np.argsort(-grouped[:, :, 2, :].sum(axis=-1), axis=1, kind="stable")[:, :max_instances]
+    grouped = grouped[samples[:, None], order]
+    if grouped.shape[1] < max_instances:
+        missing = np.zeros((num_samples, max_instances - grouped.shape[1], 3, num_joints), dtype="float32")
+        missing[:, :, :2, :] = np.nan
+        grouped = np.concatenate([grouped, missing], axis=1)
+    return grouped
+
+
+def split_paf_output(model):
+    """ Returns the confidence map output (the last one if stacked) and the part affinity field output (or None). """
+    outputs = model.output if type(model.output) == list else [model.output]
+    pafs = None
+    if "pafs" in [layer.name for layer in model.layers]:
+        pafs = model.get_layer("pafs").output
+        outputs = [x for x in outputs if x is not pafs]
+    return outputs[-1], pafs
+
+
+def has_paf_output(weights_path):
+    """ Returns True if a saved model has a part affinity field output, without loading the model. """
+    with h5py.File(weights_path, "r") as f:
+        config = f.attrs.get("model_config")
+    if config is None:
+        return False
+    if isinstance(config, bytes):
+        config = config.decode("utf8")
+    return any(layer.get("name") == "pafs" for layer in json.loads(config)["config"]["layers"])
+
+
+def convert_to_instance_outputs(model, edges, max_peaks=4, peak_threshold=0.1):
+    """ Creates a new Keras model that yields the top peaks of each channel and the PAF scores of their connections. """
+    confmaps, pafs = split_paf_output(model)
+    peaks = Lambda(tf_find_local_peaks, arguments=dict(max_peaks=max_peaks, threshold=peak_threshold))(confmaps)
+    scores = Lambda(lambda x: tf_score_connections(x[0], x[1], edges))([peaks, pafs])
+    return keras.Model(model.input, [peaks, scores])
+
+
 def convert_to_peak_outputs(model, include_confmaps=False):
     """ Creates a new Keras model with a wrapper to yield channel peaks from rank-4 tensors. """
-    if type(model.output) == list:
-        confmaps = model.output[-1]
-    else:
-        confmaps = model.output
+    confmaps, _ = split_paf_output(model)
 
     if include_confmaps:
         return keras.Model(model.input, [Lambda(tf_find_peaks)(confmaps), confmaps])
@@ -59,7 +219,102 @@ def convert_to_peak_outputs(model, include_confmaps=False):
         return keras.Model(model.input, Maxima2D()(confmaps))
 
 
-def predict_box(box_path, model_path, out_path, *, box_dset="/box", epoch=None, verbose=True, overwrite=False, save_confmaps=False, batch_size=32):
+def rescale_peaks(Ypk, output_stride=1):
+    """ Maps peaks (samples, [instances,] [x, y, val], channels) from confidence map to image coordinates. """
+    if output_stride == 1:
+        return Ypk
+
+    # Output pixels are centered on blocks of output_stride x output_stride input pixels
+    Ypk = Ypk.copy()
+    Ypk[...,:2,:] = np.round(Ypk[...,:2,:] * output_stride + (output_stride - 1) / 2)
+    return Ypk
+
+
+def save_predictions(f, Ypk):
+    """
+    Writes peaks (samples, [x, y, val], channels) to the positions_pred and conf_pred datasets of an open HDF5 file.
+
+    Grouped peaks (samples, instances, [x, y, val], channels) are saved with an instance axis and -1 coordinates for
+    missing joints.
+    """
+    if Ypk.ndim == 4:
+        positions = np.where(np.isnan(Ypk[:,:,:2,:]), -1, Ypk[:,:,:2,:]).astype("int32")
+        ds_pos = f.create_dataset("positions_pred", data=positions, compression="gzip", compression_opts=1)
+        ds_pos.attrs["description"] = "coordinate of peak of each instance at each sample (-1 if missing)"
+        ds_pos.attrs["dims"] = "(sample, instance, [x, y], joint) === (sample, instance, [column, row], joint)"
+
+        ds_conf = f.create_dataset("conf_pred", data=Ypk[:,:,2,:], compression="gzip", compression_opts=1)
+        ds_conf.attrs["description"] = "confidence map value in [0, 1.0] at peak (0 if missing)"
+        ds_conf.attrs["dims"] = "(sample, instance, joint)"
+        return
+
+    ds_pos = f.create_dataset("positions_pred", data=Ypk[:,:2,:].astype("int32"), compression="gzip", compression_opts=1)
+    ds_pos.attrs["description"] = "coordinate of peak at each sample"
+    ds_pos.attrs["dims"] = "(sample, [x, y], joint) === (sample, [column, row], joint)"
+
+    ds_conf = f.create_dataset("conf_pred", data=Ypk[:,2,:].squeeze(), compression="gzip", compression_opts=1)
+    ds_conf.attrs["description"] = "confidence map value in [0, 1.0] at peak"
+    ds_conf.attrs["dims"] = "(sample, joint)"
+
+
+@value_converter(name="THRESHOLDS")
+def threshold_list(arg):
+    """ Parses one threshold ("0.5") or comma-separated thresholds ("0.5,0.3,...") from the command line. """
+    return [float(x) for x in arg.split(",")]
+
+
+def parse_thresholds(thresholds, num_joints):
+    """ Returns a threshold for all joints (0.5) or one per joint ([0.5, 0.3, ...]) as an array (joints,). """
+    thresholds = np.atleast_1d(np.asarray(thresholds, dtype="float32"))
+    if len(thresholds) not in (1, num_joints):
+        raise ValueError("Expected 1 or %d thresholds, got %d." % (num_joints, len(thresholds)))
+    return np.broadcast_to(thresholds, (num_joints,))
+
+
+def find_low_confidence(Ypk, thresholds):
+    """ Returns the indices of samples with any joint's peak value (samples, [x, y, val], joints) below its threshold. """
+    return np.flatnonzero((Ypk[:, 2, :] < thresholds[None, :]).any(axis=1))
+
+
+def cascade_predict(box, Ypk, idx, weights_path, start_frame=0, batch_size=32, read_frames=1024, verbose=True):
+    """
+    Re-predicts a subset of frames with a second model and replaces their peaks.
+
+    Frames are read from the box in blocks of increasing indices (as required by HDF5 fancy indexing), so only the
+    selected frames are loaded.
+
+    :param box: box dataset (frames, channels, width, height)
+    :param Ypk: peaks of the first model (samples, [x, y, val], joints), relative to start_frame
+    :param idx: indices into Ypk of the samples to re-predict
+    :param weights_path: path to the Keras weights of the second model
+    :param start_frame: box frame of the first sample
+    :param batch_size: number of samples to evaluate at once per batch
+    :param read_frames: number of frames to read from the box at a time
+    :param verbose: if True, prints progress
+    :return: Ypk with the re-predicted samples replaced, and the prediction runtime in seconds
+    """
+    model = keras.models.load_model(weights_path)
+    model_peaks = convert_to_peak_outputs(model)
+    output_stride = get_output_stride(model)
+    if verbose:
+        print("cascade weights_path:", weights_path)
+        print("Loaded cascade model: %d layers, %d params" % (len(model.layers), model.count_params()))
+
+    Ypk = Ypk.copy()
+    idx = np.sort(idx)
+    runtime = 0
+    for i in range(0, len(idx), read_frames):
+        block = idx[i:i + read_frames]
+        X = preprocess(box[start_frame + block])
+        t0 = time()
+        Ypk[block] = rescale_peaks(model_peaks.predict(X, batch_size=batch_size), output_stride)
+        runtime += time() - t0
+    return Ypk, runtime
+
+
+def predict_box(box_path, model_path, out_path, *, box_dset="/box", epoch=None, verbose=True, overwrite=False, save_confmaps=False, batch_size=32,
+                start_frame=0, end_frame: int = None, cache_dir=None, cache_max_gb=10.0, max_instances=4, peak_threshold=0.1,
+                skeleton_path=None, cascade_model_path=None, cascade_epoch: int = None, cascade_threshold: threshold_list = 0.5):
     """
     Predict and save peak coordinates for a box.
 
@@ -69,9 +324,26 @@ def predict_box(box_path, model_path, out_path, *, box_dset="/box", epoch=None,
     :param box_dset: name of HDF5 dataset containing box images
     :param epoch: epoch to use if run folder provided instead of Keras weights file
     :param verbose: if True, prints some info and statistics during procesing
-    :param overwrite: if True and out_path exists, file will be overwritten
+    :param overwrite: if True and out_path exists, file will be overwritten. With cache_dir, an existing output is also
+        rewritten when all of its frames are cached.
     :param save_confmaps: if True, saves the full confidence maps as additional datasets in the output file (very slow)
     :param batch_size: number of samples to evaluate at once per batch (see keras.Model API)
+    :param start_frame: first frame to predict
+    :param end_frame: frame to stop predicting at (exclusive). Defaults to the end of the box.
+    :param cache_dir: path to a prediction cache folder. Frames previously predicted with the same weights and box are
+        loaded from the cache instead of being predicted again (not used with save_confmaps).
+    :param cache_max_gb: maximum size of the cache folder, after which least recently used entries are deleted
+    :param max_instances: number of instances to save per frame if the model has a part affinity field output
+    :param peak_threshold: minimum confidence map value of a peak when grouping instances
+    :param skeleton_path: path to HDF5 file with the skeleton the part affinity fields were trained on. Defaults to the
+        training set of the run folder.
+    :param cascade_model_path: path to the Keras weights or run folder of a slower, more accurate model. If provided,
+        model_path is run on all frames first (e.g., a leap_cnn with few filters), and frames where the confidence of any
+        joint is below cascade_threshold are predicted again with this model (e.g., a stacked_hourglass). The model that
+        produced each frame is saved in the model_idx dataset (0 = model_path, 1 = cascade_model_path).
+    :param cascade_epoch: epoch to use if a run folder is provided for cascade_model_path
+    :param cascade_threshold: minimum confidence of the first model's peaks, either one value for all joints or one
+        value for each joint (comma-separated on the command line, e.g., 0.5,0.3,...)
     """
 
     if verbose:
@@ -79,25 +351,44 @@ def predict_box(box_path, model_path, out_path, *, box_dset="/box", epoch=None,
 
     # Find model weights
     model_name = None
-    weights_path = model_path
     if os.path.isdir(model_path):
         model_name = os.path.basename(model_path)
-
-        weights_paths, epochs, val_losses = find_weights(model_path)
-
-        if epoch == None and len(val_losses) > 0:
-            weights_path = weights_paths[np.argmin(val_losses)]
-        elif epoch == "final" or (epoch == None and len(val_losses) == 0):
-            weights_path = os.path.join(model_path, "final_model.h5")
-        else:
-            weights_path = weights_paths[epoch]
+    weights_path = find_model_weights(model_path, epoch=epoch)
+
+    # Models with part affinity fields predict multiple instances that are grouped along the skeleton edges
+    multi_instance = has_paf_output(weights_path)
+    edges = None
+    if multi_instance:
+        edges = find_skeleton_edges(model_path, skeleton_path)
+        if edges is None:
+            print("Error: Skeleton path is required for models with part affinity fields.")
+            return
+        if save_confmaps:
+            print("Error: Confidence maps cannot be saved for models with part affinity fields.")
+            return
+        if verbose:
+            print("Grouping up to %d instances along %d edges." % (max_instances, len(edges)))
+
+    # Cascade of a fast and an accurate model
+    cascade_weights_path = None
+    if cascade_model_path is not None:
+        if multi_instance or save_confmaps:
+            print("Error: Cascade prediction is not supported with part affinity fields or saved confidence maps.")
+            return
+        cascade_weights_path = find_model_weights(cascade_model_path, epoch=cascade_epoch)
 
     # Input data
     box = h5py.File(box_path,"r")[box_dset]
-    num_samples = box.shape[0]
+    if end_frame is None:
+        end_frame = box.shape[0]
+    end_frame = min(end_frame, box.shape[0])
+    num_samples = end_frame - start_frame
     if verbose:
         print("Input:", box_path)
         print("box.shape:", box.shape)
+        if num_samples < box.shape[0]:
+            print("Frames: %d-%d" % (start_frame, end_frame))
+    check_chunk_layout(box)
 
     # Create output path
     if out_path[-3:] != ".h5":
@@ -113,65 +404,139 @@ def predict_box(box_path, model_path, out_path, *, box_dset="/box", epoch=None,
         print("Output:", out_path)
 
     t0_all = time()
+    if os.path.exists(out_path) and not overwrite and cache_dir is None:
+        print("Error: Output path already exists.")
+        return
+
+    # Look up previously predicted frames
+    cache = None
+    segments, missing = [], [(start_frame, end_frame)]
+    output_stride = None
+    if cache_dir is not None and not save_confmaps:
+        cache = PredictionCache(cache_dir, max_size_gb=cache_max_gb)
+        if multi_instance:
+            cache_key = cache.key(weights_path, box_path, box_dset, peaks="pafs", max_instances=max_instances,
+                                  peak_threshold=peak_threshold, edges=edges.tolist())
+        else:
+            cache_key = cache.key(weights_path, box_path, box_dset, peaks="Maxima2D")
+        segments, missing = cache.get(cache_key, start_frame, end_frame)
+        if len(segments) > 0:
+            output_stride = cache.metadata(cache_key)["output_stride"]
+        if verbose:
+            print("Cache: %d/%d frames cached (%s)" % (num_samples - sum(e - s for s, e in missing), num_samples, cache_key))
+
+    # An existing output is rewritten when all of its frames are cached
     if os.path.exists(out_path):
         if overwrite:
             os.remove(out_path)
             print("Deleted existing output.")
+        elif cache is not None and len(missing) == 0:
+            os.remove(out_path)
+            print("Rewriting existing output from cache.")
         else:
             print("Error: Output path already exists.")
             return
 
-    # Load and prepare model
-    model = keras.models.load_model(weights_path)
-    model_peaks = convert_to_peak_outputs(model, include_confmaps=save_confmaps)
-    if verbose:
-        print("weights_path:", weights_path)
-        print("Loaded model: %d layers, %d params" % (len(model.layers), model.count_params()))
-
-    # Load data and preprocess (normalize)
-    t0 = time()
-    X = preprocess(box[:])
-    if verbose:
-        print("Loaded [%.1fs]" % (time() - t0))
-
-    # Evaluate
-    t0 = time()
-    if save_confmaps:
-        Ypk, confmaps = model_peaks.predict(X, batch_size=batch_size)
-
-        # Quantize
-        confmaps_min = confmaps.min()
-        confmaps_max = confmaps.max()
-        confmaps = (confmaps - confmaps_min) / (confmaps_max - confmaps_min)
-        confmaps = (confmaps * 255).astype('uint8')
-
-        # Reshape
-        confmaps = np.transpose(confmaps, (0, 3, 2, 1))
-    else:
-        Ypk = model_peaks.predict(X, batch_size=batch_size)
-    prediction_runtime = time() - t0
-    if verbose:
+    prediction_runtime = 0
+    if len(missing) > 0:
+        # Load and prepare model
+        model = keras.models.load_model(weights_path)
+        if multi_instance:
+            model_peaks = convert_to_instance_outputs(model, edges, max_peaks=max_instances, peak_threshold=peak_threshold)
+        else:
+            model_peaks = convert_to_peak_outputs(model, include_confmaps=save_confmaps)
+        output_stride = get_output_stride(model)
+        if verbose:
+            print("weights_path:", weights_path)
+            print("Loaded model: %d layers, %d params" % (len(model.layers), model.count_params()))
+            if output_stride > 1:
+                print("output_stride:", output_stride)
+
+    for seg_start, seg_end in missing:
+        # Load data and preprocess (normalize)
+        t0 = time()
+        X = preprocess(box[seg_start:seg_end])
+        if verbose:
+            print("Loaded [%.1fs]" % (time() - t0))
+
+        # Evaluate
+        t0 = time()
+        if save_confmaps:
+            Ypk, confmaps = model_peaks.predict(X, batch_size=batch_size)
+
+            # Quantize
+            confmaps_min = confmaps.min()
+            confmaps_max = confmaps.max()
+            confmaps = (confmaps - confmaps_min) / (confmaps_max - confmaps_min)
+            confmaps = (confmaps * 255).astype('uint8')
+
+            # Reshape
+            confmaps = np.transpose(confmaps, (0, 3, 2, 1))
+        elif multi_instance:
+            peaks, scores = model_peaks.predict(X, batch_size=batch_size)
+            Ypk = group_instances(peaks, scores, edges, max_instances=max_instances)
+        else:
+            Ypk = model_peaks.predict(X, batch_size=batch_size)
+        Ypk = rescale_peaks(Ypk, output_stride)
+        prediction_runtime += time() - t0
+
+        if cache is not None:
+            cache.put(cache_key, seg_start, Ypk, weights_path=weights_path, box_path=box_path, box_dset=box_dset,
+                      output_stride=output_stride)
+        segments.append((seg_start, Ypk))
+
+    Ypk = np.concatenate([Ypk for _, Ypk in sorted(segments, key=lambda x: x[0])], axis=0)
+    if verbose and prediction_runtime > 0:
+        num_predicted = sum(e - s for s, e in missing)
         print("Predicted [%.1fs]" % prediction_runtime)
-        print("Prediction performance: %.3f FPS" % (num_samples / prediction_runtime))
+        print("Prediction performance: %.3f FPS" % (num_predicted / prediction_runtime))
+
+    # Re-predict low confidence frames with the cascade model
+    model_idx = None
+    if cascade_weights_path is not None:
+        try:
+            thresholds = parse_thresholds(cascade_threshold, Ypk.shape[-1])
+        except ValueError as e:
+            print("Error:", e)
+            return
+        refine_idx = find_low_confidence(Ypk, thresholds)
+        if verbose:
+            print("Cascade: %d/%d frames below confidence threshold" % (len(refine_idx), num_samples))
+        model_idx = np.zeros(num_samples, dtype="uint8")
+        model_idx[refine_idx] = 1
+        if len(refine_idx) > 0:
+            Ypk, cascade_runtime = cascade_predict(box, Ypk, refine_idx, cascade_weights_path, start_frame=start_frame,
+                                                   batch_size=batch_size, verbose=verbose)
+            prediction_runtime += cascade_runtime
+            if verbose and cascade_runtime > 0:
+                print("Cascade predicted [%.1fs]" % cascade_runtime)
+                print("Cascade performance: %.3f FPS" % (len(refine_idx) / cascade_runtime))
 
     # Save
     t0 = time()
     with h5py.File(out_path, "w") as f:
         f.attrs["num_samples"] = num_samples
-        f.attrs["img_size"] = X.shape[1:]
+        f.attrs["img_size"] = box.shape[1:][::-1]
         f.attrs["box_path"] = box_path
         f.attrs["box_dset"] = box_dset
+        f.attrs["start_frame"] = start_frame
         f.attrs["model_path"] = model_path
         f.attrs["weights_path"] = weights_path
         f.attrs["model_name"] = model_name
-
-        ds_pos = f.create_dataset("positions_pred", data=Ypk[:,:2,:].astype("int32"), compression="gzip", compression_opts=1)
-        ds_pos.attrs["description"] = "coordinate of peak at each sample"
-        ds_pos.attrs["dims"] = "(sample, [x, y], joint) === (sample, [column, row], joint)"
-
-        ds_conf = f.create_dataset("conf_pred", data=Ypk[:,2,:].squeeze(), compression="gzip", compression_opts=1)
-        ds_conf.attrs["description"] = "confidence map value in [0, 1.0] at peak"
-        ds_conf.attrs["dims"] = "(sample, joint)"
+        f.attrs["output_stride"] = output_stride
+        if multi_instance:
+            f.attrs["max_instances"] = max_instances
+
+        save_predictions(f, Ypk)
+
+        if model_idx is not None:
+            f.attrs["cascade_model_path"] = cascade_model_path
+            f.attrs["cascade_weights_path"] = cascade_weights_path
+            f.attrs["cascade_threshold"] = parse_thresholds(cascade_threshold, Ypk.shape[-1])
+            f.attrs["cascade_frames"] = int(model_idx.sum())
+            ds_model_idx = f.create_dataset("model_idx", data=model_idx, compression="gzip", compression_opts=1)
+            ds_model_idx.attrs["description"] = "model that predicted each sample (0 = model_path, 1 = cascade_model_path)"
+            ds_model_idx.attrs["dims"] = "(sample,)"
 
         if save_confmaps:
             ds_confmaps = f.create_dataset("confmaps", data=confmaps, compression="gzip", compression_opts=1)
@@ -0,0 +1,208 @@
+import numpy as np
+import h5py
+import os
+import threading
+from queue import Queue
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+import cv2
+import keras
+import keras.models
+import clize
+
+from leap.utils import find_model_weights, get_output_stride
+from leap.image_augmentation import crop_egocentric
+from leap.predict_box import convert_to_peak_outputs, rescale_peaks, save_predictions
+
+
+def load_tracking(tracking_path, centroid_dset="centroids", orientation_dset="orientations"):
+    """
+    Loads per-frame centroids and orientations used to crop boxes from raw frames.
+
+    :param tracking_path: path to HDF5 file with tracking data
+    :param centroid_dset: name of the dataset with centroids (frames, [x, y]) in 0-based image coordinates
+    :param orientation_dset: name of the dataset with orientations (frames,) in degrees
+    :return: centroids, orientations
+    """
+    with h5py.File(tracking_path, "r") as f:
+        centroids = f[centroid_dset][()].astype("float32")
+        orientations = f[orientation_dset][()].astype("float32").flatten()
+
+    # Accept MATLAB dimension order
+    if centroids.shape[0] == 2 and centroids.shape[1] != 2:
+        centroids = centroids.T
+
+    return centroids, orientations
+
+
+def _read_frames(reader, start_frame, end_frame, batch_size, grayscale, crop, executor, batches):
+    """
+    Decodes frames in batches and queues the futures of their crops. Any exception raised while decoding is queued
+    for the consumer to re-raise, and None is always queued when done.
+    """
+    try:
+        reader.set(cv2.CAP_PROP_POS_FRAMES, start_frame)
+
+        frame_idx = start_frame
+        while frame_idx < end_frame:
+            frames = []
+            while len(frames) < batch_size and frame_idx < end_frame:
+                ok, I = reader.read()
+                if not ok:
+                    end_frame = frame_idx
+                    break
+                if grayscale:
+                    I = cv2.cvtColor(I, cv2.COLOR_BGR2GRAY)
+                frames.append(I)
+                frame_idx += 1
+
+            if len(frames) > 0:
+                idx = np.arange(frame_idx - len(frames), frame_idx)
+                batches.put((idx, executor.submit(lambda frames=frames, idx=idx: np.stack([crop(I, i) for I, i in zip(frames, idx)]))))
+    except Exception as e:
+        batches.put(e)
+    finally:
+        reader.release()
+        batches.put(None)
+
+
+def predict_video(video_path, tracking_path, model_path, out_path, *, centroid_dset="centroids",
+                  orientation_dset="orientations", start_frame=0, end_frame: int = None, epoch=None, batch_size=32,
+                  workers=4, max_pending=8, verbose=True, overwrite=False):
+    """
+    Predict and save peak coordinates from a raw video, cropping boxes on the fly.
+
+    Frames are decoded in a background thread and cropped around the centroid of each frame (rotated by its
+    orientation) in a thread pool while the model evaluates previous batches. No intermediate box file is written.
+
+    :param video_path: path to video file readable by OpenCV
+    :param tracking_path: path to HDF5 file with centroids and orientations (see load_tracking)
+    :param model_path: path to Keras weights file or run folder with weights subfolder
+    :param out_path: path to HDF5 file to save results to
+    :param centroid_dset: name of the dataset with centroids (frames, [x, y]) in 0-based image coordinates
+    :param orientation_dset: name of the dataset with orientations (frames,) in degrees
+    :param start_frame: first frame to predict
+    :param end_frame: frame to stop predicting at (exclusive). Defaults to the end of the video.
+    :param epoch: epoch to use if run folder provided instead of Keras weights file
+    :param batch_size: number of samples to evaluate at once per batch
+    :param workers: number of threads used to crop frames
+    :param max_pending: maximum number of decoded batches waiting for the model
+    :param verbose: if True, prints some info and statistics during procesing
+    :param overwrite: if True and out_path exists, file will be overwritten
+    """
+    t0_all = time()
+    if os.path.exists(out_path):
+        if overwrite:
+            os.remove(out_path)
+            print("Deleted existing output.")
+        else:
+            print("Error: Output path already exists.")
+            return
+
+    # Load and prepare model
+    weights_path = find_model_weights(model_path, epoch=epoch)
+    model = keras.models.load_model(weights_path)
+    model_peaks = convert_to_peak_outputs(model)
+    output_stride = get_output_stride(model)
+    box_size = model.input_shape[1:3]
+    grayscale = model.input_shape[-1] == 1
+    if verbose:
+        print("weights_path:", weights_path)
+        print("Loaded model: %d layers, %d params" % (len(model.layers), model.count_params()))
+
+    # Tracking data
+    centroids, orientations = load_tracking(tracking_path, centroid_dset=centroid_dset, orientation_dset=orientation_dset)
+    tracked = np.all(~np.isnan(centroids), axis=1) & ~np.isnan(orientations)
+    if end_frame is None:
+        end_frame = len(centroids)
+    end_frame = min(end_frame, len(centroids))
+    if verbose:
+        print("Input:", video_path)
+        print("Frames: %d-%d (%d untracked)" % (start_frame, end_frame, np.sum(~tracked[start_frame:end_frame])))
+
+    def crop(I, i):
+        if not tracked[i]:
+            return np.zeros(tuple(box_size) + I.shape[2:], dtype=I.dtype)
+        return crop_egocentric(I, centroids[i], orientations[i], box_size)
+
+    # Decode and crop in the background
+    reader = cv2.VideoCapture(video_path)
+    if not reader.isOpened():
+        print("Error: Could not open video: %s" % video_path)
+        return
+    batches = Queue(maxsize=max_pending)
+    executor = ThreadPoolExecutor(max_workers=workers)
+    reader_thread = threading.Thread(target=_read_frames, args=(reader, start_frame, end_frame, batch_size, grayscale,
+                                                                crop, executor, batches), daemon=True)
+    reader_thread.start()
+
+    # Evaluate
+    Ypk = []
+    prediction_runtime = 0
+    error = None
+    while True:
+        batch = batches.get()
+        if batch is None:
+            break
+        if isinstance(batch, Exception):
+            error = batch
+            continue
+        idx, future = batch
+        X = future.result()
+        if X.ndim == 3:
+            X = X[..., None]
+        if X.dtype == "uint8":
+            X = X.astype("float32") / 255
+
+        t0 = time()
+        Ypk.append(model_peaks.predict_on_batch(X))
+        prediction_runtime += time() - t0
+
+        if verbose and len(Ypk) % 100 == 0:
+            num_predicted = idx[-1] + 1 - start_frame
+            print("Predicted %d/%d frames [%.1f FPS]" % (num_predicted, end_frame - start_frame, num_predicted / (time() - t0_all)))
+    reader_thread.join()
+    executor.shutdown()
+    if error is not None:
+        raise error
+    if len(Ypk) == 0:
+        print("Error: No frames decoded from %s in frames %d-%d." % (video_path, start_frame, end_frame))
+        return
+
+    Ypk = rescale_peaks(np.concatenate(Ypk, axis=0), output_stride)
+    num_samples = len(Ypk)
+    if verbose:
+        print("Predicted [%.1fs]" % prediction_runtime)
+        print("Prediction performance: %.3f FPS" % (num_samples / prediction_runtime))
+
+    # Save
+    t0 = time()
+    with h5py.File(out_path, "w") as f:
+        f.attrs["num_samples"] = num_samples
+        f.attrs["img_size"] = model.input_shape[1:]
+        f.attrs["video_path"] = video_path
+        f.attrs["tracking_path"] = tracking_path
+        f.attrs["start_frame"] = start_frame
+        f.attrs["model_path"] = model_path
+        f.attrs["weights_path"] = weights_path
+        f.attrs["model_name"] = os.path.basename(model_path)
+        f.attrs["output_stride"] = output_stride
+
+        save_predictions(f, Ypk)
+
+        ds_tracked = f.create_dataset("tracked", data=tracked[start_frame:start_frame + num_samples].astype("uint8"))
+        ds_tracked.attrs["description"] = "1 if the frame had a centroid and orientation to crop at, 0 if a blank box was used"
+
+        total_runtime = time() - t0_all
+        f.attrs["total_runtime_secs"] = total_runtime
+        f.attrs["prediction_runtime_secs"] = prediction_runtime
+
+    if verbose:
+        print("Saved [%.1fs]" % (time() - t0))
+
+        print("Total runtime: %.1f mins" % (total_runtime / 60))
+        print("Total performance: %.3f FPS" % (num_samples / total_runtime))
+
+
+if __name__ == "__main__":
+    clize.run(predict_video)
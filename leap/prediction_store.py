@@ -0,0 +1,302 @@
+import numpy as np
+import h5py
+import os
+import csv
+from glob import glob
+from time import time
+import clize
+
+
+def _decode(s):
+    return s.decode("utf8") if isinstance(s, bytes) else str(s)
+
+
+class PredictionStore:
+    """
+    Consolidated store of the predictions of many sessions (predict_box output files) in a single HDF5 file.
+
+    Predictions are stored as columnar arrays with a row per joint and the frames of all sessions concatenated along
+    the columns:
+
+        /x, /y: (joints, frames) int32 coordinates of the peaks
+        /conf: (joints, frames) float32 confidence map values at the peaks
+
+    Arrays are chunked along frames (chunk_frames per chunk), so a query for one joint over a frame range only reads
+    the chunks of that row that overlap the range. Sessions are indexed by name with the range of store frames they
+    occupy (/sessions/offsets, frames offsets[i] to offsets[i + 1]), and the minimum, maximum and mean confidence of
+    every chunk of every joint is kept in /chunk_conf_* (joints, chunks) so that confidence filters skip chunks
+    without reading them.
+    """
+
+    def __init__(self, store_path, mode="r"):
+        """
+        :param store_path: path to the store HDF5 file
+        :param mode: h5py file mode ("r" to query, "a" to ingest)
+        """
+        self.store_path = store_path
+        self.f = h5py.File(store_path, mode)
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def num_joints(self):
+        return self.f["conf"].shape[0] if "conf" in self.f else 0
+
+    @property
+    def num_frames(self):
+        return self.f["conf"].shape[1] if "conf" in self.f else 0
+
+    @property
+    def chunk_frames(self):
+        return int(self.f.attrs["chunk_frames"])
+
+    @property
+    def sessions(self):
+        """ Names of the sessions in the order they were ingested. """
+        if "sessions" not in self.f:
+            return []
+        return [_decode(s) for s in self.f["sessions/names"][()]]
+
+    def session_range(self, session):
+        """ Returns the range of store frames (start, end) of a session given by name or index. """
+        i = self.sessions.index(session) if isinstance(session, str) else session
+        offsets = self.f["sessions/offsets"]
+        return int(offsets[i]), int(offsets[i + 1])
+
+    def _create(self, num_joints, chunk_frames):
+        self.f.attrs["chunk_frames"] = chunk_frames
+        for name, dtype in [("x", "int32"), ("y", "int32"), ("conf", "float32")]:
+            ds = self.f.create_dataset(name, shape=(num_joints, 0), maxshape=(num_joints, None), dtype=dtype,
+                                       chunks=(1, chunk_frames), compression="lzf")
+            ds.attrs["dims"] = "(joint, frame)"
+        for name in ["min", "max", "mean"]:
+            self.f.create_dataset("chunk_conf_" + name, shape=(num_joints, 0), maxshape=(num_joints, None), dtype="float32",
+                                  chunks=(num_joints, 1024))
+
+        sessions = self.f.create_group("sessions")
+        str_dtype = h5py.special_dtype(vlen=str)
+        for name in ["names", "pred_paths", "box_paths"]:
+            sessions.create_dataset(name, shape=(0,), maxshape=(None,), dtype=str_dtype, chunks=(1024,))
+        for name in ["box_start_frames"]:
+            sessions.create_dataset(name, shape=(0,), maxshape=(None,), dtype="int64", chunks=(1024,))
+        sessions.create_dataset("offsets", data=np.zeros(1, dtype="int64"), maxshape=(None,), chunks=(1024,))
+
+    def add_session(self, name, positions, conf, pred_path="", box_path="", box_start_frame=0, chunk_frames=4096):
+        """
+        Appends the predictions of a session and updates the confidence summaries of the chunks it touches.
+
+        :param name: unique name of the session
+        :param positions: (frames, [x, y], joints) peak coordinates
+        :param conf: (frames, joints) confidence map values at the peaks
+        :param pred_path: path of the prediction file the session was read from
+        :param box_path: path of the box file the predictions were made on
+        :param box_start_frame: index of the box frame of the first prediction
+        :param chunk_frames: number of frames per chunk (only used when creating the store)
+        """
+        if "conf" not in self.f:
+            self._create(positions.shape[-1], chunk_frames)
+        if positions.shape[-1] != self.num_joints:
+            raise ValueError("Session %s has %d joints, store has %d." % (name, positions.shape[-1], self.num_joints))
+
+        start, end = self.num_frames, self.num_frames + len(positions)
+        for key, data in [("x", positions[:, 0, :]), ("y", positions[:, 1, :]), ("conf", conf)]:
+            self.f[key].resize(end, axis=1)
+            self.f[key][:, start:end] = data.T
+
+        sessions = self.f["sessions"]
+        i = len(sessions["names"])
+        for key, value in [("names", name), ("pred_paths", pred_path), ("box_paths", box_path),
+                           ("box_start_frames", box_start_frame)]:
+            sessions[key].resize(i + 1, axis=0)
+            sessions[key][i] = value
+        sessions["offsets"].resize(i + 2, axis=0)
+        sessions["offsets"][i + 1] = end
+
+        self._update_summaries(start, end)
+
+    def _update_summaries(self, start, end):
+        """ Recomputes the confidence summaries of the chunks overlapping frames start to end. """
+        chunk_frames = self.chunk_frames
+        first, last = start // chunk_frames, (end + chunk_frames - 1) // chunk_frames
+        conf = self.f["conf"][:, first * chunk_frames:end]
+        pad = (last - first) * chunk_frames - conf.shape[1]
+        conf = np.pad(conf, ((0, 0), (0, pad)), mode="constant", constant_values=np.nan)
+        conf = conf.reshape(conf.shape[0], last - first, chunk_frames)
+
+        for name, fn in [("min", np.nanmin), ("max", np.nanmax), ("mean", np.nanmean)]:
+            ds = self.f["chunk_conf_" + name]
+            ds.resize(last, axis=1)
+            ds[:, first:last] = fn(conf, axis=2)
+
+    def _frame_ranges(self, sessions=None, start=0, end=None):
+        """ Returns (session index, store start, store end) of the frames of sessions (all by default) to query. """
+        names = self.sessions
+        idx = range(len(names)) if sessions is None else [names.index(s) if isinstance(s, str) else s for s in sessions]
+        ranges = []
+        for i in idx:
+            s, e = self.session_range(i)
+            s, e = s + start, e if end is None else min(e, s + end)
+            if e > s:
+                ranges.append((i, s, e))
+        return ranges
+
+    def read(self, session, start=0, end=None, joints=None):
+        """
+        Reads the predictions of a frame range of a session.
+
+        :param session: session name or index
+        :param start: first frame of the session to read
+        :param end: frame to stop reading at (exclusive). Defaults to the end of the session.
+        :param joints: list of joint indices to read (default: all)
+        :return: positions (frames, [x, y], joints), conf (frames, joints)
+        """
+        ranges = self._frame_ranges([session], start=start, end=end)
+        num_joints = self.num_joints if joints is None else len(joints)
+        if len(ranges) == 0:
+            return np.zeros((0, 2, num_joints), dtype="int32"), np.zeros((0, num_joints), dtype="float32")
+        _, s, e = ranges[0]
+
+        if joints is None:
+            x, y, conf = [self.f[key][:, s:e] for key in ["x", "y", "conf"]]
+        else:
+            # HDF5 fancy indexing requires increasing indices
+            order = np.argsort(joints)
+            rows = [int(j) for j in np.asarray(joints)[order]]
+            x, y, conf = [self.f[key][rows, s:e][np.argsort(order)] for key in ["x", "y", "conf"]]
+        return np.stack([x.T, y.T], axis=1), conf.T
+
+    def query(self, joint, min_conf=None, max_conf=None, sessions=None, start=0, end=None):
+        """
+        Finds the frames where a joint was predicted with a confidence in a range.
+
+        Only the chunks of the joint that overlap the requested frames and whose confidence summary can satisfy the
+        filter are read.
+
+        :param joint: joint index
+        :param min_conf: keep frames with conf > min_conf
+        :param max_conf: keep frames with conf < max_conf
+        :param sessions: list of session names or indices (default: all)
+        :param start: first frame of each session to query
+        :param end: frame of each session to stop querying at (exclusive)
+        :return: dict with session (index), frame (within the session), x, y and conf arrays of the matching frames
+        """
+        chunk_frames = self.chunk_frames
+        chunk_min = self.f["chunk_conf_min"][joint]
+        chunk_max = self.f["chunk_conf_max"][joint]
+        offsets = self.f["sessions/offsets"][()]
+
+        results = {k: [] for k in ["session", "frame", "x", "y", "conf"]}
+        chunks_read = 0
+        for i, s, e in self._frame_ranges(sessions, start=start, end=end):
+            for c in range(s // chunk_frames, (e + chunk_frames - 1) // chunk_frames):
+                if min_conf is not None and not chunk_max[c] > min_conf:
+                    continue
+                if max_conf is not None and not chunk_min[c] < max_conf:
+                    continue
+                cs, ce = max(s, c * chunk_frames), min(e, (c + 1) * chunk_frames)
+                conf = self.f["conf"][joint, cs:ce]
+                chunks_read += 1
+                keep = np.ones(len(conf), dtype="bool")
+                if min_conf is not None:
+                    keep &= conf > min_conf
+                if max_conf is not None:
+                    keep &= conf < max_conf
+                if not np.any(keep):
+                    continue
+                frames = np.nonzero(keep)[0] + cs
+                results["session"].append(np.full(len(frames), i, dtype="int64"))
+                results["frame"].append(frames - offsets[i])
+                results["x"].append(self.f["x"][joint, cs:ce][keep])
+                results["y"].append(self.f["y"][joint, cs:ce][keep])
+                results["conf"].append(conf[keep])
+
+        results = {k: np.concatenate(v) if len(v) > 0 else np.zeros(0) for k, v in results.items()}
+        results["chunks_read"] = chunks_read
+        return results
+
+
+def ingest_predictions(store_path, *pred_paths, chunk_frames=4096, relative_to=None):
+    """
+    Adds predict_box output files to a consolidated prediction store (see PredictionStore).
+
+    Sessions are named after the prediction files (relative to relative_to if given). Files whose session is already
+    in the store are skipped, so ingestion can be rerun as new predictions are made.
+
+    :param store_path: path to the store HDF5 file (created if it does not exist)
+    :param pred_paths: paths or glob patterns of prediction files
+    :param chunk_frames: number of frames per chunk when creating the store
+    :param relative_to: folder to name sessions relative to (default: the paths as given)
+    """
+    t0 = time()
+    paths = []
+    for pattern in pred_paths:
+        paths.extend(sorted(glob(pattern)) if any(c in pattern for c in "*?[") else [pattern])
+
+    num_added, num_frames = 0, 0
+    with PredictionStore(store_path, mode="a") as store:
+        existing = set(store.sessions)
+        for path in paths:
+            name = os.path.splitext(os.path.relpath(path, relative_to) if relative_to is not None else path)[0]
+            if name in existing:
+                continue
+
+            with h5py.File(path, "r") as f:
+                if "positions_pred" not in f:
+                    print("Skipping %s: no predictions found." % path)
+                    continue
+                positions = f["positions_pred"][()]
+                if positions.ndim != 3:
+                    print("Skipping %s: multi-instance predictions are not supported." % path)
+                    continue
+                conf = f["conf_pred"][()].reshape(len(positions), -1)
+                box_path = _decode(f.attrs.get("box_path", ""))
+                box_start_frame = int(f.attrs.get("start_frame", 0))
+
+            store.add_session(name, positions, conf, pred_path=path, box_path=box_path, box_start_frame=box_start_frame,
+                              chunk_frames=chunk_frames)
+            existing.add(name)
+            num_added += 1
+            num_frames += len(positions)
+
+        print("Added %d sessions (%d frames) [%.1fs]" % (num_added, num_frames, time() - t0))
+        print("Store: %d sessions, %d frames, %d joints" % (len(store.sessions), store.num_frames, store.num_joints))
+
+
+def query_predictions(store_path, joint: int, *, min_conf: float = None, max_conf: float = None, sessions=None, out_path=None):
+    """
+    Prints or saves the frames where a joint was predicted with a confidence in a range.
+
+    :param store_path: path to the store HDF5 file
+    :param joint: joint index
+    :param min_conf: keep frames with conf > min_conf
+    :param max_conf: keep frames with conf < max_conf
+    :param sessions: comma-separated session names (default: all)
+    :param out_path: path to a CSV file to save the matches to
+    """
+    t0 = time()
+    with PredictionStore(store_path) as store:
+        names = store.sessions
+        results = store.query(joint, min_conf=min_conf, max_conf=max_conf,
+                              sessions=sessions.split(",") if sessions is not None else None)
+
+    print("Matches: %d frames in %d sessions (%d chunks read) [%.3fs]" % (
+        len(results["frame"]), len(np.unique(results["session"])), results["chunks_read"], time() - t0))
+
+    if out_path is not None:
+        with open(out_path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["session", "frame", "x", "y", "conf"])
+            for i, frame, x, y, conf in zip(results["session"], results["frame"], results["x"], results["y"], results["conf"]):
+                writer.writerow([names[int(i)], int(frame), int(x), int(y), float(conf)])
+        print("Saved:", out_path)
+
+
+if __name__ == "__main__":
+    clize.run(ingest_predictions, query_predictions)
@@ -0,0 +1,154 @@
+import numpy as np
+import h5py
+import os
+import tempfile
+from time import time
+import clize
+
+from leap.utils import check_chunk_layout
+
+
+def _compression_kwargs(compression, compression_opts=None):
+    """ Returns h5py dataset creation arguments for a compression filter name ("lzf", "gzip" or "none"). """
+    if compression in (None, "none"):
+        return {}
+    if compression == "gzip":
+        return dict(compression="gzip", compression_opts=1 if compression_opts is None else compression_opts)
+    return dict(compression=compression)
+
+
+def frame_chunks(shape, dtype, chunk_frames=0, target_chunk_bytes=1024 ** 2):
+    """ Returns frame-aligned chunks (frames, ...) for a dataset, with chunk_frames = 0 sized to ~target_chunk_bytes. """
+    frame_bytes = int(np.prod(shape[1:])) * np.dtype(dtype).itemsize
+    if chunk_frames <= 0:
+        chunk_frames = max(1, target_chunk_bytes // max(frame_bytes, 1))
+    return (int(min(chunk_frames, shape[0])),) + tuple(shape[1:])
+
+
+def rechunk(in_path, out_path, *, chunk_frames=0, compression="lzf", compression_opts: int = None, block_frames=1024, overwrite=False):
+    """
+    Rewrites a box or training file with frame-aligned chunks and a fast compression filter.
+
+    Datasets with frames along the first axis (the same length as the largest dataset) are rechunked. Other datasets,
+    groups and attributes are copied as they are.
+
+    :param in_path: path to the input HDF5 file
+    :param out_path: path to the output HDF5 file
+    :param chunk_frames: number of frames per chunk (0 = sized to ~1 MiB per chunk)
+    :param compression: compression filter ("lzf", "gzip" or "none")
+    :param compression_opts: compression level if using gzip (default: 1)
+    :param block_frames: number of frames to copy at a time
+    :param overwrite: if True and out_path exists, file will be overwritten
+    """
+    if os.path.exists(out_path):
+        if overwrite:
+            os.remove(out_path)
+            print("Deleted existing output.")
+        else:
+            print("Error: Output path already exists.")
+            return
+
+    t0 = time()
+    with h5py.File(in_path, "r") as f_in, h5py.File(out_path, "w") as f_out:
+        # Frame datasets are the ones with the largest first dimension
+        dsets = []
+        f_in.visititems(lambda name, obj: dsets.append(name) if isinstance(obj, h5py.Dataset) else None)
+        num_frames = max([f_in[name].shape[0] for name in dsets if f_in[name].ndim > 1] + [0])
+
+        for k, v in f_in.attrs.items():
+            f_out.attrs[k] = v
+
+        for name in dsets:
+            ds_in = f_in[name]
+            parent = os.path.dirname(name)
+            if parent != "" and parent not in f_out:
+                f_out.create_group(parent)
+                for k, v in f_in[parent].attrs.items():
+                    f_out[parent].attrs[k] = v
+
+            if ds_in.ndim > 1 and ds_in.shape[0] == num_frames and ds_in.dtype.kind in "uif":
+                chunks = frame_chunks(ds_in.shape, ds_in.dtype, chunk_frames=chunk_frames)
+                ds_out = f_out.create_dataset(name, shape=ds_in.shape, dtype=ds_in.dtype, chunks=chunks,
+                                              **_compression_kwargs(compression, compression_opts))
+                for start in range(0, num_frames, block_frames):
+                    ds_out[start:start + block_frames] = ds_in[start:start + block_frames]
+                print("%s: %s -> %s" % (ds_in.name, ds_in.chunks, chunks))
+            else:
+                f_in.copy(ds_in, f_out[parent] if parent != "" else f_out, name=os.path.basename(name))
+                ds_out = f_out[name]
+
+            for k, v in ds_in.attrs.items():
+                ds_out.attrs[k] = v
+
+    print("Saved: %s [%.1fs]" % (out_path, time() - t0))
+    print("Size: %.1f MiB -> %.1f MiB" % (os.path.getsize(in_path) / 1024 ** 2, os.path.getsize(out_path) / 1024 ** 2))
+
+
+def benchmark_read(data_path, dset="box", batch_size=32, num_batches=20):
+    """
+    Measures frame read throughput of a dataset for batched sequential and random access.
+
+    :return: dict with sequential_fps and random_fps (frames per second)
+    """
+    with h5py.File(data_path, "r") as f:
+        ds = f[dset]
+        num_frames = ds.shape[0]
+        starts = np.random.randint(0, max(num_frames - batch_size, 0) + 1, size=num_batches)
+
+        # Contiguous batches (predict_box)
+        t0 = time()
+        for start in starts:
+            ds[start:start + batch_size]
+        sequential_fps = num_batches * min(batch_size, num_frames) / (time() - t0)
+
+        # Randomly sampled frames (training subsets)
+        t0 = time()
+        for _ in range(num_batches):
+            ds[np.sort(np.random.choice(num_frames, min(batch_size, num_frames), replace=False))]
+        random_fps = num_batches * min(batch_size, num_frames) / (time() - t0)
+
+    return dict(sequential_fps=sequential_fps, random_fps=random_fps)
+
+
+def benchmark_layouts(data_path, *, dset="box", max_frames=2048, batch_size=32, num_batches=20):
+    """
+    Compares read throughput of a dataset stored with different chunk layouts and compression filters.
+
+    A copy of up to max_frames frames is written with each layout to a temporary folder.
+
+    :param data_path: path to HDF5 file with the dataset
+    :param dset: name of the dataset with frames along the first axis
+    :param max_frames: maximum number of frames to copy for the benchmark
+    :param batch_size: number of frames per read
+    :param num_batches: number of reads per measurement
+    """
+    with h5py.File(data_path, "r") as f:
+        check_chunk_layout(f[dset])
+        X = f[dset][:max_frames]
+        original_chunks = f[dset].chunks
+        original_compression = f[dset].compression
+
+    frame_chunk = frame_chunks(X.shape, X.dtype)
+    layouts = [
+        ("original", original_chunks, original_compression),
+        ("contiguous", None, None),
+        ("frame/lzf", frame_chunk, "lzf"),
+        ("frame/gzip", frame_chunk, "gzip"),
+        ("single frame/gzip", (1,) + X.shape[1:], "gzip"),
+        ("row/gzip", (1,) * (X.ndim - 1) + X.shape[-1:], "gzip"),
+        ("whole/gzip", X.shape, "gzip"),
+    ]
+
+    print("%-20s %-24s %12s %12s %10s" % ("Layout", "Chunks", "Seq. FPS", "Random FPS", "MiB"))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for i, (name, chunks, compression) in enumerate(layouts):
+            tmp_path = os.path.join(tmp_dir, "layout_%d.h5" % i)
+            with h5py.File(tmp_path, "w") as f:
+                f.create_dataset("data", data=X, chunks=chunks, **_compression_kwargs(compression))
+            fps = benchmark_read(tmp_path, dset="data", batch_size=batch_size, num_batches=num_batches)
+            print("%-20s %-24s %12.1f %12.1f %10.1f" % (name, chunks, fps["sequential_fps"], fps["random_fps"],
+                                                         os.path.getsize(tmp_path) / 1024 ** 2))
+
+
+if __name__ == "__main__":
+    clize.run(rechunk, benchmark_layouts)
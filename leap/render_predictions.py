@@ -0,0 +1,218 @@
+import numpy as np
+import h5py
+import os
+import shutil
+import subprocess
+import multiprocessing
+from time import time
+import cv2
+import clize
+
+from leap.utils import find_skeleton_edges
+
+
+def confidence_colors(conf, colormap=cv2.COLORMAP_JET):
+    """ Maps confidence values in [0, 1] to BGR colors (..., 3) with an OpenCV colormap. """
+    lut = cv2.applyColorMap(np.arange(256, dtype="uint8")[:, None], colormap)[:, 0, :]
+    return lut[np.round(np.clip(np.nan_to_num(conf), 0, 1) * 255).astype("uint8")]
+
+
+def load_frames(box, start, end):
+    """ Reads frames from a box dataset (frames, channels, width, height) as BGR images (frames, height, width, 3). """
+    X = np.transpose(box[start:end], (0, 3, 2, 1))
+    if X.dtype != "uint8":
+        X = np.clip(X * 255 if X.max() <= 1 else X, 0, 255).astype("uint8")
+    if X.shape[-1] == 1:
+        X = np.repeat(X, 3, axis=-1)
+    return np.ascontiguousarray(X)
+
+
+def draw_predictions(frames, positions, conf, edges=None, scale=1, marker_size=2, edge_color=(255, 255, 255)):
+    """
+    Draws skeletons and joint markers colored by confidence on a batch of frames.
+
+    Markers are stamped on all frames at once with array indexing, and the edges of each frame are drawn with a single
+    polylines call.
+
+    :param frames: BGR images (frames, height, width, 3) as uint8
+    :param positions: (frames, [instances,] [x, y], joints) in image coordinates (negative or NaN if missing)
+    :param conf: (frames, [instances,] joints) confidence map values at the peaks
+    :param edges: (edges, [src, dst]) as 0-based joint indices
+    :param scale: factor to upscale frames by before drawing
+    :param marker_size: radius of the joint markers in pixels (after scaling)
+    :param edge_color: BGR color of the skeleton edges
+    :return: frames with overlays (frames, height * scale, width * scale, 3)
+    """
+    if positions.ndim == 3:
+        positions, conf = positions[:, None], conf[:, None]
+    num_frames, num_instances = positions.shape[:2]
+
+    if scale != 1:
+        frames = np.repeat(np.repeat(frames, scale, axis=1), scale, axis=2)
+    else:
+        frames = frames.copy()
+    height, width = frames.shape[1:3]
+
+    # Joint centers in output pixels: (frames, instances, joints)
+    centers = (positions[:, :, :2, :] + 0.5) * scale - 0.5
+    centers = np.where(np.isnan(centers), -1, centers).round().astype("int64")
+    x, y = centers[:, :, 0, :], centers[:, :, 1, :]
+    visible = (positions[:, :, 0, :] >= 0) & (positions[:, :, 1, :] >= 0) & ~np.isnan(positions[:, :, 0, :])
+
+    # Skeleton edges
+    if edges is not None and len(edges) > 0:
+        for i in range(num_frames):
+            lines = []
+            for j in range(num_instances):
+                for src, dst in edges:
+                    if visible[i, j, src] and visible[i, j, dst]:
+                        lines.append(np.array([[x[i, j, src], y[i, j, src]], [x[i, j, dst], y[i, j, dst]]], dtype="int32"))
+            if len(lines) > 0:
+                cv2.polylines(frames[i], lines, False, edge_color, thickness=max(1, scale // 2), lineType=cv2.LINE_AA)
+
+    # Markers: disk offsets added to every visible joint
+    r = marker_size
+    dy, dx = np.mgrid[-r:r + 1, -r:r + 1]
+    disk = dx ** 2 + dy ** 2 <= r ** 2
+    dx, dy = dx[disk], dy[disk]
+
+    n, inst, joint = np.nonzero(visible)
+    colors = confidence_colors(conf[n, inst, joint])
+    px = x[n, inst, joint][:, None] + dx[None, :]
+    py = y[n, inst, joint][:, None] + dy[None, :]
+    inside = (px >= 0) & (px < width) & (py >= 0) & (py < height)
+    frames[np.broadcast_to(n[:, None], px.shape)[inside], py[inside], px[inside]] = np.broadcast_to(colors[:, None, :], px.shape + (3,))[inside]
+
+    return frames
+
+
+def _render_segment(box_path, box_dset, pred_path, edges, out_path, start, end, batch_size, scale, marker_size, fps,
+                    fourcc, show_frame_idx):
+    """ Renders a range of predictions (indices into the prediction file) to a video file. """
+    cv2.setNumThreads(1)
+    with h5py.File(box_path, "r") as f_box, h5py.File(pred_path, "r") as f_pred:
+        box = f_box[box_dset]
+        box_start = int(f_pred.attrs.get("start_frame", 0))
+        writer = None
+        for batch_start in range(start, end, batch_size):
+            batch_end = min(batch_start + batch_size, end)
+            frames = load_frames(box, box_start + batch_start, box_start + batch_end)
+            positions = f_pred["positions_pred"][batch_start:batch_end].astype("float32")
+            conf = f_pred["conf_pred"][batch_start:batch_end].reshape(positions.shape[:-2] + positions.shape[-1:])
+            frames = draw_predictions(frames, positions, conf, edges=edges, scale=scale, marker_size=marker_size)
+
+            if writer is None:
+                writer = cv2.VideoWriter(out_path, cv2.VideoWriter_fourcc(*fourcc), fps, (frames.shape[2], frames.shape[1]))
+            for i, frame in enumerate(frames):
+                if show_frame_idx:
+                    cv2.putText(frame, str(box_start + batch_start + i), (4, 14), cv2.FONT_HERSHEY_SIMPLEX, 0.4,
+                                (255, 255, 255), 1, cv2.LINE_AA)
+                writer.write(frame)
+        if writer is not None:
+            writer.release()
+
+
+def concat_videos(part_paths, out_path):
+    """ Joins video files with ffmpeg (without re-encoding) or by re-encoding with OpenCV if ffmpeg is not available. """
+    if shutil.which("ffmpeg") is not None:
+        list_path = out_path + ".txt"
+        with open(list_path, "w") as f:
+            f.writelines("file '%s'\n" % os.path.abspath(p) for p in part_paths)
+        subprocess.run(["ffmpeg", "-y", "-loglevel", "error", "-f", "concat", "-safe", "0", "-i", list_path, "-c", "copy",
+                        out_path], check=True)
+        os.remove(list_path)
+        return
+
+    writer = None
+    for part_path in part_paths:
+        reader = cv2.VideoCapture(part_path)
+        if writer is None:
+            fourcc = int(reader.get(cv2.CAP_PROP_FOURCC))
+            size = (int(reader.get(cv2.CAP_PROP_FRAME_WIDTH)), int(reader.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+            writer = cv2.VideoWriter(out_path, fourcc, reader.get(cv2.CAP_PROP_FPS), size)
+        while True:
+            ok, frame = reader.read()
+            if not ok:
+                break
+            writer.write(frame)
+        reader.release()
+    if writer is not None:
+        writer.release()
+
+
+def render_predictions(box_path, pred_path, out_path, *, box_dset="/box", skeleton_path=None, start=0, end: int = None,
+                       workers=4, segment_frames=1000, batch_size=64, scale=2, marker_size=2, fps=30.0, fourcc="mp4v",
+                       show_frame_idx=True, keep_segments=False, overwrite=False):
+    """
+    Renders a video of the predictions of predict_box overlaid on the box images, without re-running the model.
+
+    Joint markers are colored by their confidence (conf_pred) from blue (low) to red (high), and the skeleton edges
+    are drawn between them. Predictions are split into segments that are rendered and encoded by worker processes in
+    parallel, each streaming its frames to a video file. Segments are joined at the end (with ffmpeg if available).
+
+    :param box_path: path to HDF5 file with box dataset
+    :param pred_path: path to HDF5 file with predictions (see predict_box)
+    :param out_path: path to the output video file
+    :param box_dset: name of HDF5 dataset containing box images
+    :param skeleton_path: path to HDF5 file with a skeleton group to draw edges. Defaults to the training set of the
+        model that made the predictions. If not found, only joints are drawn.
+    :param start: first prediction to render (index into the prediction file)
+    :param end: prediction to stop rendering at (exclusive). Defaults to all.
+    :param workers: number of processes rendering segments in parallel
+    :param segment_frames: number of frames per segment
+    :param batch_size: number of frames to read and draw at a time
+    :param scale: integer factor to upscale the frames by
+    :param marker_size: radius of the joint markers in pixels (after scaling)
+    :param fps: frame rate of the output video
+    :param fourcc: four character code of the video codec
+    :param show_frame_idx: if True, draws the box frame index on each frame
+    :param keep_segments: if True, does not delete the segment files after joining them
+    :param overwrite: if True and out_path exists, file will be overwritten
+    """
+    t0 = time()
+    if os.path.exists(out_path):
+        if overwrite:
+            os.remove(out_path)
+            print("Deleted existing output.")
+        else:
+            print("Error: Output path already exists.")
+            return
+
+    with h5py.File(pred_path, "r") as f:
+        num_preds = f["positions_pred"].shape[0]
+        model_path = f.attrs.get("model_path", "")
+        if isinstance(model_path, bytes):
+            model_path = model_path.decode()
+    end = num_preds if end is None else min(end, num_preds)
+
+    edges = find_skeleton_edges(str(model_path), skeleton_path)
+    if edges is None:
+        print("Warning: Skeleton not found, only drawing joints.")
+
+    # Segments are rendered to files next to the output
+    segments_dir = out_path + ".segments"
+    os.makedirs(segments_dir, exist_ok=True)
+    ext = os.path.splitext(out_path)[1] or ".mp4"
+    segments = [(s, min(s + segment_frames, end)) for s in range(start, end, segment_frames)]
+    part_paths = [os.path.join(segments_dir, "%06d-%06d%s" % (s, e, ext)) for s, e in segments]
+    print("Rendering %d frames in %d segments with %d workers..." % (end - start, len(segments), workers))
+
+    ctx = multiprocessing.get_context("spawn")
+    with ctx.Pool(workers) as pool:
+        results = [pool.apply_async(_render_segment, (box_path, box_dset, pred_path, edges, part_path, s, e, batch_size,
+                                                      scale, marker_size, fps, fourcc, show_frame_idx))
+                   for (s, e), part_path in zip(segments, part_paths)]
+        for i, result in enumerate(results):
+            result.get()
+            print("Rendered segment %d/%d [%.1fs]" % (i + 1, len(segments), time() - t0))
+
+    concat_videos(part_paths, out_path)
+    if not keep_segments:
+        shutil.rmtree(segments_dir, ignore_errors=True)
+
+    print("Saved:", out_path)
+    print("Total runtime: %.1f secs (%.1f FPS)" % (time() - t0, (end - start) / (time() - t0)))
+
+
+if __name__ == "__main__":
+    clize.run(render_predictions)
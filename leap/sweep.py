@@ -0,0 +1,220 @@
+import numpy as np
+import os
+import sys
+import ast
+import csv
+import inspect
+import itertools
+import multiprocessing
+import traceback
+from time import time, sleep
+import clize
+import keras
+
+from leap.cache import load_cached_split
+from leap.utils import configure_threads
+
+
+def parse_grid(specs):
+    """
+    Parses parameter grid specifications of the form "name=value1,value2,...".
+
+    Values are parsed as Python literals if possible (e.g., 64, 0.1, True) and kept as strings otherwise.
+
+    :param specs: list of specification strings
+    :return: dict mapping parameter names to lists of values
+    """
+    def parse_value(value):
+        try:
+            return ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            return value
+
+    grid = {}
+    for spec in specs:
+        name, values = spec.split("=", 1)
+        grid[name.strip()] = [parse_value(v.strip()) for v in values.split(",")]
+    return grid
+
+
+def expand_grid(grid):
+    """ Returns the list of parameter dicts for every combination of values in a grid. """
+    names = sorted(grid.keys())
+    return [dict(zip(names, values)) for values in itertools.product(*[grid[name] for name in names])]
+
+
+class MedianPruner(keras.callbacks.Callback):
+    """
+    Stops a trial whose best val_loss so far is worse than the median of the other trials at the same epoch.
+
+    Validation curves of all trials are shared through a multiprocessing.Manager dict.
+    """
+
+    def __init__(self, trial_id, curves, warmup_epochs=5, min_trials=3):
+        super().__init__()
+        self.trial_id = trial_id
+        self.curves = curves
+        self.warmup_epochs = warmup_epochs
+        self.min_trials = min_trials
+        self.pruned = False
+
+    def on_epoch_end(self, epoch, logs={}):
+        curve = list(self.curves.get(self.trial_id, [])) + [float(logs["val_loss"])]
+        self.curves[self.trial_id] = curve # reassign so that the manager sees the update
+
+        if epoch + 1 < self.warmup_epochs:
+            return
+
+        others = [min(c[:epoch + 1]) for k, c in self.curves.items() if k != self.trial_id and len(c) > epoch]
+        if len(others) >= self.min_trials and min(curve) > np.median(others):
+            print("Pruned: best val_loss %g > median %g of %d trials at epoch %d." % (min(curve), np.median(others), len(others), epoch + 1))
+            self.pruned = True
+            self.model.stop_training = True
+
+
+def _run_trial(trial_id, params, data_path, base_output_path, cache_dir, threads, cores, curves, results, prune_kwargs):
+    """ Runs a single training trial in a worker process. """
+    from leap.training import train
+
+    t0 = time()
+    log_path = os.path.join(base_output_path, "logs", trial_id + ".log")
+    sys.stdout = sys.stderr = open(log_path, "w", buffering=1)
+
+    # Pin threads (and cores if possible) so that concurrent trials do not oversubscribe the CPU
+    configure_threads(threads, cores=cores)
+
+    pruner = MedianPruner(trial_id, curves, **prune_kwargs)
+    try:
+        train(data_path, base_output_path=base_output_path, run_name=trial_id, clean=True, cache_dir=cache_dir,
+              callbacks=[pruner], **params)
+        status = "pruned" if pruner.pruned else "completed"
+    except Exception:
+        traceback.print_exc()
+        status = "failed"
+
+    curve = list(curves.get(trial_id, []))
+    results[trial_id] = dict(status=status, epochs=len(curve), runtime_secs=time() - t0,
+                             best_val_loss=min(curve) if len(curve) > 0 else np.nan,
+                             best_epoch=int(np.argmin(curve)) + 1 if len(curve) > 0 else 0)
+
+
+def write_results(results_path, trials, results, base_output_path):
+    """ Writes a CSV table with the parameters and results of each trial, sorted by best val_loss. """
+    param_names = sorted(set(itertools.chain(*[params.keys() for params in trials.values()])))
+    fields = ["trial", "status", "best_val_loss", "best_epoch", "epochs", "runtime_secs"]
+
+    rows = []
+    for trial_id, params in trials.items():
+        result = results.get(trial_id, dict(status="not run"))
+        rows.append(dict(result, trial=trial_id, run_path=os.path.join(base_output_path, trial_id),
+                         **{name: params.get(name, "") for name in param_names}))
+    rows = sorted(rows, key=lambda row: np.inf if np.isnan(row.get("best_val_loss", np.nan)) else row["best_val_loss"])
+
+    with open(results_path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=fields + param_names + ["run_path"], extrasaction="ignore")
+        writer.writeheader()
+        writer.writerows(rows)
+
+    return rows
+
+
+def sweep(data_path, *grid_specs, sweep_name="sweep", base_output_path="models", workers=2, threads=0,
+          cache_dir=None, prune=True, prune_warmup_epochs=5, prune_min_trials=3, poll_secs=1.0):
+    """
+    Runs a grid of training trials concurrently in worker processes.
+
+    Parameters of training.train are given as "name=value1,value2,..." (e.g., filters=32,64 net_name=leap_cnn,hourglass
+    reduce_lr_factor=0.1,0.5 epochs=30). Every combination is trained once. The preprocessed datasets are cached as
+    memory-mapped arrays before the trials start, so all workers share a single read-only copy in memory. Trials are
+    split with seed=0 unless specified, so they are evaluated on the same validation set.
+
+    Trials are saved under base_output_path/sweep_name along with their logs and a results.csv table.
+
+    :param data_path: path to an HDF5 file with box and confmaps datasets
+    :param grid_specs: parameter values to sweep over as "name=value1,value2,..."
+    :param sweep_name: name of the subfolder of base_output_path to save the trials in
+    :param base_output_path: path to folder in which the sweep folder will be saved
+    :param workers: number of trials to run at a time
+    :param threads: number of threads per trial (0 = split the CPU cores evenly between workers)
+    :param cache_dir: path to a folder for the shared preprocessed datasets. Defaults to /dev/shm if available.
+    :param prune: stop trials early whose val_loss is worse than the median of the other trials at the same epoch
+    :param prune_warmup_epochs: number of epochs before a trial can be pruned
+    :param prune_min_trials: minimum number of other trials at the same epoch required to prune
+    :param poll_secs: interval at which finished workers are checked for
+    """
+    from leap.training import train
+
+    t0 = time()
+    grid = parse_grid(grid_specs)
+    grid.setdefault("seed", [0])
+    trials = {"trial_%03d" % i: params for i, params in enumerate(expand_grid(grid))}
+    print("Trials: %d" % len(trials))
+    for name, values in grid.items():
+        print("    %s: %s" % (name, values))
+
+    sweep_path = os.path.join(base_output_path, sweep_name)
+    os.makedirs(os.path.join(sweep_path, "logs"), exist_ok=True)
+
+    # Threads and cores per worker
+    num_cpus = os.cpu_count() or 1
+    if threads <= 0:
+        threads = max(1, num_cpus // workers)
+    os.environ["OMP_NUM_THREADS"] = str(threads)
+    os.environ["MKL_NUM_THREADS"] = str(threads)
+    print("Workers: %d x %d threads" % (workers, threads))
+
+    # Preprocess each distinct dataset split once
+    if cache_dir is None:
+        cache_dir = os.path.join("/dev/shm", "leap_cache") if os.path.isdir("/dev/shm") else os.path.join(sweep_path, "cache")
+    defaults = {k: v.default for k, v in inspect.signature(train).parameters.items() if v.default is not inspect.Parameter.empty}
+    split_keys = ["box_dset", "confmap_dset", "val_size", "preshuffle", "seed", "output_stride"]
+    splits = set(tuple(params.get(k, defaults[k]) for k in split_keys) for params in trials.values())
+    for split in splits:
+        split = dict(zip(split_keys, split))
+        load_cached_split(cache_dir, data_path, X_dset=split["box_dset"], Y_dset=split["confmap_dset"],
+                          val_size=split["val_size"], shuffle=split["preshuffle"], seed=split["seed"],
+                          output_stride=split["output_stride"])
+
+    # Schedule trials
+    ctx = multiprocessing.get_context("spawn")
+    manager = ctx.Manager()
+    curves, results = manager.dict(), manager.dict()
+    prune_kwargs = dict(warmup_epochs=prune_warmup_epochs if prune else np.inf, min_trials=prune_min_trials)
+
+    pending = list(trials.items())
+    running = {}
+    free_slots = list(range(workers))
+    while len(pending) > 0 or len(running) > 0:
+        for slot, (trial_id, p) in list(running.items()):
+            if not p.is_alive():
+                p.join()
+                del running[slot]
+                free_slots.append(slot)
+                result = results.get(trial_id, dict(status="failed", best_val_loss=np.nan, epochs=0))
+                print("[%.1f mins] %s %s: best val_loss = %g (%d epochs)" % ((time() - t0) / 60, trial_id, result["status"],
+                                                                            result["best_val_loss"], result["epochs"]))
+
+        while len(pending) > 0 and len(free_slots) > 0:
+            trial_id, params = pending.pop(0)
+            slot = free_slots.pop(0)
+            cores = list(range(slot * threads, (slot + 1) * threads)) if (slot + 1) * threads <= num_cpus else None
+            p = ctx.Process(target=_run_trial, args=(trial_id, params, data_path, sweep_path, cache_dir, threads, cores,
+                                                     curves, results, prune_kwargs))
+            p.start()
+            running[slot] = (trial_id, p)
+            print("[%.1f mins] %s started: %s" % ((time() - t0) / 60, trial_id, params))
+
+        sleep(poll_secs)
+
+    # Results table
+    results_path = os.path.join(sweep_path, "results.csv")
+    rows = write_results(results_path, trials, dict(results), sweep_path)
+    print("%-10s %-10s %14s %6s" % ("Trial", "Status", "Best val_loss", "Epoch"))
+    for row in rows:
+        print("%-10s %-10s %14g %6d" % (row["trial"], row["status"], row.get("best_val_loss", np.nan), row.get("best_epoch", 0)))
+    print("Saved:", results_path)
+    print("Total runtime: %.1f mins" % ((time() - t0) / 60))
+
+
+if __name__ == "__main__":
+    clize.run(sweep)
@@ -0,0 +1,283 @@
+import numpy as np
+import h5py
+import os
+from time import time
+from datetime import datetime
+import clize
+
+from leap.generate_training_set import render_confmaps, render_pafs, _write_mat_attrs
+from leap.rechunk import _compression_kwargs
+
+
+def make_skeleton(num_joints=32):
+    """
+    Builds a skeleton with a chain of midline joints and pairs of left/right legs attached to the middle of the chain.
+
+    Legs are named legL1/legR1, legL2/legR2, ... so that they are found by utils.find_symmetric_pairs for mirroring.
+
+    :param num_joints: total number of joints (at least 2)
+    :return: dict with joint names, edges (edges, [src, dst]) as 0-based joint indices and default joint positions
+    (joints, [x, y]) relative to the body center in units of body length
+    """
+    num_legs = (num_joints - 3) // 2 if num_joints >= 5 else 0
+    num_midline = num_joints - 2 * num_legs
+
+    joint_names = ["body%d" % i for i in range(num_midline)]
+    edges = [(i, i + 1) for i in range(num_midline - 1)]
+    pos = [(0.5 - i / max(num_midline - 1, 1), 0) for i in range(num_midline)]
+
+    attach = num_midline // 2
+    for leg in range(num_legs):
+        x = pos[attach][0] + 0.25 * (leg / max(num_legs - 1, 1) - 0.5)
+        for side, sign in [("L", -1), ("R", 1)]:
+            edges.append((attach, len(joint_names)))
+            joint_names.append("leg%s%d" % (side, leg + 1))
+            pos.append((x, sign * 0.3))
+
+    return dict(joint_names=joint_names, edges=np.array(edges, dtype="int64").reshape(-1, 2),
+                pos=np.array(pos, dtype="float32"))
+
+
+def synthetic_poses(num_frames, skeleton, img_size, rng, body_length=0.5, jitter=0.02):
+    """
+    Generates smoothly moving poses of a skeleton centered in egocentric (aligned) boxes.
+
+    The body drifts around the box center and sways slightly, and each leg swings with its own frequency and phase.
+
+    :param num_frames: number of frames
+    :param skeleton: skeleton from make_skeleton
+    :param img_size: (height, width) of the boxes
+    :param rng: numpy RandomState
+    :param body_length: length of the body as a fraction of the box width
+    :param jitter: standard deviation of per-frame joint noise as a fraction of the box width
+    :return: points (frames, joints, [x, y]) in 0-based image coordinates
+    """
+    height, width = img_size
+    t = np.arange(num_frames, dtype="float32")[:, None]
+    scale = body_length * width
+    pos = skeleton["pos"] * scale
+
+    # Legs swing back and forth around their default positions
+    is_leg = np.array([name.startswith("leg") for name in skeleton["joint_names"]])
+    freq = rng.uniform(0.05, 0.2, size=len(pos)).astype("float32")
+    phase = rng.uniform(0, 2 * np.pi, size=len(pos)).astype("float32")
+    dx = is_leg * 0.1 * scale * np.sin(freq * t + phase)
+    points = np.stack([pos[:, 0] + dx, np.broadcast_to(pos[:, 1], dx.shape)], axis=-1)
+
+    # Small rotation and translation of the whole body
+    theta = 0.1 * np.sin(0.01 * t + rng.uniform(0, 2 * np.pi))
+    cos, sin = np.cos(theta), np.sin(theta)
+    x = cos * points[..., 0] - sin * points[..., 1]
+    y = sin * points[..., 0] + cos * points[..., 1]
+    center = 0.05 * np.array([width, height], dtype="float32") * np.sin(0.02 * t[..., None] + rng.uniform(0, 2 * np.pi, size=2))
+    points = np.stack([x, y], axis=-1) + center + np.array([width / 2, height / 2], dtype="float32")
+    points += rng.normal(scale=jitter * width, size=points.shape)
+
+    return points.astype("float32")
+
+
+def render_images(points, edges, img_size, rng, channels=1, blob_size=None, points_per_edge=4, noise=0.05):
+    """
+    Renders blob images of poses: a Gaussian blob at every joint and along every edge over a noisy background.
+
+    Blobs are separable Gaussians, so images are built as sums of outer products of 1D profiles for all frames at once.
+
+    :param points: (frames, joints, [x, y]) in 0-based image coordinates
+    :param edges: (edges, [src, dst]) as 0-based joint indices
+    :param img_size: (height, width) of the images
+    :param rng: numpy RandomState
+    :param channels: number of image channels (copies of the same image)
+    :param blob_size: standard deviation of the blobs in pixels (default: 1/48 of the width)
+    :param points_per_edge: number of blobs drawn along each edge between its joints
+    :param noise: standard deviation of the background noise (images are in [0, 1] before conversion)
+    :return: images (frames, height, width, channels) as uint8
+    """
+    height, width = img_size
+    blob_size = width / 48 if blob_size is None else blob_size
+
+    # Blob centers: joints and points interpolated along edges
+    centers = [points]
+    if len(edges) > 0:
+        w = (np.arange(1, points_per_edge + 1) / (points_per_edge + 1)).astype("float32")[None, None, :, None]
+        src, dst = points[:, edges[:, 0], None, :], points[:, edges[:, 1], None, :]
+        centers.append((src + w * (dst - src)).reshape(len(points), -1, 2))
+    centers = np.concatenate(centers, axis=1)
+
+    gx = np.exp(-(np.arange(width, dtype="float32")[None, None, :] - centers[..., 0:1]) ** 2 / (2 * blob_size ** 2))
+    gy = np.exp(-(np.arange(height, dtype="float32")[None, None, :] - centers[..., 1:2]) ** 2 / (2 * blob_size ** 2))
+    images = np.minimum(np.einsum("nph,npw->nhw", gy, gx), 1)
+
+    images = 0.1 + 0.8 * images + rng.normal(scale=noise, size=images.shape)
+    images = np.clip(images * 255, 0, 255).astype("uint8")
+    return np.repeat(images[..., None], channels, axis=-1)
+
+
+def _create_frames_dataset(f, name, shape, dtype, chunk_frames, compression):
+    """ Creates a frames dataset with chunks of chunk_frames frames (0 = contiguous, uncompressed). """
+    if chunk_frames <= 0:
+        return f.create_dataset(name, shape=shape, dtype=dtype)
+    chunks = (min(chunk_frames, shape[0]),) + tuple(shape[1:])
+    return f.create_dataset(name, shape=shape, dtype=dtype, chunks=chunks, **_compression_kwargs(compression))
+
+
+def write_box(box_path, *, num_frames=1000, img_size=192, channels=1, num_joints=32, chunk_frames=1, compression="gzip",
+              block_frames=256, seed=0):
+    """
+    Writes a box file of synthetic frames with the layout of the preprocessing pipeline: /box (frames, channels, width,
+    height) as uint8 and 1-based /framesIdx. The true joint positions are saved in /joints (frames, [x, y], joints) as
+    1-based coordinates, like in training sets.
+
+    :param box_path: path to the HDF5 file to create
+    :param num_frames: number of frames
+    :param img_size: width and height of the boxes
+    :param channels: number of image channels
+    :param num_joints: number of joints in the skeleton
+    :param chunk_frames: number of frames per chunk (0 = contiguous)
+    :param compression: compression filter ("lzf", "gzip" or "none")
+    :param block_frames: number of frames to render and write at a time
+    :param seed: random seed
+    :return: box_path
+    """
+    rng = np.random.RandomState(seed)
+    skeleton = make_skeleton(num_joints)
+    points = synthetic_poses(num_frames, skeleton, (img_size, img_size), rng)
+
+    with h5py.File(box_path, "w") as f:
+        ds_box = _create_frames_dataset(f, "box", (num_frames, channels, img_size, img_size), "uint8", chunk_frames,
+                                        compression)
+        _write_mat_attrs(ds_box, "uint8")
+        for start in range(0, num_frames, block_frames):
+            images = render_images(points[start:start + block_frames], skeleton["edges"], (img_size, img_size), rng,
+                                   channels=channels)
+            ds_box[start:start + len(images)] = np.transpose(images, (0, 3, 2, 1))
+
+        _write_mat_attrs(f.create_dataset("framesIdx", data=np.arange(1, num_frames + 1, dtype="float64")), "double")
+        _write_mat_attrs(f.create_dataset("joints", data=np.transpose(points + 1, (0, 2, 1))), "single")
+        f.attrs["synthetic"] = np.uint8(1)
+        f.attrs["seed"] = seed
+
+    return box_path
+
+
+def write_training_set(save_path, *, num_frames=1000, img_size=192, channels=1, num_joints=32, chunk_frames=1,
+                       compression="gzip", sigma=5.0, normalize=True, pafs=False, paf_sigma=5.0, block_frames=256, seed=0):
+    """
+    Writes a training set of synthetic frames with the datasets and attributes of generate_training_set: /box, /confmaps
+    (and /pafs), /joints, /labeledIdx, /shuffleIdx and the /skeleton group.
+
+    :param save_path: path to the HDF5 file to create
+    :param num_frames: number of frames
+    :param img_size: width and height of the boxes
+    :param channels: number of image channels
+    :param num_joints: number of joints in the skeleton
+    :param chunk_frames: number of frames per chunk (0 = contiguous)
+    :param compression: compression filter ("lzf", "gzip" or "none")
+    :param sigma: standard deviation of the confidence map Gaussians in pixels
+    :param normalize: if True, confidence maps peak at 1.0
+    :param pafs: if True, also writes part affinity fields
+    :param paf_sigma: half-width of the part affinity field bands in pixels
+    :param block_frames: number of frames to render and write at a time
+    :param seed: random seed
+    :return: save_path
+    """
+    rng = np.random.RandomState(seed)
+    skeleton = make_skeleton(num_joints)
+    edges = skeleton["edges"]
+    size = (img_size, img_size)
+    points = synthetic_poses(num_frames, skeleton, size, rng)
+
+    with h5py.File(save_path, "w") as f:
+        ds_box = _create_frames_dataset(f, "box", (num_frames, channels) + size, "uint8", chunk_frames, compression)
+        _write_mat_attrs(ds_box, "uint8")
+        ds_confmaps = _create_frames_dataset(f, "confmaps", (num_frames, num_joints) + size, "float32", chunk_frames,
+                                             compression)
+        _write_mat_attrs(ds_confmaps, "single")
+        ds_confmaps.attrs["sigma"] = sigma
+        ds_confmaps.attrs["normalize"] = np.uint8(normalize)
+        if pafs:
+            ds_pafs = _create_frames_dataset(f, "pafs", (num_frames, 2 * len(edges)) + size, "float32", chunk_frames,
+                                             compression)
+            _write_mat_attrs(ds_pafs, "single")
+            ds_pafs.attrs["sigma"] = paf_sigma
+
+        for start in range(0, num_frames, block_frames):
+            block = points[start:start + block_frames]
+            end = start + len(block)
+            ds_box[start:end] = np.transpose(render_images(block, edges, size, rng, channels=channels), (0, 3, 2, 1))
+            ds_confmaps[start:end] = np.transpose(render_confmaps(block, size, sigma=sigma, normalize=normalize),
+                                                  (0, 3, 2, 1))
+            if pafs:
+                ds_pafs[start:end] = np.transpose(render_pafs(block, edges, size, sigma=paf_sigma), (0, 3, 2, 1))
+
+        # Labels and indices (1-based, as in MATLAB)
+        _write_mat_attrs(f.create_dataset("joints", data=np.transpose(points + 1, (0, 2, 1))), "single")
+        idx = np.arange(1, num_frames + 1, dtype="float64")
+        _write_mat_attrs(f.create_dataset("labeledIdx", data=idx), "double")
+        _write_mat_attrs(f.create_dataset("shuffleIdx", data=idx), "double")
+
+        f.attrs["createdOn"] = datetime.now().strftime("%d-%b-%Y %H:%M:%S")
+        f.attrs["scale"] = 1.0
+        f.attrs["postShuffle"] = np.uint8(0)
+        f.attrs["horizontalOrientation"] = np.uint8(1)
+        f.attrs["synthetic"] = np.uint8(1)
+        f.attrs["seed"] = seed
+
+        skeleton_group = f.create_group("skeleton")
+        skeleton_group.create_dataset("edges", data=(edges + 1).T.astype("float64"))
+        skeleton_group.create_dataset("pos", data=skeleton["pos"].T.astype("float64"))
+        skeleton_group.attrs["jointNames"] = "\n".join(skeleton["joint_names"])
+
+    return save_path
+
+
+def synthetic_data(out_path, *, kind="training", num_frames=1000, img_size=192, channels=1, num_joints=32,
+                   chunk_frames=1, compression="gzip", sigma=5.0, pafs=False, seed=0, overwrite=False):
+    """
+    Generates a synthetic box or training file for benchmarking and testing without real recordings.
+
+    Frames show a skeleton of Gaussian blobs moving smoothly in an aligned box. Files have the same dataset names, dtypes,
+    axis order and attributes as the real ones, so they can be used with predict_box, training.train, load_dataset,
+    rechunk and the benchmarks. The chunk layout and compression can be set to reproduce fast or slow layouts.
+
+    :param out_path: path to the HDF5 file to create
+    :param kind: "training" for a training set (box, confmaps, skeleton) or "box" for a box file
+    :param num_frames: number of frames
+    :param img_size: width and height of the boxes
+    :param channels: number of image channels
+    :param num_joints: number of joints in the skeleton
+    :param chunk_frames: number of frames per chunk (0 = contiguous, uncompressed)
+    :param compression: compression filter ("lzf", "gzip" or "none")
+    :param sigma: standard deviation of the confidence map Gaussians in pixels
+    :param pafs: if True, also writes part affinity fields to training sets
+    :param seed: random seed
+    :param overwrite: if True and out_path exists, file will be overwritten
+    """
+    if kind not in ("training", "box"):
+        print("Error: kind must be \"training\" or \"box\".")
+        return
+    if num_joints < 2:
+        print("Error: num_joints must be at least 2.")
+        return
+    if os.path.exists(out_path):
+        if overwrite:
+            os.remove(out_path)
+            print("Deleted existing output.")
+        else:
+            print("Error: Output path already exists.")
+            return
+
+    t0 = time()
+    if kind == "box":
+        write_box(out_path, num_frames=num_frames, img_size=img_size, channels=channels, num_joints=num_joints,
+                  chunk_frames=chunk_frames, compression=compression, seed=seed)
+    else:
+        write_training_set(out_path, num_frames=num_frames, img_size=img_size, channels=channels,
+                           num_joints=num_joints, chunk_frames=chunk_frames, compression=compression, sigma=sigma,
+                           pafs=pafs, seed=seed)
+
+    print("Saved: %s (%.1f MiB)" % (out_path, os.path.getsize(out_path) / 1024 ** 2))
+    print("Total runtime: %.1f secs" % (time() - t0))
+
+
+if __name__ == "__main__":
+    clize.run(synthetic_data)
@@ -5,29 +5,28 @@ from time import time
 from scipy.io import loadmat, savemat
 import re
 import shutil
+import inspect
+import tempfile
 import clize
+from clize import Parameter
 
 import keras
-from keras.callbacks import ReduceLROnPlateau, ModelCheckpoint, LambdaCallback
+from keras.callbacks import ReduceLROnPlateau, LambdaCallback, EarlyStopping
 
 from leap import models
-from leap.image_augmentation import PairedImageAugmenter, MultiInputOutputPairedImageAugmenter
-from leap.viz import show_pred, show_confmap_grid, plot_history
-from leap.utils import load_dataset
+from leap.image_augmentation import PairedImageAugmenter, MultiInputOutputPairedImageAugmenter, SampleLossTracker
+from leap.evaluation import evaluate_run
+from leap.cache import load_cached_split
+from leap.checkpoints import AsyncCheckpointer, load_index
+from leap.distributed import make_distributed, SyncStopTraining
+from leap.utils import load_dataset, split_indices, preprocess, find_model_weights, downsample_confmaps, load_skeleton, find_symmetric_pairs, \
+    select_confmaps, split_targets
 
 
-def train_val_split(X, Y, val_size=0.15, shuffle=True):
+def train_val_split(X, Y, val_size=0.15, shuffle=True, seed=None):
     """ Splits datasets into training and validation sets. """
 
-    if val_size < 1:
-        val_size = int(np.round(len(X) * val_size))
-
-    idx = np.arange(len(X))
-    if shuffle:
-        np.random.shuffle(idx)
-
-    val_idx = idx[:val_size]
-    idx = idx[val_size:]
+    idx, val_idx = split_indices(len(X), val_size=val_size, shuffle=shuffle, seed=seed)
 
     return X[idx], Y[idx], X[val_idx], Y[val_idx], idx, val_idx
 
@@ -63,12 +62,13 @@ def create_run_folders(run_name, base_path="models", clean=False):
 
 
 class LossHistory(keras.callbacks.Callback):
-    def __init__(self, run_path):
+    def __init__(self, run_path, history=None):
         super().__init__()
         self.run_path = run_path
+        self.initial_history = history or []
 
     def on_train_begin(self, logs={}):
-        self.history = []
+        self.history = list(self.initial_history)
 
     def on_epoch_end(self, batch, logs={}):
         # Append to log list
@@ -79,9 +79,132 @@ class LossHistory(keras.callbacks.Callback):
                 {k: [x[k] for x in self.history] for k in self.history[0].keys()})
 
         # Plot graph
+        from leap.viz import plot_history
         plot_history(self.history, save_path=os.path.join(self.run_path, "history.png"))
 
 
+def load_history(run_path):
+    """ Loads the history saved by LossHistory as a list of dicts of metrics per epoch. """
+    history = loadmat(os.path.join(run_path, "history.mat"))
+    keys = [k for k in history.keys() if not k.startswith("__")]
+    return [{k: float(history[k].flatten()[i]) for k in keys} for i in range(history[keys[0]].size)]
+
+
+class TimeBudget(keras.callbacks.Callback):
+    """ Stops training when another epoch would exceed a wall-clock time budget. """
+    def __init__(self, budget_secs):
+        super().__init__()
+        self.budget_secs = budget_secs
+
+    def on_train_begin(self, logs={}):
+        self.t0 = time()
+        self.num_epochs = 0
+
+    def on_epoch_end(self, epoch, logs={}):
+        self.num_epochs += 1
+        elapsed = time() - self.t0
+        if elapsed + elapsed / self.num_epochs > self.budget_secs:
+            print("Stopping: time budget of %.1f mins would be exceeded by the next epoch (elapsed: %.1f mins)." % (self.budget_secs / 60, elapsed / 60))
+            self.model.stop_training = True
+
+
+def predict_confmaps(model, X, batch_size=32):
+    """ Predicts confidence maps, keeping only the final confidence maps output of multi-output models. """
+    return select_confmaps(model.predict(X, batch_size=batch_size), model.output_names)
+
+
+def load_unlabeled(box_path, box_dset="box", max_samples=0):
+    """ Loads and normalizes frames from a box file, optionally subsampled to max_samples random frames. """
+    t0 = time()
+    with h5py.File(box_path, "r") as f:
+        num_samples = len(f[box_dset])
+        if max_samples > 0 and max_samples < num_samples:
+            idx = np.sort(np.random.choice(num_samples, max_samples, replace=False))
+            X = f[box_dset][idx]
+        else:
+            X = f[box_dset][:]
+    X = preprocess(X)
+    print("Loaded %d unlabeled samples [%.1fs]" % (len(X), time() - t0))
+
+    return X
+
+
+def load_pafs(data_path, edges, idx, img_size, paf_dset="pafs", sigma=5.0, block_frames=256):
+    """
+    Loads part affinity fields of samples in a training set, or renders them from its joints if it has none.
+
+    :param data_path: path to an HDF5 file with a pafs or joints dataset
+    :param edges: skeleton edges (edges, [src, dst]) as 0-based joint indices
+    :param idx: indices of the samples to load
+    :param img_size: (height, width) of the fields
+    :param paf_dset: name of the part affinity fields dataset
+    :param sigma: maximum distance from the edges in pixels if the fields are rendered (see render_pafs)
+    :param block_frames: number of samples to render at a time
+    :return: pafs (samples, height, width, 2 * edges) in the order of idx, or None if the data file has neither dataset
+    """
+    from leap.generate_training_set import render_pafs
+
+    t0 = time()
+    idx = np.asarray(idx, dtype="int64")
+    order = np.argsort(idx) # HDF5 fancy indexing requires increasing indices
+    with h5py.File(data_path, "r") as f:
+        if paf_dset in f:
+            pafs = preprocess(f[paf_dset][idx[order]])
+            print("Loaded part affinity fields [%.1fs]" % (time() - t0))
+        elif "joints" in f:
+            pafs = np.zeros((len(idx),) + tuple(img_size) + (2 * len(edges),), dtype="float32")
+            for start in range(0, len(idx), block_frames):
+                block = order[start:start + block_frames]
+                points = np.transpose(f["joints"][idx[block]], (0, 2, 1)) - 1 # (samples, joints, [x, y]), 0-based
+                pafs[start:start + len(block)] = render_pafs(points, edges, img_size, sigma=sigma)
+            print("Rendered part affinity fields (sigma = %g) [%.1fs]" % (sigma, time() - t0))
+        else:
+            return None
+
+    return pafs[np.argsort(order)]
+
+
+def distill_targets(teacher_path, box, confmap, unlabeled_path=None, unlabeled_dset="box", max_unlabeled=0, alpha=1.0, batch_size=32):
+    """
+    Generates training targets for knowledge distillation from the confidence maps of a teacher model.
+
+    :param teacher_path: path to Keras weights file or run folder of the teacher model
+    :param box: labeled training images
+    :param confmap: ground truth confidence maps of the labeled images (at the output resolution of the student)
+    :param unlabeled_path: path to an HDF5 file with additional unlabeled box images
+    :param unlabeled_dset: name of the box dataset in the unlabeled HDF5 file
+    :param max_unlabeled: maximum number of unlabeled frames to sample (0 = all)
+    :param alpha: weight of the teacher confidence maps in the targets of labeled images (0 = labels only)
+    :param batch_size: number of samples to evaluate the teacher on at once
+    :return: box, confmap with the teacher targets
+    """
+    weights_path = find_model_weights(teacher_path)
+    teacher = keras.models.load_model(weights_path)
+    print("teacher:", weights_path)
+
+    def teacher_targets(X):
+        Y = predict_confmaps(teacher, X, batch_size=batch_size)
+
+        # Match the output resolution of the student
+        if Y.shape[1] > confmap.shape[1]:
+            Y = downsample_confmaps(Y, Y.shape[1] // confmap.shape[1])
+        if Y.shape[1:] != confmap.shape[1:]:
+            raise ValueError("Teacher outputs %s do not match the training targets %s." % (Y.shape[1:], confmap.shape[1:]))
+        return Y
+
+    t0 = time()
+    if alpha > 0:
+        confmap = alpha * teacher_targets(box) + (1 - alpha) * confmap
+
+    if unlabeled_path is not None:
+        unlabeled_box = load_unlabeled(unlabeled_path, box_dset=unlabeled_dset, max_samples=max_unlabeled)
+        box = np.concatenate((box, unlabeled_box), axis=0)
+        confmap = np.concatenate((confmap, teacher_targets(unlabeled_box)), axis=0)
+    print("Generated teacher targets [%.1fs]" % (time() - t0))
+
+    return box, confmap
+
+
 def create_model(net_name, img_size, output_channels, **kwargs):
     """ Wrapper for initializing a network for training. """
     # compile_model = getattr(models, net_name)
@@ -90,6 +213,7 @@ def create_model(net_name, img_size, output_channels, **kwargs):
         leap_cnn=models.leap_cnn,
         hourglass=models.hourglass,
         stacked_hourglass=models.stacked_hourglass,
+        leap_mobile=models.leap_mobile,
         ).get(net_name)
     if compile_model == None:
         return None
@@ -106,8 +230,12 @@ def train(data_path, *,
     confmap_dset="confmaps",
     val_size=0.15,
     preshuffle=True,
+    seed: int = None,
+    cache_dir=None,
     filters=64,
     rotate_angle=15,
+    mirror=False,
+    importance_sampling=False,
     epochs=50,
     batch_size=32,
     batches_per_epoch=50,
@@ -118,9 +246,27 @@ def train(data_path, *,
     reduce_lr_min_delta=1e-5,
     reduce_lr_cooldown=0,
     reduce_lr_min_lr=1e-10,
+    early_stopping_patience=0,
+    time_budget_mins=0,
     save_every_epoch=False,
+    keep_best_checkpoints=3,
     amsgrad=False,
     upsampling_layers=False,
+    output_stride=1,
+    width_multiplier=1.0,
+    teacher_path=None,
+    unlabeled_path=None,
+    unlabeled_dset="box",
+    max_unlabeled=0,
+    distill_alpha=1.0,
+    pafs=False,
+    paf_dset="pafs",
+    paf_sigma=5.0,
+    callbacks: Parameter.IGNORE = None,
+    resume_path: Parameter.IGNORE = None,
+    frames: Parameter.IGNORE = None,
+    val_frames: Parameter.IGNORE = None,
+    distributed: Parameter.IGNORE = None,
     ):
     """
     Trains the network and saves the intermediate results to an output directory.
@@ -135,28 +281,98 @@ def train(data_path, *,
     :param confmap_dset: Name of the confidence maps dataset in the HDF5 data file
     :param preshuffle: If True, shuffle prior to splitting the dataset, otherwise validation set will be the last frames
     :param val_size: Fraction of dataset to use as validation
+    :param seed: Random seed for the training/validation split
+    :param cache_dir: Path to a folder to cache the preprocessed and split datasets in as memory-mappable .npy files.
+        Runs with the same data file, datasets, val_size, seed and output_stride load them from the cache (unseeded runs
+        share the split of the first cached run).
     :param filters: Number of filters to use as baseline (see create_model)
     :param rotate_angle: Images will be augmented by rotating by +-rotate_angle
+    :param mirror: Randomly flip images and swap left/right joints (found in the skeleton metadata of the data file)
+    :param importance_sampling: Draw training batches weighted toward samples with high recent loss, with importance
+        weights to correct for the sampling (costs an extra forward pass per batch)
     :param epochs: Number of epochs to train for
     :param batch_size: Number of samples per batch
     :param batches_per_epoch: Number of batches per epoch (validation is evaluated at the end of the epoch)
-    :param val_batches_per_epoch: Number of batches for validation
+    :param val_batches_per_epoch: Number of batches for validation. The same un-augmented validation samples are
+        evaluated at every epoch (0 = the whole validation set).
     :param viz_idx: Index of the sample image to use for visualization
     :param reduce_lr_factor: Factor to reduce the learning rate by (see ReduceLROnPlateau)
     :param reduce_lr_patience: How many epochs to wait before reduction (see ReduceLROnPlateau)
     :param reduce_lr_min_delta: Minimum change in error required before reducing LR (see ReduceLROnPlateau)
     :param reduce_lr_cooldown: How many epochs to wait after reduction before LR can be reduced again (see ReduceLROnPlateau)
     :param reduce_lr_min_lr: Minimum that the LR can be reduced down to (see ReduceLROnPlateau)
+    :param early_stopping_patience: Stop training after this many epochs without improvement in val_loss greater than
+        reduce_lr_min_delta (0 = no early stopping)
+    :param time_budget_mins: Stop training before an epoch would end after this many minutes (0 = no limit)
     :param save_every_epoch: Save weights at every epoch. If False, saves only initial, final and best weights.
+    :param keep_best_checkpoints: If saving weights at every epoch, keep only this many with the lowest val_loss plus
+        the latest (0 = keep all)
     :param amsgrad: Use AMSGrad variant of optimizer. Can help with training accuracy on rare examples (see Reddi et al., 2018)
     :param upsampling_layers: Use simple bilinear upsampling layers as opposed to learned transposed convolutions
+    :param output_stride: Downsampling factor of the predicted confidence maps relative to the input (1, 2 or 4)
+    :param width_multiplier: Scales the number of filters in every layer (only for leap_mobile)
+    :param teacher_path: Path to a trained model (weights file or run folder) to distill into the network being trained
+    :param unlabeled_path: Path to an HDF5 file with unlabeled box images to train on with teacher targets
+    :param unlabeled_dset: Name of the box dataset in the unlabeled HDF5 file
+    :param max_unlabeled: Maximum number of unlabeled frames to sample for distillation (0 = all)
+    :param distill_alpha: Weight of the teacher confidence maps in the targets of labeled training frames (0 = labels only)
+    :param pafs: Also train the network to predict part affinity fields along the skeleton edges of the data file for
+        grouping joints into instances (see predict_box.group_instances)
+    :param paf_dset: Name of the part affinity fields dataset in the HDF5 data file. If missing, the fields are rendered
+        from the joints of the data file.
+    :param paf_sigma: Maximum distance from the skeleton edges in pixels of the rendered part affinity fields
+    :param callbacks: Additional Keras callbacks (not available from the command line)
+    :param resume_path: Run folder to continue training in from its latest checkpoint (see resume)
+    :param frames: Indices of the samples in the data file to train on (default: all, see finetune)
+    :param val_frames: Indices of the samples in the data file to validate on. If given, all of frames are trained on.
+    :param distributed: Communicator of this worker for data-parallel training (see distributed.train_distributed)
     """
 
+    if pafs and teacher_path is not None:
+        print("Error: Distillation is not supported with part affinity fields.")
+        return
+
     # Load
     print("data_path:", data_path)
-    box, confmap = load_dataset(data_path, X_dset=box_dset, Y_dset=confmap_dset)
-    viz_sample = (box[viz_idx], confmap[viz_idx])
-    box, confmap, val_box, val_confmap, train_idx, val_idx = train_val_split(box, confmap, val_size=val_size, shuffle=preshuffle)
+    if frames is not None:
+        frames = np.unique(frames)
+        if val_frames is not None:
+            val_frames = np.unique(val_frames)
+    if cache_dir is not None and resume_path is None and frames is None:
+        box, confmap, val_box, val_confmap, train_idx, val_idx = load_cached_split(
+            cache_dir, data_path, X_dset=box_dset, Y_dset=confmap_dset, val_size=val_size, shuffle=preshuffle, seed=seed,
+            output_stride=output_stride)
+        if viz_idx in val_idx:
+            i = list(val_idx).index(viz_idx)
+            viz_sample = (val_box[i], val_confmap[i])
+        else:
+            i = list(train_idx).index(viz_idx)
+            viz_sample = (box[i], confmap[i])
+    else:
+        loaded_idx = frames if val_frames is None else np.unique(np.concatenate((frames, val_frames)))
+        box, confmap = load_dataset(data_path, X_dset=box_dset, Y_dset=confmap_dset, idx=loaded_idx)
+        confmap = downsample_confmaps(confmap, output_stride)
+        viz_sample = (box[viz_idx], confmap[viz_idx])
+        if resume_path is not None:
+            # Keep the split of the run being resumed
+            info = loadmat(os.path.join(resume_path, "training_info.mat"), squeeze_me=True)
+            train_idx, val_idx = [np.atleast_1d(info[k]).astype("int64") for k in ("train_idx", "val_idx")]
+            box, confmap, val_box, val_confmap = box[train_idx], confmap[train_idx], box[val_idx], confmap[val_idx]
+        elif val_frames is not None:
+            # Fixed split given as indices into the data file
+            train_idx, val_idx = frames, val_frames
+            i, j = np.searchsorted(loaded_idx, train_idx), np.searchsorted(loaded_idx, val_idx)
+            box, confmap, val_box, val_confmap = box[i], confmap[i], box[j], confmap[j]
+        else:
+            box, confmap, val_box, val_confmap, train_idx, val_idx = train_val_split(box, confmap, val_size=val_size, shuffle=preshuffle, seed=seed)
+            if frames is not None:
+                # Indices into the data file
+                train_idx, val_idx = frames[train_idx], frames[val_idx]
+
+    # Distill teacher predictions into the training targets (validation is still against labels)
+    if teacher_path is not None:
+        box, confmap = distill_targets(teacher_path, box, confmap, unlabeled_path=unlabeled_path, unlabeled_dset=unlabeled_dset,
+                                       max_unlabeled=max_unlabeled, alpha=distill_alpha, batch_size=batch_size)
     print("box.shape:", box.shape)
     print("val_box.shape:", val_box.shape)
 
@@ -166,6 +382,21 @@ def train(data_path, *,
     print("img_size:", img_size)
     print("num_output_channels:", num_output_channels)
 
+    # Part affinity fields are trained as the last channels of the targets (see split_targets)
+    paf_edges, paf_channels = None, 0
+    if pafs:
+        paf_edges = load_skeleton(data_path)["edges"]
+        paf_channels = 2 * len(paf_edges)
+        Y_pafs = load_pafs(data_path, paf_edges, np.concatenate((train_idx, val_idx)), img_size[:2], paf_dset=paf_dset,
+                           sigma=paf_sigma)
+        if Y_pafs is None:
+            print("Error: Data file has no %s or joints dataset to train part affinity fields on." % paf_dset)
+            return
+        Y_pafs = downsample_confmaps(Y_pafs, output_stride)
+        confmap = np.concatenate((confmap, Y_pafs[:len(train_idx)]), axis=-1)
+        val_confmap = np.concatenate((val_confmap, Y_pafs[len(train_idx):]), axis=-1)
+        print("paf_channels:", paf_channels)
+
     # Build run name if needed
     if data_name == None:
         data_name = os.path.splitext(os.path.basename(data_path))[0]
@@ -177,56 +408,134 @@ def train(data_path, *,
     print("run_name:", run_name)
 
     # Create network
-    if isinstance(net_name, keras.models.Model):
+    epoch0 = 0
+    if resume_path is not None:
+        index = load_index(resume_path)
+        if index is None or index.get("latest") is None:
+            print("Error: No checkpoint to resume from in", resume_path)
+            return
+        model = keras.models.load_model(os.path.join(resume_path, index["latest"]))
+        epoch0 = index["latest_epoch"]
+        print("Resuming from %s (epoch %d)" % (index["latest"], epoch0))
+    elif isinstance(net_name, keras.models.Model):
         model = net_name
         net_name = model.name
     else:
-        model = create_model(net_name, img_size, num_output_channels, filters=filters, amsgrad=amsgrad, upsampling_layers=upsampling_layers, summary=True)
+        model_kwargs = dict(filters=filters, amsgrad=amsgrad, upsampling_layers=upsampling_layers, output_stride=output_stride,
+                            paf_channels=paf_channels, summary=True)
+        if net_name == "leap_mobile":
+            model_kwargs["width_multiplier"] = width_multiplier
+        model = create_model(net_name, img_size, num_output_channels, **model_kwargs)
     if model == None:
         print("Could not find model:", net_name)
         return
 
+    # Frames of the original box that were labeled in the data file (see finetune)
+    with h5py.File(data_path, "r") as f:
+        labeled_idx = f["labeledIdx"][()].flatten().astype("int64") - 1 if "labeledIdx" in f else np.array([], dtype="int64")
+
     # Initialize run directories
-    run_path = create_run_folders(run_name, base_path=base_output_path, clean=clean)
+    is_main = distributed is None or distributed.rank == 0
+    if not is_main:
+        # Only the first worker saves the run folder
+        run_path = create_run_folders(run_name, base_path=tempfile.mkdtemp(prefix="leap_rank%d_" % distributed.rank))
+    elif resume_path is not None:
+        run_path = resume_path
+    else:
+        run_path = create_run_folders(run_name, base_path=base_output_path, clean=clean)
     savemat(os.path.join(run_path, "training_info.mat"),
-            {"data_path": data_path, "val_idx": val_idx, "train_idx": train_idx,
+            {"data_path": data_path, "val_idx": val_idx, "train_idx": train_idx, "labeled_idx": labeled_idx,
              "base_output_path": base_output_path, "run_name": run_name, "data_name": data_name,
              "net_name": net_name, "clean": clean, "box_dset": box_dset, "confmap_dset": confmap_dset,
-             "preshuffle": preshuffle, "val_size": val_size, "filters": filters, "rotate_angle": rotate_angle,
+             "preshuffle": preshuffle, "val_size": val_size, "seed": "" if seed is None else seed, "filters": filters, "rotate_angle": rotate_angle, "mirror": mirror, "importance_sampling": importance_sampling,
              "epochs": epochs, "batch_size": batch_size, "batches_per_epoch": batches_per_epoch,
              "val_batches_per_epoch": val_batches_per_epoch, "viz_idx": viz_idx, "reduce_lr_factor": reduce_lr_factor,
              "reduce_lr_patience": reduce_lr_patience, "reduce_lr_min_delta": reduce_lr_min_delta,
              "reduce_lr_cooldown": reduce_lr_cooldown, "reduce_lr_min_lr": reduce_lr_min_lr,
-             "save_every_epoch": save_every_epoch, "amsgrad": amsgrad, "upsampling_layers": upsampling_layers})
+             "early_stopping_patience": early_stopping_patience, "time_budget_mins": time_budget_mins,
+             "save_every_epoch": save_every_epoch, "keep_best_checkpoints": keep_best_checkpoints, "amsgrad": amsgrad, "upsampling_layers": upsampling_layers,
+             "output_stride": output_stride, "width_multiplier": width_multiplier, "teacher_path": teacher_path or "", "unlabeled_path": unlabeled_path or "", "unlabeled_dset": unlabeled_dset,
+             "max_unlabeled": max_unlabeled, "distill_alpha": distill_alpha, "pafs": pafs, "paf_dset": paf_dset,
+             "paf_sigma": paf_sigma})
 
     # Save initial network
-    model.save(os.path.join(run_path, "initial_model.h5"))
+    if resume_path is None:
+        model.save(os.path.join(run_path, "initial_model.h5"))
+
+    # Average gradients across data-parallel workers
+    if distributed is not None:
+        make_distributed(model, distributed)
+        np.random.seed(seed or 0) # same batches on all workers
+
+    # Mirroring augmentation
+    augmenter_kwargs = dict(batch_size=batch_size, shuffle=True, theta=(-rotate_angle, rotate_angle), paf_edges=paf_edges)
+    if mirror:
+        skeleton = load_skeleton(data_path)
+        swap_pairs = find_symmetric_pairs(skeleton["joint_names"])
+        print("Symmetric channels:")
+        for a, b in swap_pairs:
+            print("    %s (%d) <-> %s (%d)" % (skeleton["joint_names"][a], a, skeleton["joint_names"][b], b))
+        augmenter_kwargs.update(mirror=True, swap_pairs=swap_pairs, horizontal_orientation=skeleton["horizontal_orientation"])
+    if importance_sampling:
+        augmenter_kwargs.update(sampling=True)
 
     # Data generators/augmentation
     input_layers = model.input_names
     output_layers = model.output_names
     if len(input_layers) > 1 or len(output_layers) > 1:
-        train_datagen = MultiInputOutputPairedImageAugmenter(input_layers, output_layers, box, confmap, batch_size=batch_size, shuffle=True, theta=(-rotate_angle, rotate_angle))
-        val_datagen = MultiInputOutputPairedImageAugmenter(input_layers, output_layers, val_box, val_confmap, batch_size=batch_size, shuffle=True, theta=(-rotate_angle, rotate_angle))
+        train_datagen = MultiInputOutputPairedImageAugmenter(input_layers, output_layers, box, confmap, **augmenter_kwargs)
     else:
-        train_datagen = PairedImageAugmenter(box, confmap, batch_size=batch_size, shuffle=True, theta=(-rotate_angle, rotate_angle))
-        val_datagen = PairedImageAugmenter(val_box, val_confmap, batch_size=batch_size, shuffle=True, theta=(-rotate_angle, rotate_angle))
+        train_datagen = PairedImageAugmenter(box, confmap, **augmenter_kwargs)
+    if distributed is not None:
+        # Each worker takes its shard of every batch, with different augmentations
+        train_datagen.batches = [b[distributed.rank::distributed.world_size] for b in train_datagen.batches]
+        train_datagen.batch_size = int(np.ceil(batch_size / distributed.world_size))
+        np.random.seed((seed or 0) + 1 + distributed.rank)
+
+    # Fixed, un-augmented validation samples so that val_loss is comparable across epochs
+    num_val = len(val_box) if val_batches_per_epoch == 0 else min(len(val_box), val_batches_per_epoch * batch_size)
+    val_X, val_Y = np.asarray(val_box[:num_val]), np.asarray(val_confmap[:num_val])
+    if len(input_layers) > 1 or len(output_layers) > 1:
+        val_data = ({k: val_X for k in input_layers}, split_targets(val_Y, output_layers, paf_channels))
+    else:
+        val_data = (val_X, val_Y)
+    print("Validation samples per epoch:", num_val)
 
     # Initialize training callbacks
-    history_callback = LossHistory(run_path=run_path)
+    history_callback = LossHistory(run_path=run_path, history=load_history(resume_path)[:epoch0] if resume_path is not None else None)
     reduce_lr_callback = ReduceLROnPlateau(monitor="val_loss", factor=reduce_lr_factor,
                                           patience=reduce_lr_patience, verbose=1, mode="auto",
                                           epsilon=reduce_lr_min_delta, cooldown=reduce_lr_cooldown,
                                           min_lr=reduce_lr_min_lr)
-    if save_every_epoch:
-        checkpointer = ModelCheckpoint(filepath=os.path.join(run_path, "weights/weights.{epoch:03d}-{val_loss:.9f}.h5"), verbose=1, save_best_only=False)
-    else:
-        checkpointer = ModelCheckpoint(filepath=os.path.join(run_path, "best_model.h5"), verbose=1, save_best_only=True)
+    from leap.viz import show_pred, show_confmap_grid # matplotlib is only needed while training
     viz_grid_callback = LambdaCallback(on_epoch_end=lambda epoch, logs: show_confmap_grid(model, *viz_sample, plot=True, save_path=os.path.join(run_path, "viz_confmaps/confmaps_%03d.png" % epoch), show_figure=False))
     viz_pred_callback = LambdaCallback(on_epoch_end=lambda epoch, logs: show_pred(model, *viz_sample, save_path=os.path.join(run_path, "viz_pred/pred_%03d.png" % epoch), show_figure=False))
+    stopping_callbacks = []
+    if early_stopping_patience > 0:
+        stopping_callbacks.append(EarlyStopping(monitor="val_loss", min_delta=reduce_lr_min_delta, patience=early_stopping_patience, verbose=1))
+    if time_budget_mins > 0:
+        stopping_callbacks.append(TimeBudget(time_budget_mins * 60))
+
+    # Checkpoints with the state of the LR schedule and early stopping for resuming
+    stateful_callbacks = dict(reduce_lr=(reduce_lr_callback, ["wait", "cooldown_counter", "best"]))
+    if early_stopping_patience > 0:
+        stateful_callbacks["early_stopping"] = (stopping_callbacks[0], ["wait", "best"])
+    def training_state():
+        return {name: {k: float(getattr(callback, k)) for k in keys} for name, (callback, keys) in stateful_callbacks.items()}
+    def restore_state(logs):
+        # Runs after the other callbacks reset their state in on_train_begin
+        for name, state in index.get("state", {}).items():
+            if name in stateful_callbacks:
+                for k, v in state.items():
+                    setattr(stateful_callbacks[name][0], k, v)
+    checkpointer = AsyncCheckpointer(run_path, monitor="val_loss", save_every_epoch=save_every_epoch,
+                                     keep_best=keep_best_checkpoints, save_latest=True, state_fn=training_state)
+    resume_callbacks = [LambdaCallback(on_train_begin=restore_state)] if resume_path is not None else []
+    viz_callbacks = [viz_pred_callback, viz_grid_callback] if is_main else []
+    distributed_callbacks = [SyncStopTraining(distributed)] if distributed is not None else []
+    sampling_callbacks = [SampleLossTracker(train_datagen)] if importance_sampling else []
 
     # Train!
-    epoch0 = 0
     t0_train = time()
     training = model.fit_generator(
             train_datagen,
@@ -236,29 +545,129 @@ def train(data_path, *,
     #         use_multiprocessing=True,
     #         workers=8,
             steps_per_epoch=batches_per_epoch,
-            max_queue_size=512,
+            max_queue_size=8 if importance_sampling else 512, # sampling uses recent losses
             shuffle=False,
-            validation_data=val_datagen,
-            validation_steps=val_batches_per_epoch,
+            validation_data=val_data,
             callbacks = [
                 reduce_lr_callback,
                 checkpointer,
                 history_callback,
-                viz_pred_callback,
-                viz_grid_callback
-            ]
+            ] + sampling_callbacks + viz_callbacks + stopping_callbacks + resume_callbacks + list(callbacks or []) + distributed_callbacks
         )
 
     # Compute total elapsed time for training
     elapsed_train = time() - t0_train
     print("Total runtime: %.1f mins" % (elapsed_train / 60))
+    if not is_main:
+        shutil.rmtree(os.path.dirname(run_path), ignore_errors=True)
+        return
 
     # Save final model
     model.history = history_callback.history
     model.save(os.path.join(run_path, "final_model.h5"))
 
+    # Evaluate joint position errors on the held-out validation set
+    evaluate_run(run_path, model=model, batch_size=batch_size)
+
+
+def load_train_kwargs(run_path):
+    """ Returns the data path and keyword arguments to train saved in the training_info.mat of a run. """
+    info = loadmat(os.path.join(run_path, "training_info.mat"), squeeze_me=True)
+
+    # Empty values stand in for None
+    kwargs = {}
+    for name, param in inspect.signature(train).parameters.items():
+        if name in info and param.kind == inspect.Parameter.KEYWORD_ONLY:
+            value = info[name]
+            if isinstance(value, (np.ndarray, np.generic)):
+                value = None if value.size == 0 else value.item()
+            kwargs[name] = value
+
+    return str(info["data_path"]), kwargs
+
+
+def resume(run_path, *, epochs: int = None, time_budget_mins: float = None):
+    """
+    Continues training in an existing run folder from its latest checkpoint.
+
+    The model, optimizer state, learning rate schedule, history and training/validation split are restored, and all
+    other parameters are loaded from the training_info.mat of the run.
+
+    :param run_path: Path to the run folder
+    :param epochs: Total number of epochs to train for (default: same as the original run)
+    :param time_budget_mins: Stop training before an epoch would end after this many minutes (default: same as the
+        original run)
+    """
+    data_path, kwargs = load_train_kwargs(run_path)
+    if epochs is not None:
+        kwargs["epochs"] = epochs
+    if time_budget_mins is not None:
+        kwargs["time_budget_mins"] = time_budget_mins
+
+    return train(data_path, resume_path=run_path, **kwargs)
+
+
+def finetune(data_path, model_path, *, run_name=None, replay_ratio=2.0, max_epochs=15, early_stopping_patience=3,
+             learning_rate=1e-4, time_budget_mins=0):
+    """
+    Fine-tunes a trained model on frames labeled since it was trained.
+
+    New frames are the ones in the data file whose labeledIdx is not in the labeled_idx of the run that trained the
+    model. Training starts from the best weights of that run, on all of the new frames plus a random replay sample of
+    the frames it was trained on, and is validated on the validation frames of that run. Epochs are single passes over
+    the training frames and training stops once val_loss stops improving. Other parameters are loaded from the training_info.mat of the run.
+
+    :param data_path: Path to an HDF5 file with box and confmaps datasets (regenerated with the new labels)
+    :param model_path: Path to the run folder of the model to fine-tune
+    :param run_name: Name of the fine-tuning run (default: name of the original run with a "_finetune" suffix)
+    :param replay_ratio: Number of previously labeled frames to train on per new frame
+    :param max_epochs: Maximum number of epochs to train for
+    :param early_stopping_patience: Stop training after this many epochs without improvement in val_loss
+    :param learning_rate: Learning rate of the optimizer (the schedule of the original run is not kept)
+    :param time_budget_mins: Stop training before an epoch would end after this many minutes (0 = no limit)
+    """
+    _, kwargs = load_train_kwargs(model_path)
+    info = loadmat(os.path.join(model_path, "training_info.mat"), squeeze_me=True)
+    seen = info.get("labeled_idx")
+    if seen is None:
+        print("Error: %s does not record its labeled frames (labeled_idx). Train it again to fine-tune." % model_path)
+        return
+    seen = np.atleast_1d(seen).astype("int64")
+    seen_val = seen[np.atleast_1d(info["val_idx"]).astype("int64")] if len(seen) > 0 else seen
+
+    # Find new labels by their index in the original box, since the training set may have been reshuffled
+    with h5py.File(data_path, "r") as f:
+        labeled_idx = f["labeledIdx"][()].flatten().astype("int64") - 1
+    is_new = ~np.isin(labeled_idx, seen)
+    new_frames = np.where(is_new)[0]
+    val_frames = np.where(np.isin(labeled_idx, seen_val))[0]
+    old_frames = np.where(~is_new & ~np.isin(labeled_idx, seen_val))[0]
+    print("New labeled frames: %d (previously: %d)" % (len(new_frames), len(old_frames) + len(val_frames)))
+    if len(new_frames) == 0:
+        print("Nothing to fine-tune on.")
+        return
+    if len(val_frames) == 0:
+        print("Error: None of the validation frames of %s are in the data file." % model_path)
+        return
+
+    # All new frames are trained on and the validation frames of the original run are kept for validation
+    num_replay = min(len(old_frames), int(np.round(replay_ratio * len(new_frames))))
+    replay_frames = np.random.choice(old_frames, num_replay, replace=False)
+    frames = np.concatenate((new_frames, replay_frames))
+    print("Replayed frames: %d" % num_replay)
+    print("Validation frames: %d" % len(val_frames))
+
+    model = keras.models.load_model(find_model_weights(model_path))
+    keras.backend.set_value(model.optimizer.lr, learning_rate)
 
+    # One epoch is a single pass over the training frames
+    kwargs.update(
+        net_name=model, frames=frames, val_frames=val_frames, run_name=run_name or kwargs["run_name"] + "_finetune", clean=False,
+        epochs=max_epochs, early_stopping_patience=early_stopping_patience, time_budget_mins=time_budget_mins,
+        batches_per_epoch=max(1, int(np.ceil(len(frames) / kwargs["batch_size"]))), val_batches_per_epoch=0,
+        teacher_path=None, unlabeled_path=None, seed=None)
 
+    return train(data_path, **kwargs)
 
 
 if __name__ == "__main__":
@@ -266,4 +675,4 @@ if __name__ == "__main__":
     # plt.ioff()
 
     # Wrapper for running from commandline
-    clize.run(train)
+    clize.run(train, alt=[resume, finetune])
@@ -1,4 +1,5 @@
 import os
+import json
 import numpy as np
 import re
 from time import time
@@ -22,14 +23,42 @@ def versions(list_devices=False):
         print("Devices:\n" + str(device_lib.list_local_devices()))
 
 
+def configure_threads(threads, cores=None):
+    """
+    Limits the threads used by TensorFlow in this process and optionally pins it to a set of CPU cores.
+
+    :param threads: number of intra- and inter-op threads
+    :param cores: list of CPU core indices to run on (ignored if not supported by the OS)
+    """
+    import keras
+    import tensorflow as tf
+
+    if cores is not None and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    config = tf.ConfigProto(intra_op_parallelism_threads=threads, inter_op_parallelism_threads=threads)
+    config.gpu_options.allow_growth = True
+    keras.backend.set_session(tf.Session(config=config))
+
+
 def find_weights(model_path):
     """ Returns paths to saved weights in the run's subfolder.  """
     weights_folder = os.path.join(model_path, "weights")
+
+    # Use the checkpoint index if available (see checkpoints.AsyncCheckpointer)
+    index_path = os.path.join(weights_folder, "checkpoints.json")
+    if os.path.exists(index_path):
+        with open(index_path, "r") as f:
+            index = json.load(f)
+        checkpoints = sorted(index["checkpoints"], key=lambda x: x["epoch"])
+        weights_paths = [os.path.join(weights_folder, x["path"]) for x in checkpoints]
+        epochs = np.array([x["epoch"] for x in checkpoints], dtype="int64")
+        val_losses = np.array([x[index["monitor"]] for x in checkpoints], dtype="float64")
+        return weights_paths, epochs, val_losses
     weights_paths = sorted(os.listdir(weights_folder))
     weights_paths = [x for x in weights_paths if "weights" in x]
     matches = [re.match("weights[.]([0-9]+)-([0-9.]+)[.]h5", x).groups() for x in weights_paths]
     epochs = np.array([int(x[0]) for x in matches])
-    val_losses = np.array([np.float(x[1]) for x in matches])
+    val_losses = np.array([float(x[1]) for x in matches])
     
     weights_paths = [os.path.join(weights_folder, x) for x in weights_paths]
     return weights_paths, epochs, val_losses
@@ -45,14 +74,147 @@ def find_best_weights(model_path):
         return None
 
 
-def load_dataset(data_path, X_dset="box", Y_dset="confmaps", permute=(0,3,2,1)):
-    """ Loads and normalizes datasets. """
+def find_model_weights(model_path, epoch=None):
+    """
+    Resolves a Keras weights file from a weights path or a run folder.
+
+    :param model_path: path to Keras weights file or run folder with weights subfolder
+    :param epoch: epoch to use if run folder provided instead of Keras weights file. If None, uses the weights with the
+    lowest validation loss, or the final model if none were saved. If "final", uses the final model.
+    """
+    if not os.path.isdir(model_path):
+        return model_path
+
+    weights_paths, epochs, val_losses = find_weights(model_path)
+
+    if epoch == None and len(val_losses) > 0:
+        return weights_paths[np.argmin(val_losses)]
+    elif epoch == "final" or (epoch == None and len(val_losses) == 0):
+        return os.path.join(model_path, "final_model.h5")
+    else:
+        return weights_paths[epoch]
+
+
+def _read_mat_cellstr(f, dset):
+    """ Reads a MATLAB cell array of strings from a v7.3 MAT file. """
+    return ["".join(chr(c) for c in f[ref][()].flatten()) for ref in f[dset][()].flatten()]
+
+
+def load_labels(labels_path):
+    """
+    Loads joint positions and skeleton from a labels file created by the labeling GUI (label_joints).
+
+    :param labels_path: path to *.labels.mat file
+    :return: dict with positions (frames, joints, [x, y]) in 0-based image coordinates (NaN if not labeled), joint
+    names, edges (edges, [src, dst]) as 0-based joint indices and default joint positions (joints, [x, y])
+    """
+    if h5py.is_hdf5(labels_path):
+        # MATLAB v7.3 files are HDF5 with dimensions in reverse order
+        with h5py.File(labels_path, "r") as f:
+            positions = np.transpose(f["positions"][()], (0, 2, 1))
+            nodes = _read_mat_cellstr(f, "skeleton/nodes")
+            edges = f["skeleton/edges"][()].T
+            pos = f["skeleton/pos"][()].T
+    else:
+        from scipy.io import loadmat
+        labels = loadmat(labels_path, squeeze_me=True, struct_as_record=False)
+        positions = np.transpose(np.atleast_3d(labels["positions"]), (2, 0, 1))
+        nodes = [str(x) for x in np.atleast_1d(labels["skeleton"].nodes)]
+        edges = np.atleast_2d(labels["skeleton"].edges)
+        pos = np.atleast_2d(labels["skeleton"].pos)
+
+    return dict(positions=positions.astype("float32") - 1, joint_names=nodes,
+                edges=edges.astype("int64") - 1, pos=pos.astype("float32"))
+
+
+def load_skeleton(data_path):
+    """
+    Loads the skeleton metadata saved in a training set (see generate_training_set).
+
+    :param data_path: path to HDF5 file with a skeleton group
+    :return: dict with joint names, edges (edges, [src, dst]) as 0-based joint indices and horizontal orientation
+    """
+    with h5py.File(data_path, "r") as f:
+        joint_names = f["skeleton"].attrs["jointNames"]
+        if isinstance(joint_names, bytes):
+            joint_names = joint_names.decode()
+        edges = f["skeleton/edges"][()].T.astype("int64") - 1
+        horizontal_orientation = bool(f.attrs.get("horizontalOrientation", 1))
+
+    return dict(joint_names=str(joint_names).split("\n"), edges=edges, horizontal_orientation=horizontal_orientation)
+
+
+def find_skeleton_edges(model_path, skeleton_path=None):
+    """
+    Loads skeleton edges for a model.
+
+    :param model_path: path to Keras weights file or run folder
+    :param skeleton_path: path to HDF5 file with a skeleton group. Defaults to the training set of the run folder.
+    :return: edges (edges, [src, dst]) as 0-based joint indices, or None if no skeleton was found
+    """
+    if skeleton_path is None and os.path.exists(os.path.join(model_path, "training_info.mat")):
+        from scipy.io import loadmat
+        skeleton_path = str(loadmat(os.path.join(model_path, "training_info.mat"), squeeze_me=True)["data_path"])
+    if skeleton_path is None or not os.path.exists(skeleton_path):
+        return None
+    return load_skeleton(skeleton_path)["edges"]
+
+
+def find_symmetric_pairs(joint_names):
+    """ Finds pairs of joint indices with *L/*R naming patterns (e.g., wingL/wingR, legL1/legR1) to swap when mirroring. """
+    pairs = []
+    for i, name in enumerate(joint_names):
+        match = re.match("(.*)L([0-9]*)$", name)
+        if match is not None:
+            name_r = match.group(1) + "R" + match.group(2)
+            if name_r in joint_names:
+                pairs.append((i, joint_names.index(name_r)))
+    return pairs
+
+
+def check_chunk_layout(dset, max_chunks_per_frame=16, max_chunk_bytes=64 * 1024 ** 2):
+    """
+    Warns if a frame dataset (frames, ...) has a chunk layout that makes reading frames slow.
+
+    :param dset: h5py dataset with frames along the first axis
+    :param max_chunks_per_frame: warn if reading a single frame touches more chunks than this
+    :param max_chunk_bytes: warn if a single chunk is larger than this (e.g., one chunk for the whole dataset)
+    :return: True if the layout looks fine
+    """
+    if dset.chunks is None:
+        return True
+
+    chunks_per_frame = np.prod([int(np.ceil(s / c)) for s, c in zip(dset.shape[1:], dset.chunks[1:])])
+    chunk_bytes = np.prod(dset.chunks) * dset.dtype.itemsize
+
+    ok = True
+    if chunks_per_frame > max_chunks_per_frame:
+        print("Warning: %s is split into %d chunks per frame (chunks = %s). Reading frames will be slow." % (dset.name, chunks_per_frame, dset.chunks))
+        ok = False
+    if chunk_bytes > max_chunk_bytes and dset.chunks[0] > 1:
+        print("Warning: %s has %.1f MiB chunks of %d frames (chunks = %s). Reading frames will be slow." % (dset.name, chunk_bytes / 1024 ** 2, dset.chunks[0], dset.chunks))
+        ok = False
+    if not ok:
+        print("Consider converting the file with frame-aligned chunks: python -m leap.rechunk rechunk <in_path> <out_path>")
+
+    return ok
+
+
+def load_dataset(data_path, X_dset="box", Y_dset="confmaps", permute=(0,3,2,1), idx=None):
+    """ Loads and normalizes datasets, optionally only the samples at indices idx. """
     
     # Load
     t0 = time()
     with h5py.File(data_path,"r") as f:
-        X = f[X_dset][:]
-        Y = f[Y_dset][:]
+        check_chunk_layout(f[X_dset])
+        check_chunk_layout(f[Y_dset])
+        if idx is None:
+            X = f[X_dset][:]
+            Y = f[Y_dset][:]
+        else:
+            idx = np.unique(idx) # HDF5 fancy indexing requires increasing indices
+            X = f[X_dset][idx]
+            Y = f[Y_dset][idx]
     print("Loaded %d samples [%.1fs]" % (len(X), time() - t0))
     
     # Adjust dimensions
@@ -63,6 +225,18 @@ def load_dataset(data_path, X_dset="box", Y_dset="confmaps", permute=(0,3,2,1)):
     
     return X, Y
 
+def split_indices(num_samples, val_size=0.15, shuffle=True, seed=None):
+    """ Returns training and validation indices, with val_size as a fraction or number of samples. """
+    if val_size < 1:
+        val_size = int(np.round(num_samples * val_size))
+
+    idx = np.arange(num_samples)
+    if shuffle:
+        rng = np.random if seed is None else np.random.RandomState(seed)
+        rng.shuffle(idx)
+
+    return idx[val_size:], idx[:val_size]
+
 def preprocess(X, permute=(0,3,2,1)):
     """ Normalizes input data. """
     
@@ -77,4 +251,41 @@ def preprocess(X, permute=(0,3,2,1)):
     if X.dtype == "uint8":
         X = X.astype("float32") / 255
     
-    return X
\ No newline at end of file
+    return X
+
+
+def downsample_confmaps(Y, output_stride=1):
+    """ Downsamples confidence maps (samples, height, width, channels) by averaging output_stride x output_stride blocks. """
+    if output_stride == 1:
+        return Y
+
+    # Pad to a multiple of the stride (matches "same" padding of the network pooling layers)
+    pad_rows = -Y.shape[1] % output_stride
+    pad_cols = -Y.shape[2] % output_stride
+    if pad_rows > 0 or pad_cols > 0:
+        Y = np.pad(Y, ((0, 0), (0, pad_rows), (0, pad_cols), (0, 0)), mode="constant")
+
+    n, h, w, c = Y.shape
+    return Y.reshape(n, h // output_stride, output_stride, w // output_stride, output_stride, c).mean(axis=(2, 4))
+
+
+def get_output_stride(model):
+    """ Returns the downsampling factor of the (final) output of a model relative to its input. """
+    output_shape = model.output_shape
+    if type(output_shape) == list:
+        output_shape = output_shape[-1]
+    return int(round(model.input_shape[1] / output_shape[1]))
+
+
+
+def select_confmaps(Y, output_names):
+    """ Returns the final confidence maps of the predictions of a model, skipping its part affinity fields output. """
+    if type(Y) != list:
+        return Y
+    return [y for y, name in zip(Y, output_names) if name != "pafs"][-1]
+
+
+def split_targets(Y, output_names, paf_channels=0):
+    """ Maps training targets with part affinity fields in their last paf_channels channels to the outputs of a model. """
+    confmaps, pafs = (Y[..., :-paf_channels], Y[..., -paf_channels:]) if paf_channels > 0 else (Y, None)
+    return {name: pafs if name == "pafs" else confmaps for name in output_names}
@@ -1,5 +1,6 @@
 import numpy as np
 import matplotlib.pyplot as plt
+from leap.utils import select_confmaps
 plt.switch_backend('agg')
 
 
@@ -28,9 +29,7 @@ def show_pred(net, X, Y, joint_idx=0, alpha_pred=0.7, save_path=None, show_figur
         Y = Y.squeeze(axis=0)
         
     # Predict
-    Y2 = net.predict(X)
-    if type(Y2) == list:
-        Y2 = Y2[-1]
+    Y2 = select_confmaps(net.predict(X), net.output_names)
     Y2 = Y2.squeeze(axis=0)
     X = X.squeeze()
     
@@ -46,6 +45,11 @@ def show_pred(net, X, Y, joint_idx=0, alpha_pred=0.7, save_path=None, show_figur
         peak_coord = np.unravel_index(np.argmax(Yi), Yi.shape)
         pks_pred.append(peak_coord)
     
+    # Map confmap coordinates to image coordinates if predicted at a lower resolution
+    stride = X.shape[0] // Y2.shape[0]
+    pks_gt = [np.array(pk) * stride + (stride - 1) / 2 for pk in pks_gt]
+    pks_pred = [np.array(pk) * stride + (stride - 1) / 2 for pk in pks_pred]
+    
     # Show box image
     plt.figure(figsize=(6,6))
     plt.imshow(X, cmap="gray")
@@ -55,7 +59,7 @@ def show_pred(net, X, Y, joint_idx=0, alpha_pred=0.7, save_path=None, show_figur
         Y2[...,i] /= Y2[...,i].max()
         
     # Show prediction overlay
-    plt.imshow(Y2[:,:,joint_idx], alpha=alpha_pred)
+    plt.imshow(Y2[:,:,joint_idx], alpha=alpha_pred, extent=(-0.5, X.shape[1] - 0.5, X.shape[0] - 0.5, -0.5))
     
     # Plot peak markers
     for i in range(Y2.shape[-1]):
@@ -106,9 +110,7 @@ def show_confmap_grid(net, X, Y, plot=True, save_path=None, show_figure=False):
         Y = Y.squeeze(axis=0)
         
     # Predict
-    Y2 = net.predict(X)
-    if type(Y2) == list:
-        Y2 = Y2[-1]
+    Y2 = select_confmaps(net.predict(X), net.output_names)
     Y2 = Y2.squeeze(axis=0)
     X = X.squeeze()
     
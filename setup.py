@@ -5,6 +5,8 @@ setup(
     version="0.0.1",
     author="Talmo Pereira",
     author_email="talmo@princeton.edu",
+    packages=["leap"],
+    entry_points={"console_scripts": ["leap=leap.cli:main"]},
     install_requires=[
         "numpy>=1.14.1",
         "h5py>=2.7.1",
@@ -0,0 +1,53 @@
+import os
+import sys
+import numpy as np
+import h5py
+import pytest
+from scipy.io import savemat
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope="session")
+def box_path(tmp_path_factory):
+    """ Synthetic box file with 64 frames of 32 x 32 x 1 and 5 joints (true positions in /joints). """
+    from leap.synthetic import write_box
+    return write_box(str(tmp_path_factory.mktemp("data") / "box.h5"), num_frames=64, img_size=32, num_joints=5, seed=0)
+
+
+@pytest.fixture(scope="session")
+def training_path(tmp_path_factory):
+    """ Synthetic training set with 48 frames of 32 x 32 x 1 and 5 joints. """
+    from leap.synthetic import write_training_set
+    return write_training_set(str(tmp_path_factory.mktemp("data") / "training.h5"), num_frames=48, img_size=32,
+                              num_joints=5, sigma=2.0, seed=0)
+
+
+@pytest.fixture(scope="session")
+def model_path(tmp_path_factory):
+    """ Untrained leap_cnn for 32 x 32 x 1 boxes with 5 joints. """
+    pytest.importorskip("keras")
+    from leap.models import leap_cnn
+    path = str(tmp_path_factory.mktemp("models") / "leap_cnn.h5")
+    leap_cnn((32, 32, 1), 5, filters=4).save(path)
+    return path
+
+
+# Frames of the box fixture that are labeled in the labels fixture
+LABELED_FRAMES = np.array([2, 5, 7, 11, 40])
+
+
+@pytest.fixture(scope="session")
+def labels_path(box_path):
+    """ label_joints *.labels.mat file next to the box fixture with the true joints of LABELED_FRAMES. """
+    with h5py.File(box_path, "r") as f:
+        joints = f["joints"][()] # (frames, [x, y], joints), 1-based
+    positions = np.full(joints.shape, np.nan)
+    positions[LABELED_FRAMES] = joints[LABELED_FRAMES]
+    num_joints = joints.shape[-1]
+    skeleton = dict(nodes=np.array(["j%d" % i for i in range(num_joints)], dtype=object),
+                    edges=np.array([[i + 1, i + 2] for i in range(num_joints - 1)], dtype="float64"),
+                    pos=np.zeros((num_joints, 2)))
+    path = os.path.splitext(box_path)[0] + ".labels.mat"
+    savemat(path, dict(positions=np.transpose(positions, (2, 1, 0)), skeleton=skeleton))
+    return path
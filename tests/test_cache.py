@@ -0,0 +1,62 @@
+import os
+import numpy as np
+import h5py
+
+from leap.cache import PredictionCache, evict
+
+
+def test_prediction_cache_serves_ranges(tmp_path, box_path):
+    weights_path = str(tmp_path / "weights.h5")
+    with h5py.File(weights_path, "w") as f:
+        f["w"] = np.arange(10)
+
+    cache = PredictionCache(str(tmp_path / "cache"))
+    key = cache.key(weights_path, box_path, "/box", peaks="Maxima2D")
+    assert cache.key(weights_path, box_path, "/box", peaks="Maxima2D") == key
+    assert cache.key(weights_path, box_path, "/box", peaks="pafs") != key
+
+    Ypk = np.random.rand(64, 3, 5).astype("float32")
+    cache.put(key, 10, Ypk[10:20], output_stride=1)
+    cache.put(key, 30, Ypk[30:40])
+    hits, misses = cache.get(key, 5, 35)
+    assert misses == [(5, 10), (20, 30)]
+    assert [(s, len(y)) for s, y in hits] == [(10, 10), (30, 5)]
+    assert np.array_equal(hits[1][1], Ypk[30:35])
+    assert cache.metadata(key)["output_stride"] == 1
+
+    # Same contents under another path share the key
+    copy_path = str(tmp_path / "copy.h5")
+    with open(weights_path, "rb") as f_in, open(copy_path, "wb") as f_out:
+        f_out.write(f_in.read())
+    assert cache.key(copy_path, box_path, "/box", peaks="Maxima2D") == key
+
+
+def test_evict_least_recently_used(tmp_path):
+    for i, name in enumerate(["a", "b", "c"]):
+        os.makedirs(str(tmp_path / name))
+        with open(str(tmp_path / name / "data"), "wb") as f:
+            f.write(b"x" * 100)
+        os.utime(str(tmp_path / name), (i, i))
+    assert evict(str(tmp_path), 150, keep=("a",)) == ["b", "c"]
+    assert sorted(os.listdir(str(tmp_path))) == ["a"]
+
+
+def test_load_cached_split(tmp_path, training_path):
+    from leap.cache import load_cached_split
+    from leap.utils import load_dataset, split_indices
+
+    cache_dir = str(tmp_path / "cache")
+    X, Y, val_X, val_Y, train_idx, val_idx = load_cached_split(cache_dir, training_path, seed=0, output_stride=2)
+    assert isinstance(X, np.memmap)
+    expected_train_idx, expected_val_idx = split_indices(48, val_size=0.15, seed=0)
+    assert np.array_equal(train_idx, expected_train_idx) and np.array_equal(val_idx, expected_val_idx)
+
+    box, confmap = load_dataset(training_path)
+    assert np.array_equal(X, box[train_idx])
+    assert np.array_equal(val_X, box[val_idx])
+    assert Y.shape == (len(train_idx), 16, 16, 5)
+    assert len(os.listdir(cache_dir)) == 1
+
+    # Loaded from the same entry
+    X2 = load_cached_split(cache_dir, training_path, seed=0, output_stride=2)[0]
+    assert np.array_equal(X, X2) and len(os.listdir(cache_dir)) == 1
@@ -0,0 +1,33 @@
+import os
+import numpy as np
+import pytest
+
+keras = pytest.importorskip("keras")
+
+from leap.checkpoints import AsyncCheckpointer, load_index
+
+
+def test_async_checkpointer_retention(tmp_path, model_path):
+    model = keras.models.load_model(model_path)
+    run_path = str(tmp_path)
+    os.makedirs(os.path.join(run_path, "weights"))
+
+    checkpointer = AsyncCheckpointer(run_path, save_every_epoch=True, keep_best=2, state_fn=lambda: {"lr": 0.1}, verbose=0)
+    checkpointer.set_model(model)
+    checkpointer.on_train_begin()
+    for epoch, val_loss in enumerate([5.0, 3.0, 4.0, 1.0, 2.0, 6.0]):
+        checkpointer.on_epoch_end(epoch, {"val_loss": val_loss})
+    checkpointer.on_train_end()
+
+    index = load_index(run_path)
+    assert [x["epoch"] for x in index["checkpoints"]] == [4, 5, 6] # 2 best plus the latest
+    assert sorted(os.listdir(os.path.join(run_path, "weights"))) == sorted(
+        [x["path"] for x in index["checkpoints"]] + ["checkpoints.json"])
+    assert index["best_epoch"] == 4 and index["best_value"] == 1.0
+    assert index["latest_epoch"] == 6 and index["state"] == {"lr": 0.1}
+
+    # Written checkpoints load like keras.models.save_model files
+    latest = keras.models.load_model(os.path.join(run_path, index["latest"]))
+    for w, w_latest in zip(model.get_weights(), latest.get_weights()):
+        assert np.array_equal(w, w_latest)
+    keras.models.load_model(os.path.join(run_path, "best_model.h5"))
@@ -0,0 +1,86 @@
+import os
+import subprocess
+import sys
+import pytest
+
+import leap
+from leap.cli import COMMANDS, main
+
+
+def test_usage_lists_commands(capsys):
+    main([])
+    out = capsys.readouterr().out
+    assert out.startswith("Usage: leap")
+    for name in COMMANDS:
+        assert name in out
+
+
+def test_unknown_command(capsys):
+    with pytest.raises(SystemExit) as e:
+        main(["nope"])
+    assert e.value.code == 2
+    assert "Error: Unknown command: nope" in capsys.readouterr().out
+
+
+def test_commands_resolve_to_functions():
+    package_dir = os.path.dirname(leap.__file__)
+    for name in leap.__all__:
+        assert os.path.exists(os.path.join(package_dir, name + ".py"))
+    for target, _ in COMMANDS.values():
+        module_name, fn_name = target.split(":")
+        module = module_name.split(".")[1]
+        assert module in leap.__all__
+        with open(os.path.join(package_dir, module + ".py")) as f:
+            assert "def %s(" % fn_name in f.read()
+
+
+def test_import_does_not_load_keras():
+    code = "import sys, leap, leap.cli; leap.cli.main(['info', '--help']); assert 'keras' not in sys.modules"
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    subprocess.run([sys.executable, "-c", code], cwd=root, check=True, stdout=subprocess.DEVNULL)
+
+
+def test_lazy_submodules():
+    # Must not rely on a module-level __getattr__, which Python 3.6 ignores
+    assert "__getattr__" not in vars(leap)
+    assert leap.synthetic.write_box is not None
+    assert "training" in dir(leap)
+    with pytest.raises(AttributeError):
+        leap.nope
+
+
+def test_weights(tmp_path, capsys):
+    (tmp_path / "weights").mkdir()
+    for name in ["weights.001-0.500000000.h5", "weights.002-0.250000000.h5", "weights.003-0.300000000.h5"]:
+        (tmp_path / "weights" / name).touch()
+    (tmp_path / "final_model.h5").touch()
+    main(["weights", str(tmp_path)])
+    lines = capsys.readouterr().out.splitlines()
+    assert len(lines) == 5
+    assert lines[2].endswith("weights.002-0.250000000.h5 (best)")
+    assert lines[4].endswith("final_model.h5")
+
+    main(["weights", str(tmp_path / "missing")])
+    assert capsys.readouterr().out.startswith("Error:")
+
+
+def test_info(box_path, capsys):
+    main(["info", box_path])
+    out = capsys.readouterr().out
+    assert "box: (64, 1, 32, 32) uint8" in out
+    assert "joints:" in out
+
+
+@pytest.mark.parametrize("command", sorted(COMMANDS))
+def test_command_help(command, capsys):
+    import importlib
+    module_name = COMMANDS[command][0].split(":")[0]
+    try:
+        importlib.import_module(module_name)
+    except ImportError as e:
+        pytest.skip("%s is not importable: %s" % (module_name, e))
+
+    main([command, "--help"])
+    out, err = capsys.readouterr()
+    assert out.startswith("Usage: leap " + command)
+    assert "WARNING" not in err and ":param" not in out
@@ -0,0 +1,58 @@
+import numpy as np
+import h5py
+
+from leap.cluster_sample import IncrementalPCA, MiniBatchKMeans, assign_clusters
+
+
+def test_incremental_pca_matches_svd():
+    rng = np.random.RandomState(0)
+    # Rank 5 data: truncating to 5 components between batches loses nothing
+    X = (rng.randn(300, 5) * np.linspace(5, 1, 5)) @ rng.randn(5, 20) + 3
+    pca = IncrementalPCA(5)
+    for chunk in np.array_split(X, 6):
+        pca.partial_fit(chunk)
+
+    _, S, Vt = np.linalg.svd(X - X.mean(axis=0), full_matrices=False)
+    assert pca.n_samples_seen == 300
+    assert np.allclose(pca.mean, X.mean(axis=0))
+    assert np.allclose(pca.var, X.var(axis=0))
+    assert np.allclose(pca.singular_values, S[:5], rtol=1e-6)
+    assert np.allclose(np.abs(np.sum(pca.components * Vt[:5], axis=1)), 1, atol=1e-6)
+    assert np.allclose(pca.explained_variance_ratio, S[:5] ** 2 / np.sum(S ** 2), rtol=1e-6)
+
+
+def test_minibatch_kmeans_separates_clusters():
+    rng = np.random.RandomState(0)
+    centers = np.array([[0, 0], [10, 0], [0, 10]], dtype="float32")
+    labels = rng.randint(3, size=600)
+    X = (centers[labels] + rng.randn(600, 2)).astype("float32")
+    kmeans = MiniBatchKMeans(3, seed=0)
+    for chunk in np.array_split(X, 6):
+        kmeans.partial_fit(chunk)
+
+    assert kmeans.counts.sum() == 600
+    pred = assign_clusters(X, kmeans.centers)
+    for j in range(3):
+        assert len(np.unique(pred[labels == j])) == 1
+    assert len(np.unique(pred)) == 3
+
+
+def test_cluster_sample_command_seed(tmp_path, box_path):
+    from leap.cli import main
+
+    outputs = []
+    for name in ["a.h5", "b.h5"]:
+        out_path = str(tmp_path / name)
+        main(["cluster-sample", out_path, box_path, "--num-clusters=4", "--samples-per-cluster=3", "--pcs=8",
+              "--chunk-frames=16", "--seed=0", "--shuffle"])
+        with h5py.File(out_path, "r") as f:
+            outputs.append({k: f[k][()] for k in ["box", "dataIdx", "exptID", "clusters/G", "clusters/counts", "pca/score"]})
+
+    a, b = outputs
+    for k in a:
+        assert np.array_equal(a[k], b[k])
+    assert len(a["dataIdx"]) == np.minimum(a["clusters/counts"], 3).sum()
+    assert np.all(a["exptID"] == 1)
+    with h5py.File(box_path, "r") as f:
+        for x, i in zip(a["box"], a["dataIdx"]):
+            assert np.array_equal(x, f["box"][i - 1])
@@ -0,0 +1,81 @@
+import socket
+import threading
+import numpy as np
+import pytest
+
+keras = pytest.importorskip("keras")
+
+from leap.distributed import Communicator, make_distributed, print_scaling
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def test_communicator_allreduce_and_broadcast():
+    address = ("127.0.0.1", free_port())
+    world_size = 3
+    results = [None] * world_size
+
+    def run(rank):
+        comm = Communicator(rank, world_size, address=address, timeout=10)
+        try:
+            mean = comm.allreduce(np.full(4, rank, dtype="float32"))
+            weighted = comm.allreduce(np.full((2, 2), rank, dtype="float32"), weight=rank + 1)
+            obj = comm.broadcast({"rank": rank})
+            results[rank] = (mean, weighted, obj)
+        finally:
+            comm.close()
+
+    threads = [threading.Thread(target=run, args=(r,)) for r in range(world_size)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(30)
+
+    for mean, weighted, obj in results:
+        assert mean.dtype == "float32"
+        assert np.allclose(mean, 1.0)
+        assert weighted.shape == (2, 2)
+        assert np.allclose(weighted, (0 * 1 + 1 * 2 + 2 * 3) / 6)
+        assert obj == {"rank": 0}
+
+
+def test_print_scaling(capsys):
+    stats = dict(steps=10, samples=320, compute_secs=0.8, comm_secs=0.2, apply_secs=0.0)
+    print_scaling(stats, 2)
+    out = capsys.readouterr().out
+    assert "Throughput: 640.0 samples/s" in out
+    assert "Communication overhead: 20.0%" in out
+    assert "Scaling efficiency" not in out
+
+    print_scaling(stats, 2, baseline_throughput=400)
+    assert "Scaling efficiency: 80.0%" in capsys.readouterr().out
+
+
+def test_make_distributed_single_worker_matches_keras():
+    from keras.layers import Input, Dense
+    from keras.models import Model
+    from keras.optimizers import SGD
+
+    def build():
+        x_in = Input((3,))
+        model = Model(x_in, Dense(2)(x_in))
+        model.compile(optimizer=SGD(lr=0.1), loss="mean_squared_error")
+        return model
+
+    rng = np.random.RandomState(0)
+    X, Y = rng.rand(8, 3).astype("float32"), rng.rand(8, 2).astype("float32")
+    reference, model = build(), build()
+    model.set_weights(reference.get_weights())
+
+    stats = make_distributed(model, Communicator(0, 1))
+    loss = model.train_on_batch(X, Y)
+    expected_loss = reference.train_on_batch(X, Y)
+
+    assert np.isclose(loss, expected_loss)
+    for w, w_ref in zip(model.get_weights(), reference.get_weights()):
+        assert np.allclose(w, w_ref, atol=1e-6)
+    assert stats["steps"] == 1 and stats["samples"] == 8
@@ -0,0 +1,64 @@
+import numpy as np
+import h5py
+
+from leap.evaluation import compute_errors, ErrorAccumulator, evaluate_predictions
+
+from conftest import LABELED_FRAMES
+
+
+def test_error_accumulator_matches_numpy():
+    errors = np.random.RandomState(0).gamma(2, 2, size=(1000, 3))
+    errors[::7, 1] = np.nan
+    acc = ErrorAccumulator(3, bin_width=0.01)
+    for chunk in np.array_split(errors, 7):
+        part = ErrorAccumulator(3, bin_width=0.01)
+        part.update(chunk)
+        acc.merge(part)
+
+    metrics = acc.summary(percentiles=(50, 90), thresholds=[2, 5])
+    assert np.array_equal(metrics["count"], (~np.isnan(errors)).sum(axis=0))
+    assert np.allclose(metrics["mean"], np.nanmean(errors, axis=0))
+    assert np.allclose(metrics["rmse"], np.sqrt(np.nanmean(errors ** 2, axis=0)))
+    assert np.allclose(metrics["percentile_errors"], np.nanpercentile(errors, [50, 90], axis=0).T, atol=0.02)
+    assert np.allclose(metrics["pck"][:, 1], np.nanmean(np.where(np.isnan(errors), np.nan, errors < 5), axis=0))
+
+
+def test_evaluate_predictions(tmp_path, box_path, labels_path):
+    with h5py.File(box_path, "r") as f:
+        joints = f["joints"][()] - 1
+
+    # Predictions of frames 1 onwards with known offsets
+    start_frame = 1
+    offsets = np.random.RandomState(0).randint(-3, 4, size=joints.shape).astype("float32")
+    pred_path = str(tmp_path / "preds.h5")
+    with h5py.File(pred_path, "w") as f:
+        f.attrs["box_path"] = box_path
+        f.attrs["start_frame"] = start_frame
+        f["positions_pred"] = (joints + offsets)[start_frame:]
+
+    metrics = evaluate_predictions(pred_path, chunk_size=4, verbose=False)
+    expected = compute_errors(joints[LABELED_FRAMES] + offsets[LABELED_FRAMES], joints[LABELED_FRAMES])["euclidean"]
+    assert metrics["count_all"] == expected.size
+    assert np.allclose(metrics["mean"], expected.mean(axis=0))
+
+
+def test_evaluate_predictions_multi_instance(tmp_path, box_path, labels_path):
+    with h5py.File(box_path, "r") as f:
+        joints = f["joints"][()] - 1
+
+    # Instances: the labeled animal with known offsets, a distant animal and an empty slot, in varying order
+    offsets = np.random.RandomState(0).randint(-3, 4, size=joints.shape).astype("float32")
+    instances = np.stack([joints + offsets, joints + 20, np.full(joints.shape, -1)], axis=1)
+    order = np.array([np.roll(np.arange(3), i) for i in range(len(joints))])
+    instances = instances[np.arange(len(joints))[:, None], order]
+    instances[LABELED_FRAMES[0], :, :, 0] = -1 # first joint missing in every instance
+    pred_path = str(tmp_path / "preds.h5")
+    with h5py.File(pred_path, "w") as f:
+        f.attrs["box_path"] = box_path
+        f["positions_pred"] = instances
+
+    metrics = evaluate_predictions(pred_path, chunk_size=4, verbose=False)
+    expected = compute_errors(joints[LABELED_FRAMES] + offsets[LABELED_FRAMES], joints[LABELED_FRAMES])["euclidean"]
+    expected[0, 0] = np.nan
+    assert metrics["count_all"] == expected.size - 1
+    assert np.allclose(metrics["mean"], np.nanmean(expected, axis=0))
@@ -0,0 +1,68 @@
+import numpy as np
+import h5py
+
+from leap.gait_analysis import bouts, classify_gait, gait_analysis, TRIPOD, TETRAPOD, NON_CANONICAL
+
+
+def test_bouts():
+    mask = np.array([[1, 1, 0, 1, 0, 0], [0, 0, 0, 0, 0, 0], [1, 1, 1, 1, 1, 1]], dtype="bool")
+    rows, starts, durations = bouts(mask)
+    assert rows.tolist() == [0, 0, 2]
+    assert starts.tolist() == [0, 3, 0]
+    assert durations.tolist() == [2, 1, 6]
+
+
+def test_classify_gait():
+    num_stance = np.array([3, 3, 4, 4, 2, 6, 3, 3, 3, 4, 3, 3])
+    stance = np.arange(6)[:, None] < num_stance[None, :]
+    expected = np.where(num_stance == 3, TRIPOD, np.where(num_stance == 4, TETRAPOD, NON_CANONICAL))
+    assert np.array_equal(classify_gait(stance, window=1), expected)
+
+    # Single frames are outvoted by their neighbors
+    smoothed = classify_gait(stance, window=3)
+    assert smoothed.dtype == "uint8"
+    assert smoothed[9] == TRIPOD and smoothed[2] == TETRAPOD
+
+
+def write_tripod(path, num_frames=200, period=20, phase=0):
+    """ Predictions of 6 legs (joints 0-5) around a center joint (6) alternating in two tripods. """
+    t = np.arange(num_frames) + phase
+    positions = np.zeros((num_frames, 2, 7), dtype="float32")
+    for leg, offset in enumerate([0, 1, 0, 1, 0, 1]):
+        positions[:, 0, leg] = 50 + 10 * np.sin(2 * np.pi * (t / period + offset / 2))
+        positions[:, 1, leg] = 10 * leg
+    positions[:, 0, 6] = 50
+    with h5py.File(path, "w") as f:
+        f["positions_pred"] = positions
+
+
+def test_gait_analysis_tripod(tmp_path):
+    for i in range(3):
+        write_tripod(str(tmp_path / ("fly%d.h5" % i)), phase=i)
+    out_path = str(tmp_path / "gait.h5")
+    gait_analysis(out_path, str(tmp_path / "fly*.h5"), legs="0,1,2,3,4,5", center_joint=6, workers=2,
+                  smoothing_window=1, gait_window=5)
+
+    with h5py.File(out_path, "r") as f:
+        assert [n.decode() for n in f["names"][()]] == ["fly0", "fly1", "fly2"]
+        assert f["num_frames"][()].tolist() == [200, 200, 200]
+        assert np.all(f["gait_mode_fractions"][:, 0] > 0.9)
+        assert f["sessions/fly0/stance"].shape == (6, 200)
+
+        # Legs are in stance for half of each period
+        stance = f["stance_durations"][()]
+        assert stance.shape[0] == 6
+        assert np.argmax(stance.sum(axis=0)) == 10
+        assert np.all(np.isnan(f["mean_forward_velocity"][()]))
+
+
+def test_gait_analysis_skips_multi_instance(tmp_path, capfd):
+    write_tripod(str(tmp_path / "fly0.h5"))
+    with h5py.File(str(tmp_path / "fly1.h5"), "w") as f:
+        f["positions_pred"] = np.zeros((200, 2, 2, 7), dtype="int32")
+    out_path = str(tmp_path / "gait.h5")
+    gait_analysis(out_path, str(tmp_path / "fly*.h5"), legs="0,1,2,3,4,5", center_joint=6, workers=1)
+
+    assert "multi-instance predictions are not supported" in capfd.readouterr().out
+    with h5py.File(out_path, "r") as f:
+        assert [n.decode() for n in f["names"][()]] == ["fly0"]
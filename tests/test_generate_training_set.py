@@ -0,0 +1,69 @@
+import numpy as np
+import h5py
+
+from leap.generate_training_set import render_confmaps, render_pafs, generate_training_set
+from leap.utils import load_labels
+
+from conftest import LABELED_FRAMES
+
+
+def test_render_confmaps_peaks_at_points():
+    points = np.array([[[3, 5], [10.5, 2], [np.nan, np.nan]]], dtype="float32")
+    confmaps = render_confmaps(points, (12, 16), sigma=1.5)
+    assert confmaps.shape == (1, 12, 16, 3)
+    assert np.unravel_index(confmaps[0, :, :, 0].argmax(), (12, 16)) == (5, 3)
+    assert np.isclose(confmaps[0, 5, 3, 0], 1)
+    assert np.isclose(confmaps[0, 2, 10, 1], confmaps[0, 2, 11, 1])
+    assert confmaps[0, :, :, 2].max() == 0
+
+    # Not normalized: scaled like a PDF
+    assert np.isclose(render_confmaps(points[:, :1], (12, 16), sigma=1.5, normalize=False).max(), 1 / (1.5 * np.sqrt(2 * np.pi)))
+
+
+def test_render_pafs_matches_distance_to_segment():
+    points = np.array([[[4, 5], [20, 13], [np.nan, np.nan]]], dtype="float32")
+    edges = np.array([[0, 1], [1, 2]])
+    pafs = render_pafs(points, edges, (24, 28), sigma=2.5)
+    assert pafs.shape == (1, 24, 28, 4)
+
+    # Brute force: unit vector at pixels within sigma of the segment
+    src, dst = points[0, 0], points[0, 1]
+    v = (dst - src) / np.linalg.norm(dst - src)
+    rows, cols = np.mgrid[:24, :28]
+    d = np.stack((cols - src[0], rows - src[1]), axis=-1)
+    along, across = d @ v, d @ np.array([-v[1], v[0]])
+    inside = (along >= 0) & (along <= np.linalg.norm(dst - src)) & (np.abs(across) <= 2.5)
+    assert np.allclose(pafs[0, :, :, 0], inside * v[0], atol=1e-5)
+    assert np.allclose(pafs[0, :, :, 1], inside * v[1], atol=1e-5)
+
+    # Edges with missing points are not rendered
+    assert pafs[0, :, :, 2:].max() == 0
+
+    # Overlapping instances are averaged
+    two = render_pafs(np.stack((points, points), axis=1), edges, (24, 28), sigma=2.5)
+    assert np.allclose(two, pafs)
+
+
+def test_generate_training_set(tmp_path, box_path, labels_path):
+    labeled = LABELED_FRAMES
+    with h5py.File(box_path, "r") as f:
+        joints = f["joints"][labeled] - 1
+    assert np.allclose(load_labels(labels_path)["positions"][labeled], np.transpose(joints, (0, 2, 1)))
+
+    save_path = generate_training_set(box_path, labels_path=labels_path, save_path=str(tmp_path / "training.h5"),
+                                      sigma=2.0, chunk_size=2)
+    with h5py.File(save_path, "r") as f, h5py.File(box_path, "r") as f_box:
+        labeled_idx = f["labeledIdx"][()].astype("int64") - 1
+        assert sorted(labeled_idx) == sorted(labeled)
+        for i, idx in enumerate(labeled_idx):
+            assert np.array_equal(f["box"][i], f_box["box"][idx])
+        assert f["confmaps"].shape == (5, 5, 32, 32)
+        assert f["skeleton/edges"].shape == (2, 4)
+
+        # Peaks of the confidence maps at the labels (MATLAB order: (frames, joints, width, height))
+        confmaps = f["confmaps"][()]
+        points = f["joints"][()] - 1
+        for i in range(len(confmaps)):
+            for j in range(confmaps.shape[1]):
+                x, y = np.unravel_index(confmaps[i, j].argmax(), confmaps.shape[2:])
+                assert abs(x - points[i, 0, j]) <= 0.5 and abs(y - points[i, 1, j]) <= 0.5
@@ -0,0 +1,104 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("keras")
+
+from leap.image_augmentation import PairedImageAugmenter
+
+
+def test_mirror_flips_and_swaps_channels():
+    X = np.random.rand(16, 8, 8, 1).astype("float32")
+    Y = np.random.rand(16, 8, 8, 3).astype("float32")
+    augmenter = PairedImageAugmenter(X, Y, batch_size=16, theta=0, mirror=True, swap_pairs=[(0, 2)],
+                                     horizontal_orientation=True)
+    np.random.seed(0)
+    X_aug, Y_aug = augmenter[0]
+
+    flipped = np.array([not np.allclose(a, b) for a, b in zip(X_aug, X)])
+    assert 0 < flipped.sum() < len(X)
+    assert np.allclose(X_aug[flipped], X[flipped][:, ::-1])
+    assert np.allclose(Y_aug[flipped], Y[flipped][:, ::-1][..., [2, 1, 0]])
+    assert np.allclose(Y_aug[~flipped], Y[~flipped])
+
+
+def test_sampling_probabilities_and_weights():
+    X = np.zeros((4, 8, 8, 1), dtype="float32")
+    Y = np.zeros((4, 8, 8, 2), dtype="float32")
+    augmenter = PairedImageAugmenter(X, Y, batch_size=4, theta=0, sampling=True, sampling_smoothing=0.5,
+                                     sampling_uniform=0.2)
+    assert np.allclose(augmenter.sampling_probabilities(), 0.25)
+
+    # Moving average starts at the first loss
+    augmenter.update_losses(np.array([0, 1]), np.array([1.0, 3.0]))
+    augmenter.update_losses(np.array([0]), np.array([3.0]))
+    assert np.allclose(augmenter.sample_loss[:2], [2.0, 3.0])
+    assert np.isnan(augmenter.sample_loss[2:]).all()
+
+    # Unseen samples count as the hardest seen one
+    p = augmenter.sampling_probabilities()
+    loss = np.array([2.0, 3.0, 3.0, 3.0])
+    assert np.allclose(p, 0.8 * loss / loss.sum() + 0.2 / 4)
+    assert np.isclose(p.sum(), 1)
+
+    np.random.seed(0)
+    X_aug, Y_aug, weights = augmenter[0]
+    idx, _, _ = augmenter.pending[-1]
+    expected = 1 / (4 * p[idx])
+    assert np.allclose(weights, expected / expected.mean())
+
+
+def limb_fields(points, edges, img_size=32):
+    """ Confidence maps and part affinity fields (1, height, width, joints + 2 * edges) of one frame. """
+    from leap.generate_training_set import render_confmaps, render_pafs
+    points = np.asarray(points, dtype="float32")[None]
+    return np.concatenate((render_confmaps(points, (img_size, img_size), sigma=1.5),
+                           render_pafs(points, edges, (img_size, img_size), sigma=2)), axis=-1)
+
+
+def peak(confmap):
+    row, col = np.unravel_index(np.argmax(confmap), confmap.shape)
+    return np.array([col, row])
+
+
+@pytest.mark.parametrize("theta", [30, 90, -135])
+def test_rotated_pafs_point_along_rotated_limb(theta):
+    import cv2
+    points = np.array([[10, 16], [22, 16]])
+    edges = np.array([[0, 1]])
+    Y = limb_fields(points, edges)
+    X = np.zeros((1, 32, 32, 1), dtype="float32")
+    augmenter = PairedImageAugmenter(X, Y, batch_size=1, theta=(theta, theta), paf_edges=edges)
+    _, Y_aug = augmenter[0]
+    Y_aug = Y_aug[0]
+
+    # Limb rotated the same way as the images
+    T = cv2.getRotationMatrix2D((16, 16), theta, 1.0)
+    src, dst = [T[:, :2] @ p + T[:, 2] for p in points]
+    assert np.allclose(peak(Y_aug[..., 0]), src, atol=1)
+    assert np.allclose(peak(Y_aug[..., 1]), dst, atol=1)
+
+    # Fields on the rotated limb point from its source to its destination
+    direction = (dst - src) / np.linalg.norm(dst - src)
+    for t in [0.3, 0.5, 0.7]:
+        x, y = np.round(src + t * (dst - src)).astype(int)
+        assert np.allclose(Y_aug[y, x, 2:], direction, atol=0.05)
+
+
+def test_mirrored_pafs_follow_swapped_limbs():
+    # Joint 0 in the middle with left (1) and right (2) joints on either side
+    points = np.array([[16, 10], [10, 20], [22, 20]])
+    edges = np.array([[0, 1], [2, 0]])
+    Y = limb_fields(points, edges)
+    X = np.zeros((1, 32, 32, 1), dtype="float32")
+    augmenter = PairedImageAugmenter(X, Y, batch_size=1, theta=0, mirror=True, swap_pairs=[(1, 2)],
+                                     horizontal_orientation=False, paf_edges=edges)
+    np.random.seed(1)
+    while True:
+        X_aug, Y_aug = augmenter[0]
+        if not np.allclose(Y_aug, Y):
+            break
+
+    # Same as rendering the flipped points with left and right joints swapped (edge 0 maps onto edge 1 reversed)
+    flipped = np.array([[31 - x, y] for x, y in points])[[0, 2, 1]]
+    expected = limb_fields(flipped, edges)
+    assert np.allclose(Y_aug, expected, atol=1e-5)
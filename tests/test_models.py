@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("keras")
+
+from leap import models
+
+
+def test_leap_mobile_output_shape():
+    model = models.leap_mobile((32, 32, 1), 5, filters=32, width_multiplier=0.5)
+    assert model.output_shape == (None, 32, 32, 5)
+    assert model.predict(np.zeros((2, 32, 32, 1), dtype="float32")).shape == (2, 32, 32, 5)
+
+    # Fewer filters in every layer
+    assert model.count_params() < models.leap_mobile((32, 32, 1), 5, filters=32).count_params()
+
+
+@pytest.mark.parametrize("net_name", ["leap_cnn", "hourglass", "stacked_hourglass", "leap_mobile"])
+@pytest.mark.parametrize("output_stride", [1, 2, 4])
+def test_output_stride(net_name, output_stride):
+    from leap.utils import get_output_stride
+    # Inputs are pooled 4 times per hourglass after the output stride
+    model = getattr(models, net_name)((64, 64, 1), 5, filters=8, output_stride=output_stride)
+    assert get_output_stride(model) == output_stride
+
+
+def test_count_flops():
+    from keras.layers import Input, Conv2D, Conv2DTranspose, SeparableConv2D
+    from keras.models import Model
+    from leap.benchmark import count_flops
+
+    x_in = Input((8, 8, 2))
+    x = Conv2D(4, 3, padding="same")(x_in) # 8 x 8 x (3 x 3 x 2) x 4
+    x = SeparableConv2D(6, 3, strides=2, padding="same")(x) # 4 x 4 x (3 x 3 x 4 + 4 x 6)
+    x = Conv2DTranspose(3, 3, strides=2, padding="same")(x) # 4 x 4 x 3 x 3 x 6 x 3
+    model = Model(x_in, x)
+    assert count_flops(model) == 2 * (8 * 8 * 9 * 2 * 4 + 4 * 4 * (9 * 4 + 4 * 6) + 4 * 4 * 9 * 6 * 3)
+
+
+def test_benchmark_command(capsys):
+    from leap.cli import main
+
+    main(["benchmark", "leap_cnn", "leap_mobile", "--img-size=32", "--output-channels=5", "--filters=8",
+          "--num-samples=8", "--batch-size=4"])
+    out = capsys.readouterr().out
+    assert "leap_cnn" in out and "leap_mobile" in out
@@ -0,0 +1,103 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("keras")
+
+from leap.predict_box import rescale_peaks, group_instances, parse_thresholds, find_low_confidence
+
+
+def test_rescale_peaks_centers_on_input_blocks():
+    Ypk = np.array([[[0, 3], [1, 2], [0.5, 0.9]]], dtype="float32")
+    Y = rescale_peaks(Ypk, 4)
+    assert np.array_equal(Y[0, :2], [[2, 14], [6, 10]])
+    assert np.array_equal(Y[0, 2], Ypk[0, 2])
+    assert rescale_peaks(Ypk, 1) is Ypk
+
+
+def test_group_instances_follows_best_connections():
+    # Two instances of a 3-joint chain, with peaks listed in a different order for each joint
+    instances = np.array([[[1, 2], [3, 4], [5, 6]], [[11, 12], [13, 14], [15, 16]]], dtype="float32")
+    order = np.array([[0, 1], [1, 0], [0, 1]]) # peak k of joint j belongs to instance order[j, k]
+    peaks = np.zeros((1, 2, 3, 3), dtype="float32")
+    for j in range(3):
+        peaks[0, :, :2, j] = instances[order[j], j]
+        peaks[0, :, 2, j] = 0.9
+    edges = np.array([[0, 1], [1, 2]])
+    scores = np.full((1, 2, 2, 2), 0.1, dtype="float32")
+    for e, (src, dst) in enumerate(edges):
+        for k_src in range(2):
+            scores[0, e, k_src, list(order[dst]).index(order[src, k_src])] = 0.8
+
+    grouped = group_instances(peaks, scores, edges, max_instances=3)
+    assert grouped.shape == (1, 3, 3, 3)
+    found = sorted(grouped[0, :2, :2, :].transpose(0, 2, 1).tolist())
+    assert np.allclose(found, instances)
+    assert np.isnan(grouped[0, 2, :2]).all() and (grouped[0, 2, 2] == 0).all()
+
+    # Weak connections are not made: every peak starts its own instance
+    grouped = group_instances(peaks, scores, edges, max_instances=6, min_score=0.9)
+    assert np.sum(~np.isnan(grouped[0, :, 0, :])) == 6
+    assert np.all(np.sum(~np.isnan(grouped[0, :, 0, :]), axis=1) <= 1)
+
+
+def test_predict_box_end_frame_and_cache(tmp_path, box_path, model_path, capsys):
+    import h5py
+    from leap.cli import main
+
+    cache_dir = str(tmp_path / "cache")
+    main(["predict", box_path, model_path, str(tmp_path / "a.h5"), "--start-frame=4", "--end-frame=20",
+          "--cache-dir=" + cache_dir])
+    main(["predict", box_path, model_path, str(tmp_path / "b.h5"), "--end-frame=30", "--cache-dir=" + cache_dir])
+    with h5py.File(str(tmp_path / "a.h5"), "r") as a, h5py.File(str(tmp_path / "b.h5"), "r") as b:
+        assert a["positions_pred"].shape == (16, 2, 5)
+        assert b["positions_pred"].shape == (30, 2, 5)
+        assert np.array_equal(a["positions_pred"][()], b["positions_pred"][4:20])
+        assert np.allclose(a["conf_pred"][()], b["conf_pred"][4:20])
+        expected = a["positions_pred"][()]
+    capsys.readouterr()
+
+    # Re-running over cached frames rewrites the existing output, uncached frames still need --overwrite
+    main(["predict", box_path, model_path, str(tmp_path / "a.h5"), "--start-frame=4", "--end-frame=20",
+          "--cache-dir=" + cache_dir])
+    assert "Rewriting existing output from cache." in capsys.readouterr().out
+    with h5py.File(str(tmp_path / "a.h5"), "r") as a:
+        assert np.array_equal(a["positions_pred"][()], expected)
+    main(["predict", box_path, model_path, str(tmp_path / "a.h5"), "--cache-dir=" + cache_dir])
+    assert "Error: Output path already exists." in capsys.readouterr().out
+
+
+def test_parse_thresholds_and_low_confidence():
+    assert np.array_equal(parse_thresholds(0.5, 3), [0.5, 0.5, 0.5])
+    assert np.array_equal(parse_thresholds([0.1, 0.2, 0.3], 3), np.float32([0.1, 0.2, 0.3]))
+    with pytest.raises(ValueError):
+        parse_thresholds([0.1, 0.2], 3)
+
+    Ypk = np.zeros((4, 3, 2), dtype="float32")
+    Ypk[:, 2, :] = [[0.9, 0.9], [0.2, 0.9], [0.9, 0.4], [0.6, 0.6]]
+    assert find_low_confidence(Ypk, parse_thresholds([0.5, 0.5], 2)).tolist() == [1, 2]
+    assert find_low_confidence(Ypk, parse_thresholds([0.1, 0.7], 2)).tolist() == [2, 3]
+
+
+def test_predict_box_cascade(tmp_path, box_path, model_path):
+    import h5py
+    from leap.cli import main
+    from leap.models import leap_cnn
+
+    cascade_path = str(tmp_path / "cascade.h5")
+    leap_cnn((32, 32, 1), 5, filters=8).save(cascade_path)
+    main(["predict", box_path, model_path, str(tmp_path / "fast.h5"), "--end-frame=12"])
+    main(["predict", box_path, cascade_path, str(tmp_path / "slow.h5"), "--end-frame=12"])
+
+    # Frames are re-predicted if any joint is below its threshold
+    main(["predict", box_path, model_path, str(tmp_path / "all.h5"), "--end-frame=12",
+          "--cascade-model-path=" + cascade_path, "--cascade-threshold=1e9"])
+    main(["predict", box_path, model_path, str(tmp_path / "none.h5"), "--end-frame=12",
+          "--cascade-model-path=" + cascade_path, "--cascade-threshold=-1e9,-1e9,-1e9,-1e9,-1e9"])
+    with h5py.File(str(tmp_path / "fast.h5"), "r") as fast, h5py.File(str(tmp_path / "slow.h5"), "r") as slow, \
+            h5py.File(str(tmp_path / "all.h5"), "r") as all_frames, h5py.File(str(tmp_path / "none.h5"), "r") as none:
+        assert np.all(all_frames["model_idx"][()] == 1)
+        assert np.array_equal(all_frames["positions_pred"][()], slow["positions_pred"][()])
+        assert np.allclose(all_frames.attrs["cascade_threshold"], 1e9)
+        assert np.all(none["model_idx"][()] == 0)
+        assert np.array_equal(none["positions_pred"][()], fast["positions_pred"][()])
+        assert none.attrs["cascade_threshold"].shape == (5,)
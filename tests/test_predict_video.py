@@ -0,0 +1,60 @@
+import numpy as np
+import os
+import h5py
+import cv2
+import pytest
+
+pytest.importorskip("keras")
+
+from leap.cli import main
+
+
+@pytest.fixture
+def video_paths(tmp_path):
+    # 20 frames of 64 x 64 with the animal tracked at the center
+    video_path = str(tmp_path / "video.avi")
+    writer = cv2.VideoWriter(video_path, cv2.VideoWriter_fourcc(*"MJPG"), 30, (64, 64))
+    for i in range(20):
+        writer.write(np.full((64, 64, 3), 10 * i, dtype="uint8"))
+    writer.release()
+
+    tracking_path = str(tmp_path / "tracking.h5")
+    with h5py.File(tracking_path, "w") as f:
+        f["centroids"] = np.full((20, 2), 32, dtype="float32")
+        f["orientations"] = np.zeros(20, dtype="float32")
+    return video_path, tracking_path
+
+
+def test_predict_video_end_frame(tmp_path, model_path, video_paths):
+    video_path, tracking_path = video_paths
+    out_path = str(tmp_path / "preds.h5")
+    main(["predict-video", video_path, tracking_path, model_path, out_path, "--start-frame=5", "--end-frame=12"])
+    with h5py.File(out_path, "r") as f:
+        assert f["positions_pred"].shape == (7, 2, 5)
+        assert f.attrs["start_frame"] == 5
+        assert f["tracked"][()].all()
+
+
+def test_predict_video_no_frames(tmp_path, model_path, video_paths, capsys):
+    video_path, tracking_path = video_paths
+    out_path = str(tmp_path / "preds.h5")
+    main(["predict-video", str(tmp_path / "missing.avi"), tracking_path, model_path, out_path])
+    assert "Error: Could not open video" in capsys.readouterr().out
+
+    with h5py.File(tracking_path, "a") as f:
+        del f["centroids"], f["orientations"]
+        f["centroids"] = np.full((30, 2), 32, dtype="float32")
+        f["orientations"] = np.zeros(30, dtype="float32")
+    main(["predict-video", video_path, tracking_path, model_path, out_path, "--start-frame=25"])
+    assert "Error: No frames decoded" in capsys.readouterr().out
+    assert not os.path.exists(out_path)
+
+
+def test_predict_video_reader_error(tmp_path, model_path, video_paths, monkeypatch):
+    def fail(*args):
+        raise RuntimeError("decode failed")
+    monkeypatch.setattr(cv2, "cvtColor", fail)
+
+    video_path, tracking_path = video_paths
+    with pytest.raises(RuntimeError, match="decode failed"):
+        main(["predict-video", video_path, tracking_path, model_path, str(tmp_path / "preds.h5")])
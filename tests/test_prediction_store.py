@@ -0,0 +1,80 @@
+import csv
+import numpy as np
+import h5py
+
+from leap.prediction_store import PredictionStore, ingest_predictions
+
+
+def write_predictions(tmp_path, lengths, num_joints=3, seed=0):
+    """ Writes predict_box-like files with random predictions and returns their paths and contents. """
+    rng = np.random.RandomState(seed)
+    paths, contents = [], []
+    for i, n in enumerate(lengths):
+        positions = rng.randint(0, 100, size=(n, 2, num_joints)).astype("int32")
+        conf = rng.rand(n, num_joints).astype("float32")
+        conf[:20, 0] = 0.1 # low confidence block of the first joint
+        path = str(tmp_path / ("session%d.h5" % i))
+        with h5py.File(path, "w") as f:
+            f["positions_pred"] = positions
+            f["conf_pred"] = conf
+            f.attrs["start_frame"] = i
+        paths.append(path)
+        contents.append((positions, conf))
+    return paths, contents
+
+
+def test_ingest_and_chunk_summaries(tmp_path):
+    paths, contents = write_predictions(tmp_path, [40, 25, 7])
+    store_path = str(tmp_path / "store.h5")
+    ingest_predictions(store_path, *paths[:2], chunk_frames=16, relative_to=str(tmp_path))
+    ingest_predictions(store_path, str(tmp_path / "session*.h5"), chunk_frames=16, relative_to=str(tmp_path))
+
+    with PredictionStore(store_path) as store:
+        assert store.sessions == ["session0", "session1", "session2"]
+        assert store.num_frames == 72
+        assert store.session_range("session1") == (40, 65)
+        for i, (positions, conf) in enumerate(contents):
+            pos_read, conf_read = store.read(i)
+            assert np.array_equal(pos_read, positions) and np.array_equal(conf_read, conf)
+        pos_read, conf_read = store.read("session0", start=5, end=9, joints=[2, 0])
+        assert np.array_equal(pos_read, contents[0][0][5:9][:, :, [2, 0]])
+
+        # Summaries of every chunk, including the ones spanning sessions
+        all_conf = np.concatenate([conf for _, conf in contents]).T
+        padded = np.pad(all_conf, ((0, 0), (0, 8)), mode="constant", constant_values=np.nan).reshape(3, 5, 16)
+        assert np.allclose(store.f["chunk_conf_min"][()], np.nanmin(padded, axis=2))
+        assert np.allclose(store.f["chunk_conf_max"][()], np.nanmax(padded, axis=2))
+        assert np.allclose(store.f["chunk_conf_mean"][()], np.nanmean(padded, axis=2))
+
+        # Chunks of the sessions whose maximum cannot match are not read (the first one, at least)
+        chunk_max = np.nanmax(padded, axis=2)[0]
+        session_chunks = [(0, 0), (0, 1), (0, 2), (1, 2), (1, 3), (1, 4), (2, 4)]
+        results = store.query(0, min_conf=0.5)
+        assert store.query(0)["chunks_read"] == len(session_chunks)
+        assert results["chunks_read"] == sum(chunk_max[c] > 0.5 for _, c in session_chunks) < len(session_chunks)
+        assert np.array_equal(results["frame"][results["session"] == 0], np.flatnonzero(contents[0][1][:, 0] > 0.5))
+
+
+def test_query_command_matches_brute_force(tmp_path):
+    from leap.cli import main
+
+    paths, contents = write_predictions(tmp_path, [40, 25, 7], seed=1)
+    store_path = str(tmp_path / "store.h5")
+    main(["ingest", store_path] + paths + ["--chunk-frames=16", "--relative-to=" + str(tmp_path)])
+
+    out_path = str(tmp_path / "matches.csv")
+    main(["query", store_path, "1", "--min-conf=0.3", "--max-conf=0.6", "--sessions=session0,session2",
+          "--out-path=" + out_path])
+    with open(out_path, newline="") as f:
+        rows = list(csv.DictReader(f))
+
+    expected = []
+    for i in [0, 2]:
+        positions, conf = contents[i]
+        for frame in np.flatnonzero((conf[:, 1] > 0.3) & (conf[:, 1] < 0.6)):
+            expected.append(("session%d" % i, frame, positions[frame, 0, 1], positions[frame, 1, 1], conf[frame, 1]))
+    assert len(rows) == len(expected) > 0
+    for row, (session, frame, x, y, conf) in zip(rows, expected):
+        assert row["session"] == session and int(row["frame"]) == frame
+        assert int(row["x"]) == x and int(row["y"]) == y
+        assert np.isclose(float(row["conf"]), conf)
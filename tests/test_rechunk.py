@@ -0,0 +1,41 @@
+import numpy as np
+import h5py
+
+from leap.rechunk import frame_chunks, rechunk
+from leap.utils import check_chunk_layout
+
+
+def test_frame_chunks():
+    assert frame_chunks((1000, 1, 192, 192), "uint8", chunk_frames=8) == (8, 1, 192, 192)
+    assert frame_chunks((1000, 1, 192, 192), "uint8") == (28, 1, 192, 192) # ~1 MiB
+    assert frame_chunks((5, 1, 192, 192), "uint8") == (5, 1, 192, 192)
+
+
+def test_rechunk_copies_data_and_metadata(tmp_path, training_path):
+    out_path = str(tmp_path / "rechunked.h5")
+    rechunk(training_path, out_path, chunk_frames=16, block_frames=10)
+    with h5py.File(training_path, "r") as f_in, h5py.File(out_path, "r") as f_out:
+        assert dict(f_in.attrs).keys() == dict(f_out.attrs).keys()
+        assert f_out["box"].chunks == (16, 1, 32, 32)
+        assert f_out["confmaps"].chunks == (16, 5, 32, 32)
+        assert f_out["box"].compression == "lzf"
+        for name in ["box", "confmaps", "joints", "skeleton/edges"]:
+            assert np.array_equal(f_in[name][()], f_out[name][()])
+        assert f_out["skeleton"].attrs["jointNames"] == f_in["skeleton"].attrs["jointNames"]
+        assert f_out["confmaps"].attrs["sigma"] == f_in["confmaps"].attrs["sigma"]
+
+
+def test_check_chunk_layout(tmp_path):
+    with h5py.File(str(tmp_path / "layouts.h5"), "w") as f:
+        assert check_chunk_layout(f.create_dataset("frames", (100, 1, 64, 64), dtype="uint8", chunks=(1, 1, 64, 64)))
+        assert check_chunk_layout(f.create_dataset("contiguous", (100, 1, 64, 64), dtype="uint8"))
+        assert not check_chunk_layout(f.create_dataset("rows", (100, 1, 64, 64), dtype="uint8", chunks=(1, 1, 1, 64)))
+
+
+def test_rechunk_cli_gzip_level(tmp_path, training_path):
+    from leap.cli import main
+    out_path = str(tmp_path / "rechunked.h5")
+    main(["rechunk", training_path, out_path, "--compression=gzip", "--compression-opts=4"])
+    with h5py.File(out_path, "r") as f:
+        assert f["box"].compression == "gzip"
+        assert f["box"].compression_opts == 4
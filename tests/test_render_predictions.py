@@ -0,0 +1,53 @@
+import numpy as np
+import h5py
+import cv2
+
+from leap.render_predictions import confidence_colors, draw_predictions
+
+
+def test_confidence_colors():
+    colors = confidence_colors(np.array([0, 1, np.nan, 2]))
+    assert colors.shape == (4, 3) and colors.dtype == "uint8"
+    assert colors[0, 0] > colors[0, 2] # blue (BGR)
+    assert colors[1, 2] > colors[1, 0] # red
+    assert np.array_equal(colors[2], colors[0])
+    assert np.array_equal(colors[3], colors[1])
+
+
+def test_draw_predictions():
+    frames = np.zeros((2, 8, 8, 3), dtype="uint8")
+    positions = np.array([[[1, 6], [1, 1]], [[2, np.nan], [3, np.nan]]], dtype="float32") # (frames, [x, y], joints)
+    conf = np.array([[1, 0], [0.5, 0]], dtype="float32")
+    out = draw_predictions(frames, positions, conf, edges=[(0, 1)], scale=2, marker_size=0)
+    assert out.shape == (2, 16, 16, 3)
+    assert not np.any(frames) # inputs are not drawn on
+
+    # Markers at the centers of the scaled pixels, and an edge between the joints of the first frame only
+    assert np.array_equal(out[0, 2, 2], confidence_colors(1.0))
+    assert np.array_equal(out[0, 2, 12], confidence_colors(0.0))
+    assert out[0, 2, 7].max() > 0
+    assert np.array_equal(out[1, 6, 4], confidence_colors(0.5))
+    assert np.count_nonzero(out[1].max(axis=-1)) == 1
+
+
+def test_render_command_range(tmp_path, box_path):
+    from leap.cli import main
+
+    with h5py.File(box_path, "r") as f:
+        joints = f["joints"][()] - 1
+    pred_path = str(tmp_path / "preds.h5")
+    with h5py.File(pred_path, "w") as f:
+        f.attrs["start_frame"] = 2
+        f["positions_pred"] = joints[2:].astype("int32")
+        f["conf_pred"] = np.ones((len(joints) - 2, joints.shape[-1]), dtype="float32")
+
+    out_path = str(tmp_path / "preds.avi")
+    main(["render", box_path, pred_path, out_path, "--start=3", "--end=10", "--workers=2", "--segment-frames=4",
+          "--scale=1", "--fourcc=MJPG"])
+    reader = cv2.VideoCapture(out_path)
+    num_frames = 0
+    while reader.read()[0]:
+        num_frames += 1
+    reader.release()
+    assert num_frames == 7
+    assert not (tmp_path / "preds.avi.segments").exists()
@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("keras")
+
+from leap.sweep import parse_grid, expand_grid, MedianPruner, write_results
+
+
+def test_parse_and_expand_grid():
+    grid = parse_grid(["filters=32, 64", "net_name=leap_cnn,hourglass", "amsgrad=True", "rotate_angle=7.5"])
+    assert grid == dict(filters=[32, 64], net_name=["leap_cnn", "hourglass"], amsgrad=[True], rotate_angle=[7.5])
+
+    trials = expand_grid(grid)
+    assert len(trials) == 4
+    assert trials[0] == dict(amsgrad=True, filters=32, net_name="leap_cnn", rotate_angle=7.5)
+    assert len({tuple(sorted(t.items())) for t in trials}) == 4
+
+
+def test_median_pruner():
+    class Model:
+        stop_training = False
+
+    curves = {"a": [1.0, 0.5], "b": [1.0, 0.6], "c": [1.0, 0.7]}
+    pruner = MedianPruner("d", curves, warmup_epochs=2, min_trials=3)
+    pruner.model = Model()
+    pruner.on_epoch_end(0, dict(val_loss=2.0))
+    assert not pruner.model.stop_training # warming up
+    pruner.on_epoch_end(1, dict(val_loss=1.5))
+    assert pruner.pruned and pruner.model.stop_training
+    assert curves["d"] == [2.0, 1.5]
+
+
+def test_write_results_sorts_missing_losses_last(tmp_path):
+    trials = {"t0": dict(filters=8), "t1": dict(filters=16), "t2": dict(filters=32), "t3": dict(filters=64)}
+    results = {"t0": dict(status="failed", best_val_loss=np.nan), "t1": dict(status="completed", best_val_loss=0.5),
+               "t2": dict(status="completed", best_val_loss=0.2)}
+    rows = write_results(str(tmp_path / "results.csv"), trials, results, str(tmp_path))
+    assert [row["trial"] for row in rows[:2]] == ["t2", "t1"]
+    assert sorted(row["trial"] for row in rows[2:]) == ["t0", "t3"]
@@ -0,0 +1,59 @@
+import numpy as np
+import h5py
+
+from leap.synthetic import make_skeleton, write_box
+from leap.utils import load_dataset, load_skeleton, find_symmetric_pairs
+
+
+def test_make_skeleton():
+    skeleton = make_skeleton(11)
+    assert len(skeleton["joint_names"]) == len(skeleton["pos"]) == 11
+    assert len(skeleton["edges"]) == 10 # a tree
+    pairs = find_symmetric_pairs(skeleton["joint_names"])
+    assert len(pairs) == 4
+    for a, b in pairs:
+        assert np.allclose(skeleton["pos"][a], skeleton["pos"][b] * [1, -1])
+
+
+def test_synthetic_training_set(tmp_path, capsys):
+    from leap.cli import main
+
+    path = str(tmp_path / "training.h5")
+    main(["synthetic", path, "--num-frames=10", "--img-size=24", "--num-joints=7", "--chunk-frames=4",
+          "--compression=lzf", "--sigma=2", "--pafs", "--seed=1"])
+    with h5py.File(path, "r") as f:
+        assert f["box"].shape == (10, 1, 24, 24) and f["box"].dtype == "uint8"
+        assert f["box"].chunks == (4, 1, 24, 24) and f["box"].compression == "lzf"
+        assert f["confmaps"].shape == (10, 7, 24, 24) and f["confmaps"].dtype == "float32"
+        assert f["pafs"].shape == (10, 12, 24, 24)
+        assert f["joints"].shape == (10, 2, 7)
+        assert np.array_equal(f["labeledIdx"][()], np.arange(1, 11))
+        joints = f["joints"][()] - 1
+
+    box, confmaps = load_dataset(path)
+    assert box.shape == (10, 24, 24, 1) and box.dtype == "float32" and box.max() <= 1
+    assert confmaps.shape == (10, 24, 24, 7)
+
+    # Confidence maps peak at the joints
+    flat_idx = confmaps.reshape(10, -1, 7).argmax(axis=1)
+    rows, cols = np.unravel_index(flat_idx, (24, 24))
+    assert np.all(np.abs(cols - joints[:, 0]) <= 0.5) and np.all(np.abs(rows - joints[:, 1]) <= 0.5)
+
+    skeleton = load_skeleton(path)
+    assert np.array_equal(skeleton["edges"], make_skeleton(7)["edges"])
+    assert skeleton["joint_names"] == make_skeleton(7)["joint_names"]
+
+    # Existing outputs are kept
+    capsys.readouterr()
+    main(["synthetic", path])
+    assert capsys.readouterr().out.startswith("Error:")
+
+
+def test_write_box_is_seeded(tmp_path):
+    a = write_box(str(tmp_path / "a.h5"), num_frames=5, img_size=16, num_joints=5, chunk_frames=0, seed=3)
+    b = write_box(str(tmp_path / "b.h5"), num_frames=5, img_size=16, num_joints=5, chunk_frames=0, seed=3)
+    with h5py.File(a, "r") as fa, h5py.File(b, "r") as fb:
+        assert fa["box"].chunks is None
+        assert np.array_equal(fa["box"][()], fb["box"][()])
+        assert np.array_equal(fa["joints"][()], fb["joints"][()])
+        assert np.array_equal(fa["framesIdx"][()], np.arange(1, 6))
@@ -0,0 +1,143 @@
+import numpy as np
+import pytest
+
+keras = pytest.importorskip("keras")
+
+from leap.training import distill_targets
+from leap.utils import load_dataset
+
+
+def test_distill_targets_uses_teacher_confmaps(model_path, training_path, box_path):
+    box, confmap = load_dataset(training_path)
+    teacher = keras.models.load_model(model_path)
+    expected = teacher.predict(box)
+
+    X, Y = distill_targets(model_path, box, confmap, alpha=1.0)
+    assert X.shape == box.shape
+    assert np.allclose(Y, expected, atol=1e-5)
+
+    # Labels only, plus teacher targets for unlabeled frames
+    X, Y = distill_targets(model_path, box, confmap, unlabeled_path=box_path, max_unlabeled=10, alpha=0.0)
+    assert len(X) == len(Y) == len(box) + 10
+    assert np.array_equal(Y[:len(box)], confmap)
+
+
+def test_train_command_seed(tmp_path, training_path):
+    from scipy.io import loadmat
+    from leap.cli import main
+    from leap.utils import split_indices
+
+    main(["train", training_path, "--base-output-path=" + str(tmp_path), "--run-name=run", "--seed=0", "--epochs=1",
+          "--batches-per-epoch=1", "--val-batches-per-epoch=1", "--batch-size=4", "--filters=4",
+          "--cache-dir=" + str(tmp_path / "cache")])
+    info = loadmat(str(tmp_path / "run" / "training_info.mat"), squeeze_me=True)
+    assert info["seed"] == 0
+    assert np.array_equal(info["val_idx"], split_indices(48, val_size=0.15, seed=0)[1])
+    assert (tmp_path / "run" / "final_model.h5").exists()
+
+
+def test_time_budget_stops_before_next_epoch(monkeypatch):
+    import leap.training
+    from leap.training import TimeBudget
+
+    class Model:
+        stop_training = False
+
+    clock = [0.0]
+    monkeypatch.setattr(leap.training, "time", lambda: clock[0])
+    budget = TimeBudget(100)
+    budget.model = Model()
+    budget.on_train_begin()
+    for epoch in range(3):
+        clock[0] += 30
+        budget.on_epoch_end(epoch)
+        if budget.model.stop_training:
+            break
+    assert epoch == 2 # 90 + 30 > 100 secs
+
+
+def test_train_time_budget(tmp_path, training_path):
+    from leap.training import train, load_history
+
+    train(training_path, base_output_path=str(tmp_path), run_name="run", epochs=5, batches_per_epoch=1,
+          val_batches_per_epoch=1, batch_size=4, filters=4, time_budget_mins=1e-6)
+    assert len(load_history(str(tmp_path / "run"))) == 1
+
+
+def test_resume_command(tmp_path, training_path):
+    from scipy.io import loadmat
+    from leap.cli import main
+    from leap.training import train, load_history
+
+    run_path = str(tmp_path / "run")
+    train(training_path, base_output_path=str(tmp_path), run_name="run", epochs=1, batches_per_epoch=1,
+          val_batches_per_epoch=1, batch_size=4, filters=4)
+    val_idx = loadmat(str(tmp_path / "run" / "training_info.mat"), squeeze_me=True)["val_idx"]
+
+    main(["resume", run_path, "--epochs=3"])
+    assert len(load_history(run_path)) == 3
+    assert np.array_equal(loadmat(str(tmp_path / "run" / "training_info.mat"), squeeze_me=True)["val_idx"], val_idx)
+
+
+def test_finetune_trains_on_new_frames(tmp_path, training_path):
+    import shutil
+    import h5py
+    from scipy.io import loadmat
+    from leap.cli import main
+    from leap.training import train
+
+    train(training_path, base_output_path=str(tmp_path), run_name="run", epochs=1, batches_per_epoch=1,
+          val_batches_per_epoch=1, batch_size=4, filters=4)
+
+    # Relabel the first 8 frames as if they came from frames of the box that were not labeled before
+    data_path = str(tmp_path / "relabeled.h5")
+    shutil.copy(training_path, data_path)
+    with h5py.File(data_path, "r+") as f:
+        f["labeledIdx"][:8] = 1000 + np.arange(8)
+
+    main(["finetune", data_path, str(tmp_path / "run"), "--replay-ratio=0.5", "--max-epochs=1"])
+    original_val_idx = loadmat(str(tmp_path / "run" / "training_info.mat"), squeeze_me=True)["val_idx"]
+    info = loadmat(str(tmp_path / "run_finetune" / "training_info.mat"), squeeze_me=True)
+
+    # All new frames and 4 replayed ones are trained on, and the original validation frames are kept
+    train_idx, val_idx = np.atleast_1d(info["train_idx"]), np.atleast_1d(info["val_idx"])
+    assert len(train_idx) == len(np.unique(train_idx)) == 12
+    assert np.isin(np.arange(8), train_idx).all()
+    assert np.array_equal(np.sort(val_idx), np.setdiff1d(original_val_idx, np.arange(8)))
+    assert not np.isin(train_idx, original_val_idx[original_val_idx >= 8]).any()
+    assert np.isin(info["labeled_idx"], 999 + np.arange(8)).sum() == 8
+
+
+def test_load_pafs_renders_missing_fields(tmp_path):
+    from leap.synthetic import write_training_set
+    from leap.training import load_pafs
+    from leap.utils import load_skeleton
+
+    data_path = write_training_set(str(tmp_path / "pafs.h5"), num_frames=8, img_size=32, num_joints=5, pafs=True,
+                                   paf_sigma=3.0, seed=0)
+    edges = load_skeleton(data_path)["edges"]
+    idx = np.array([5, 1, 6])
+    loaded = load_pafs(data_path, edges, idx, (32, 32))
+    rendered = load_pafs(data_path, edges, idx, (32, 32), paf_dset="missing", sigma=3.0, block_frames=2)
+    assert loaded.shape == (3, 32, 32, 2 * len(edges))
+    assert np.allclose(loaded, rendered, atol=1e-6)
+
+
+def test_train_pafs(tmp_path, training_path):
+    from scipy.io import loadmat
+    from leap.cli import main
+    from leap.utils import load_skeleton
+
+    main(["train", training_path, "--base-output-path=" + str(tmp_path), "--run-name=run", "--pafs", "--epochs=1",
+          "--batches-per-epoch=1", "--val-batches-per-epoch=1", "--batch-size=4", "--filters=4", "--mirror"])
+    model = keras.models.load_model(str(tmp_path / "run" / "final_model.h5"))
+    num_edges = len(load_skeleton(training_path)["edges"])
+    assert model.output_names[-1] == "pafs"
+    assert model.output_shape[-1] == (None, 32, 32, 2 * num_edges)
+    info = loadmat(str(tmp_path / "run" / "training_info.mat"), squeeze_me=True)
+    assert info["pafs"] and info["paf_sigma"] == 5.0
+
+    # Distillation targets have no fields
+    main(["train", training_path, "--base-output-path=" + str(tmp_path), "--run-name=distill", "--pafs",
+          "--teacher-path=" + str(tmp_path / "run")])
+    assert not (tmp_path / "distill").exists()
@@ -0,0 +1,19 @@
+import numpy as np
+
+from leap.utils import downsample_confmaps, find_symmetric_pairs
+
+
+def test_downsample_confmaps_averages_blocks():
+    Y = np.random.rand(2, 8, 6, 3).astype("float32")
+    Y2 = downsample_confmaps(Y, 2)
+    assert Y2.shape == (2, 4, 3, 3)
+    assert np.allclose(Y2[1, 2, 1, 0], Y[1, 4:6, 2:4, 0].mean())
+    assert downsample_confmaps(Y, 1) is Y
+
+    # Padded to a multiple of the stride
+    assert downsample_confmaps(np.ones((1, 9, 9, 1)), 4).shape == (1, 3, 3, 1)
+
+
+def test_find_symmetric_pairs():
+    names = ["head", "wingL", "wingR", "legL1", "legR1", "legL2", "tail", "legR2", "eyeL"]
+    assert find_symmetric_pairs(names) == [(1, 2), (3, 4), (5, 7)]